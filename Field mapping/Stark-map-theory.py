@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+
+""" Stark-map-theory.py: Calculate the Rydberg Stark map of a target state, to overlay on the measured maps
+
+Energies are in GHz detuning from the zero-field target level against the field in V/cm, and are
+added to an HDF5 file (Stark_theory.hdf by default). Measured wavelengths are converted to the same
+detuning with cfib.stark.detuning. For example, for the Rb 50s state from 0 to 5 V/cm:
+
+    python Stark-map-theory.py 50 0 --fields 0 5 200
+
+The same program is available as 'cfib starkmap'.
+"""
+
+import sys
+from cfib.cli import main
+
+#Make program run now...
+if __name__ == "__main__":
+
+    main(['starkmap'] + sys.argv[1:])
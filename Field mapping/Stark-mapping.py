@@ -49,7 +49,7 @@ class AOsimple:
         #Print a confimation if required
         if confirm == True:
             #Figure out which AO channel is being addressed
-            chan = keyfromvalue(NI_hardware_addresses, self.ao_physchan)
+            chan = registry.channelname(self.ao_physchan)
             print("Channel {} was set to {} V".format(chan, value))
 
     # Clear the task
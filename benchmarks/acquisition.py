@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+
+"""
+acquisition.py: Throughput and latency benchmarks of the acquisition stack, with performance budgets
+
+The benchmarks run against the local stand-ins for the DAQ, wavemeter and iCS2 (standins.py), so
+they measure the cost of the cfib code and of the host, not of the hardware:
+
+    scan       points per second of the Stark scan loop, and the time per point beyond the dwell
+    getfreq    achieved sample rate and jitter of Counter.getfreq
+    aoramp     timing error of executeAOramp against its expected run time
+    ics2       websocket set and measure round trips (cfib.iseg) on top of the stand-in latency
+    hdf5       per point writes (as the scan does) and block appends to an HDF5 file
+    liveplot   frames per second of the live count rate plot (matplotlib Agg backend)
+
+Every run is appended to a JSON history (benchmarks/history.json) with the commit and host. The
+budgets (benchmarks/budgets.json) give for each metric which way is better and optionally
+    min / max     absolute limits
+    regression    largest fractional change for the worse from the median of the last runs
+and the run fails (exit status 1) if any budget is exceeded. Benchmarks whose modules cannot be
+imported (e.g. matplotlib) are reported as unavailable and are not checked.
+
+Run from the repository root with:  python benchmarks/acquisition.py [--only scan hdf5] [--no-save]
+"""
+
+import os #Operating system interfacing
+import sys #System-specific parameters
+import json #History and budget files
+import time #Time access and conversions
+import socket #For finding a free port
+import argparse #Command line arguments
+import platform #Host description
+import tempfile #Files written by the benchmarks
+import subprocess #For the commit of the run
+import numpy as np #For maths
+
+#Run from anywhere: the repository root must be importable, and the stand-ins installed before cfib imports the hardware modules
+benchdir = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(benchdir)
+sys.path[:0] = [root, benchdir]
+import standins
+standins.install()
+
+#Default files
+historyfile = os.path.join(benchdir, 'history.json')
+budgetfile = os.path.join(benchdir, 'budgets.json')
+
+####################################################################################################
+#Benchmarks: each returns a dictionary of metrics
+####################################################################################################
+
+benchmarks = {}
+
+#Register a benchmark under its function name
+def benchmark(func):
+    benchmarks[func.__name__] = func
+    return func
+
+#A free TCP port on this host
+def freeport():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return str(s.getsockname()[1])
+
+#Points per second of the Stark scan loop (short dwell), and where the time beyond the dwell goes
+@benchmark
+def scan(hv_points = 2, wavelength_points = 25, dwell_time = 0.02):
+    import cfib.voltagesets
+    from cfib.scan import Scan, loadspec
+    from cfib.trace import tracer
+    wavemeter = standins.WavemeterPublisher()
+    wavemeter.start()
+    os.environ.setdefault('CFIB_ICS2_PASSWORD', 'standin')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfib.voltagesets._defaultstore = cfib.voltagesets.VoltageSetStore(os.path.join(tmpdir, 'voltage_sets'))
+        spec = loadspec()
+        spec['hardware'].update(wavemeter_address = wavemeter.address, plotter_port = freeport())
+        spec['hv']['numpoints'] = hv_points
+        spec['wavelength']['numpoints'] = wavelength_points
+        spec['timing'].update(dwell_time = dwell_time, hv_settle_time = 0.01)
+        spec['output']['filename'] = os.path.join(tmpdir, 'scan.hdf')
+        s = Scan(spec)
+        s.setup()
+        tracer().reset()
+        t0 = time.perf_counter()
+        try:
+            s.run()
+        finally:
+            elapsed = time.perf_counter() - t0
+            s.close()
+            wavemeter.stop()
+    points = hv_points*wavelength_points
+    spans = tracer().summary()
+    per_point = spans['point']['mean']
+    metrics = {'scan.points_per_second': points/elapsed,
+               'scan.overhead_per_point_ms': 1e3*(per_point - dwell_time - spec['timing']['wavelength_stabilisation_time'])}
+    for name in ('ao write', 'wavemeter wait', 'counter read', 'ai read', 'hdf5 write', 'publish'):
+        if name in spans:
+            metrics['scan.{}_ms'.format(name.replace(' ', '_'))] = 1e3*spans[name]['mean']
+    return metrics
+
+#Achieved sample rate and jitter (standard deviation of the read intervals) of Counter.getfreq
+@benchmark
+def getfreq(sample_rate = 200, samples = 400):
+    from cfib.daq import Counter
+    counter = Counter()
+    counter.start()
+    standins.Task.readtimes = []
+    try:
+        counter.getfreq(sample_rate = sample_rate, samples = samples)
+        intervals = np.diff(standins.Task.readtimes)
+    finally:
+        standins.Task.readtimes = None
+        counter.close()
+    return {'getfreq.sample_rate_hz': 1/intervals.mean(),
+            'getfreq.rate_error_percent': 100*abs(1/intervals.mean() - sample_rate)/sample_rate,
+            'getfreq.jitter_ms': 1e3*intervals.std(),
+            'getfreq.max_interval_ms': 1e3*intervals.max()}
+
+#Timing error of executeAOramp against the expected run time it reports, with and without slew
+@benchmark
+def aoramp(points = 50, dwell = 0.01, slew = 0.005):
+    from cfib.daq import executeAOramp
+    metrics = {}
+    for name, s in (('noslew', 0), ('slew', slew)):
+        expected = (dwell + s)*points + s
+        t0 = time.perf_counter()
+        executeAOramp('/Dev6229/ao1', -1, 1, points, dwell, slew = s, showplot = False)
+        actual = time.perf_counter() - t0
+        metrics['aoramp.{}_error_percent'.format(name)] = 100*(actual - expected)/expected
+    return metrics
+
+#Websocket set and measure round trips of cfib.iseg, and their overhead over the stand-in latency
+@benchmark
+def ics2(requests = 200):
+    import cfib.iseg as iseg
+    os.environ.setdefault('CFIB_ICS2_PASSWORD', 'standin')
+    iseg.iCStasks.initialise()
+    electrode = iseg.eset[0]
+    setvalue = abs(electrode.limit)/2*np.sign(electrode.limit)
+    t0 = time.perf_counter()
+    for i in range(requests):
+        iseg.executeWSrequest(iseg.generateWSrequest(electrode, setvalue))
+    set_time = (time.perf_counter() - t0)/requests
+    roundtrips = np.zeros(requests)
+    for i in range(requests):
+        t0 = time.perf_counter()
+        iseg.executeWSrequest(iseg.generateWSrequest(electrode, wstask = iseg.iCStasks.VMEAS))
+        roundtrips[i] = time.perf_counter() - t0
+    return {'ics2.sets_per_second': 1/set_time,
+            'ics2.measure_roundtrip_ms': 1e3*np.median(roundtrips),
+            'ics2.measure_overhead_ms': 1e3*(np.median(roundtrips) - standins.ics2_latency),
+            'ics2.measure_p99_ms': 1e3*np.percentile(roundtrips, 99)}
+
+#HDF5 writes: one point at a time into a preallocated slab (as the scan does), and appends of blocks to a growing dataset
+@benchmark
+def hdf5(hv_points = 20, wavelength_points = 100, blocks = 200, block_size = 10000):
+    import h5py
+    point = np.arange(6, dtype = np.float64)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with h5py.File(os.path.join(tmpdir, 'bench.hdf'), 'w') as f:
+            dset = f.create_dataset('slab', (hv_points, wavelength_points, 6), 'float64')
+            t0 = time.perf_counter()
+            for i in range(hv_points):
+                for j in range(wavelength_points):
+                    dset[i, j, :] = point
+            f.flush()
+            point_time = (time.perf_counter() - t0)/(hv_points*wavelength_points)
+            block = np.random.normal(size = block_size)
+            aset = f.create_dataset('stream', (0,), 'float64', maxshape = (None,), chunks = (block_size,))
+            t0 = time.perf_counter()
+            for i in range(blocks):
+                aset.resize((i + 1)*block_size, axis = 0)
+                aset[i*block_size:] = block
+            f.flush()
+            append_time = time.perf_counter() - t0
+    return {'hdf5.point_writes_per_second': 1/point_time,
+            'hdf5.append_mb_per_second': blocks*block.nbytes/append_time/1e6}
+
+#Frames per second of the live count rate plot, drawn as makeplot does while a counter is acquired
+@benchmark
+def liveplot(frames = 100, sample_rate = 200, t_span = 5):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from cfib.live import RingBuffer, AcquisitionThread
+    from cfib.daq import Counter
+    points = int(t_span*sample_rate)
+    fig, ax = plt.subplots(1, 1, tight_layout = True)
+    line, = ax.plot(np.linspace(-t_span, 0, points), np.zeros(points))
+    ax.set_ylim(-100, 2100)
+    history = RingBuffer(points)
+    counter = Counter()
+    counter.start()
+    acquisition = AcquisitionThread(counter.readrate, sample_rate, [history])
+    acquisition.start()
+    try:
+        fig.canvas.draw()
+        t0 = time.perf_counter()
+        for i in range(frames):
+            line.set_ydata(history.view())
+            fig.canvas.draw()
+        elapsed = time.perf_counter() - t0
+    finally:
+        acquisition.stop()
+        counter.close()
+        plt.close(fig)
+    return {'liveplot.frames_per_second': frames/elapsed, 'liveplot.acquisition_overruns': acquisition.overruns}
+
+####################################################################################################
+#History and budgets
+####################################################################################################
+
+#Read a JSON file, returning default if it does not exist
+def readjson(filename, default):
+    if not os.path.exists(filename):
+        return default
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+#Commit of the working tree (None outside a git repository)
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd = root, capture_output = True, text = True).stdout.strip() or None
+    except OSError:
+        return None
+
+#Check the results against the budgets and the history. Returns a list of failure messages
+#budgets: {metric: {'better': 'higher' or 'lower', 'min': ..., 'max': ..., 'regression': fraction}, '_history_runs': n}
+def checkbudgets(results, budgets, history):
+    failures = []
+    runs = budgets.get('_history_runs', 5)
+    for metric, budget in budgets.items():
+        if metric.startswith('_') or metric not in results:
+            continue
+        value = results[metric]
+        if 'min' in budget and value < budget['min']:
+            failures.append('{} = {:.4g} is below the minimum {:.4g}'.format(metric, value, budget['min']))
+        if 'max' in budget and value > budget['max']:
+            failures.append('{} = {:.4g} is above the maximum {:.4g}'.format(metric, value, budget['max']))
+        if 'regression' in budget:
+            previous = [run['results'][metric] for run in history if metric in run['results']][-runs:]
+            if previous:
+                reference = float(np.median(previous))
+                change = (value - reference)/abs(reference) if reference != 0 else 0.0
+                worse = -change if budget.get('better', 'higher') == 'higher' else change
+                if worse > budget['regression']:
+                    failures.append('{} = {:.4g} is {:.0f}% worse than the median {:.4g} of the last {} runs (budget {:.0f}%)'.format(
+                        metric, value, 100*worse, reference, len(previous), 100*budget['regression']))
+    return failures
+
+####################################################################################################
+#Code starts here
+####################################################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmarks of the acquisition stack against local hardware stand-ins')
+    parser.add_argument('--only', nargs = '+', choices = sorted(benchmarks), help = 'benchmarks to run (default all)')
+    parser.add_argument('--history', default = historyfile, help = 'JSON history of the runs')
+    parser.add_argument('--budgets', default = budgetfile, help = 'JSON performance budgets')
+    parser.add_argument('--no-save', action = 'store_true', help = 'do not append this run to the history')
+    args = parser.parse_args()
+
+    results, unavailable = {}, []
+    for name in args.only or benchmarks:
+        print('Running {}...'.format(name))
+        try:
+            metrics = benchmarks[name]()
+        except ImportError as e:
+            print('{} unavailable ({})'.format(name, e))
+            unavailable.append(name)
+            continue
+        results.update(metrics)
+
+    history = readjson(args.history, [])
+    failures = checkbudgets(results, readjson(args.budgets, {}), history)
+
+    print('########################################################')
+    for metric, value in results.items():
+        print('{:<36s} {:12.4g}'.format(metric, value))
+    for failure in failures:
+        print('BUDGET EXCEEDED: ' + failure)
+
+    if not args.no_save:
+        history.append({'time': time.time(), 'commit': commit(), 'host': platform.node(), 'python': platform.python_version(),
+                        'results': results, 'unavailable': unavailable, 'passed': not failures})
+        with open(args.history, 'w') as f:
+            json.dump(history, f, indent = 1)
+    sys.exit(1 if failures else 0)
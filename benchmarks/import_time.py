@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+"""
+import_time.py: Time the start up of the cfib entry points against the old script imports
+
+Each import is run in a fresh interpreter (the best of 'repeats' runs is reported), so module
+caching between measurements does not hide the cost. Imports which fail (e.g. PyDAQmx on a machine
+without NI-DAQmx) are reported as unavailable.
+
+Run from the repository root with:  python benchmarks/import_time.py [repeats]
+"""
+
+import subprocess #For running fresh interpreters
+import sys #System-specific parameters
+import os #Operating system interfacing
+
+#Statements to time: the old script preamble, and the cfib equivalents
+statements = [
+    ('legacy script preamble', 'from pylab import *; from PyDAQmx import *; from CFIBfunctions import *'),
+    ('legacy without PyDAQmx', 'from pylab import *; from CFIBfunctions import *'),
+    ('import cfib', 'import cfib'),
+    ('cfib command line', 'import cfib.cli; cfib.cli.makeparser()'),
+    ('cfib pressure', 'import cfib.pressure; cfib.pressure.loadgauges()'),
+    ('cfib functions', 'import cfib.functions'),
+    ('cfib daq', 'import cfib.daq'),
+    ('cfib plotting', 'import cfib.plotting'),
+]
+
+#Time a statement in a fresh interpreter, returning the best time in seconds (None if it fails)
+def timeimport(statement, repeats = 5):
+    code = 'import time; t0 = time.perf_counter(); {}; print(time.perf_counter() - t0)'.format(statement)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    best = None
+    for i in range(repeats):
+        result = subprocess.run([sys.executable, '-c', code], cwd = root, capture_output = True, text = True)
+        if result.returncode != 0:
+            return None
+        t = float(result.stdout.strip().splitlines()[-1])
+        best = t if best is None else min(best, t)
+    return best
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for name, statement in statements:
+        t = timeimport(statement, repeats)
+        if t is None:
+            print('{:<26s} unavailable'.format(name))
+        else:
+            print('{:<26s} {:8.1f} ms'.format(name, 1000*t))
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+"""
+standins.py: Local stand-ins for the hardware, used by the benchmarks
+
+    PyDAQmx    Task simulating counters (a constant count rate), analogue inputs (samples arrive
+               at the sample rate) and analogue outputs; every other DAQmx call does nothing
+    wavemeter  a ZMQ publisher sending 'L1' wavelengths at a fixed rate, as the wavemeter PC does
+    iCS2       websocket and HTTP API (the websocket and requests modules) answering like the iCS2,
+               with a fixed latency per request
+
+install() puts the stand-in modules in sys.modules, replacing any real ones, so it must be called
+before cfib.daq, cfib.iseg or cfib.scan are imported. The benchmarks never talk to real hardware.
+"""
+
+import sys #System-specific parameters
+import time #Time access and conversions
+import types #For making the stand-in modules
+import json #iCS2 messages
+import threading #Wavemeter publisher thread
+import numpy as np #For maths
+
+####################################################################################################
+#NI DAQ
+####################################################################################################
+
+#The DAQmx constants used by cfib (the values are irrelevant to the stand-in, but must be distinct)
+daqmx_constants = ['DAQmx_Val_Auto', 'DAQmx_Val_Cfg_Default', 'DAQmx_Val_ContSamps', 'DAQmx_Val_CountUp', 'DAQmx_Val_DigEdge',
+                   'DAQmx_Val_DigLvl', 'DAQmx_Val_DoNotAllowRegen', 'DAQmx_Val_Falling', 'DAQmx_Val_FiniteSamps',
+                   'DAQmx_Val_GroupByChannel', 'DAQmx_Val_GroupByScanNumber', 'DAQmx_Val_High', 'DAQmx_Val_Low',
+                   'DAQmx_Val_MostRecentSamp', 'DAQmx_Val_Rising', 'DAQmx_Val_Task_Unreserve', 'DAQmx_Val_Volts']
+
+# Task class: stand-in for PyDAQmx.Task
+class Task:
+    count_rate = 1000.0 #Counts per second of every counter
+    write_latency = 0.0 #Time taken by each AO write (s)
+    readtimes = None #Set to a list to record the perf_counter time of every counter read
+
+    def __init__(self):
+        self.start = None #Time the task was started
+        self.kind = None #'ci', 'ai' or 'ao'
+        self.sample_rate = None #AI sample rate
+        self.clock_source = None #Sample clock terminal
+        self.most_recent = False #AI reads return at once (relative to the most recent sample)
+        self.written = None #Last AO value
+        self.created = time.perf_counter()
+
+    def CreateCICountEdgesChan(self, *args):
+        self.kind = 'ci'
+
+    def CreateAIVoltageChan(self, channels, *args):
+        self.kind = 'ai'
+        self.nchan = len(channels.split(','))
+
+    def CreateAOVoltageChan(self, *args):
+        self.kind = 'ao'
+
+    def CfgSampClkTiming(self, source, rate, *args):
+        self.sample_rate = rate
+        self.clock_source = source
+
+    def SetReadRelativeTo(self, value):
+        self.most_recent = True
+
+    def StartTask(self):
+        self.start = time.perf_counter()
+
+    def StopTask(self):
+        self.start = None
+
+    def ReadCounterScalarU32(self, timeout, value, reserved):
+        now = time.perf_counter()
+        if Task.readtimes is not None:
+            Task.readtimes.append(now)
+        elapsed = now - (self.created if self.start is None else self.start)
+        value[0] = int(self.count_rate*elapsed) % 2**32
+
+    def ReadCounterU32(self, samples, timeout, data, size, read, reserved):
+        #Counters clocked by another task's sample clock latch count_rate counts per second on each sample
+        if 'SampleClock' in (self.clock_source or ''):
+            data[:samples] = (self.count_rate*np.arange(samples)/self.sample_rate).astype(np.int64) % 2**32
+            read._obj.value = samples
+            return
+        read._obj.value = 0
+
+    def ReadAnalogF64(self, samples, timeout, fill, data, size, read, reserved):
+        if not self.most_recent and self.sample_rate:
+            time.sleep(samples/self.sample_rate)
+        data[:] = np.random.normal(0, 1e-3, data.size)
+        read._obj.value = samples
+
+    def WriteAnalogF64(self, samples, autostart, timeout, layout, data, written, reserved):
+        if self.write_latency > 0:
+            time.sleep(self.write_latency)
+        self.written = float(np.asarray(data).ravel()[-1])
+
+    #Any other DAQmx call (triggers, terminals, clearing) does nothing
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return lambda *args: None
+
+#Make the PyDAQmx stand-in module
+def makepydaqmx():
+    module = types.ModuleType('PyDAQmx')
+    module.Task = Task
+    for i, name in enumerate(daqmx_constants):
+        setattr(module, name, 10000 + i)
+    module.__all__ = ['Task'] + daqmx_constants
+    return module
+
+####################################################################################################
+#Wavemeter
+####################################################################################################
+
+# WavemeterPublisher class: publishes 'L1' wavelengths on a local port at a fixed rate
+class WavemeterPublisher(threading.Thread):
+    def __init__(self, rate = 200.0, wavelength = 780.241):
+        threading.Thread.__init__(self, daemon = True)
+        import zmq
+        self.rate = rate #Messages per second
+        self.wavelength = wavelength #Centre wavelength (nm)
+        self.ctx = zmq.Context.instance()
+        self.socket = self.ctx.socket(zmq.PUB)
+        port = self.socket.bind_to_random_port('tcp://127.0.0.1')
+        self.address = 'tcp://127.0.0.1:{}'.format(port) #Address to connect subscribers to
+        self.port = str(port)
+        self.running = threading.Event()
+
+    def run(self):
+        self.running.set()
+        period = 1/self.rate
+        next_time = time.perf_counter()
+        while self.running.is_set():
+            self.socket.send_multipart([b'L1', '{:.6f}'.format(self.wavelength + 1e-4*np.random.randn()).encode()])
+            next_time += period
+            time.sleep(max(next_time - time.perf_counter(), 0))
+
+    def stop(self):
+        self.running.clear()
+        self.join(1.0)
+        self.socket.close()
+
+####################################################################################################
+#iCS2
+####################################################################################################
+
+#Latency (s) of every iCS2 request (websocket and HTTP)
+ics2_latency = 1e-3
+
+# ICS2Connection class: stand-in for a websocket connection to the iCS2
+class ICS2Connection:
+    def __init__(self, url = None):
+        self.connected = True
+        self.replies = [] #Messages waiting to be received
+        self.voltages = {} #Set voltages by channel address (JSON)
+
+    def send(self, packet):
+        message = json.loads(packet)
+        if message['t'] == 'login':
+            self.replies.append({'i': 'standin-session'})
+            return
+        if message['t'] != 'request':
+            return
+        for command in message['c']:
+            p = command['p']
+            address = json.dumps(p['p'], sort_keys = True)
+            if command['c'] == 'setItem':
+                self.voltages[address] = p['v']
+            elif command['c'] == 'getItem':
+                data = {'i': p['i'], 'p': p['p'], 'v': str(self.voltages.get(address, 0.0)), 'u': 'V', 't': str(time.time())}
+                self.replies.append([{'c': [{'d': data}]}])
+
+    def recv(self):
+        time.sleep(ics2_latency)
+        return json.dumps(self.replies.pop(0) if self.replies else [{'c': [{}]}])
+
+    def connect(self, url):
+        self.connected = True
+
+    def close(self):
+        self.connected = False
+
+#Make the websocket stand-in module
+def makewebsocket():
+    module = types.ModuleType('websocket')
+    module.create_connection = lambda url, *args, **kwargs: ICS2Connection(url)
+    module.WebSocketConnectionClosedException = type('WebSocketConnectionClosedException', (Exception,), {})
+    return module
+
+# Response class: stand-in for a response of the iCS2 HTTP API
+class Response:
+    def __init__(self, data):
+        self.data = data
+        self.status_code = 200
+        self.content = json.dumps(data).encode()
+
+    def json(self):
+        return self.data
+
+#Make the requests stand-in module (the HTTP API of the iCS2)
+def makerequests():
+    module = types.ModuleType('requests')
+    def get(url, *args, **kwargs):
+        time.sleep(ics2_latency)
+        return Response({'i': 'standin-session'})
+    module.get = get
+    return module
+
+####################################################################################################
+#Installation
+####################################################################################################
+
+#Replace the hardware modules with the stand-ins
+def install():
+    for name in ('cfib.daq', 'cfib.iseg', 'cfib.scan', 'cfib.plotting'):
+        if name in sys.modules:
+            raise RuntimeError("{} was imported before the stand-ins were installed".format(name))
+    sys.modules['PyDAQmx'] = makepydaqmx()
+    sys.modules['websocket'] = makewebsocket()
+    sys.modules['requests'] = makerequests()
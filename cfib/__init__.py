@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+
+"""
+cfib: the CFIB control system package
+
+Importing cfib is cheap: the submodules (and the hardware, plotting and analysis libraries they
+need) are only imported when first accessed, e.g. cfib.pressure or 'from cfib.daq import Counter'.
+The command line entry point is cfib.cli ('cfib pressure', 'cfib count', 'cfib scan spec.toml').
+"""
+
+import importlib
+
+__version__ = '0.1.0'
+
+#Submodules available as attributes of the package (loaded on first access)
+submodules = ('functions', 'registry', 'pressure', 'monitor', 'interlock', 'logger', 'live', 'rateoutput',
+              'voltagesets', 'timebase', 'timetag', 'trace', 'counterstats', 'lockin', 'daq', 'wavemeter', 'iseg', 'plotting', 'scan', 'orchestrate', 'stark', 'fieldmap', 'dataserver', 'session', 'cli')
+
+def __getattr__(name):
+    if name in submodules:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+def __dir__():
+    return sorted(list(globals()) + list(submodules))
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+
+"""
+cli.py: The 'cfib' command line entry point
+
+    cfib pressure [--log] [--period s]      Read the pressure gauges
+    cfib count [--plot] [--channel name]    Print (or plot) the count rate of a counter
+               [--gate terminal]            or the counts per gate of a gated counter
+    cfib scan spec.toml [--resume [slab]]   Run (or continue) a Stark map scan
+    cfib monitor [view [channels]]          Run the monitor daemon, or print its stream
+                 [--shared]                 (keeping the channels in shared memory for notebooks)
+    cfib log [channels]                     Log the monitor stream to the slow-control log
+    cfib interlock [rules.toml] [--dry-run] Shut the HV down when a rule on the live channels trips
+    cfib rateout                            Run the CEM rate to analogue converter
+    cfib run jobs.toml                      Run independent acquisitions on several DAQ devices at once
+    cfib starkmap n l [--fields a b num]    Calculate a Rydberg Stark map (GHz detuning against V/cm)
+    cfib fieldmap solve name geometry.toml  Make a field map of the electrodes with the Laplace solver
+    cfib fieldmap import name e1=file ...   Make a field map from the unit solutions of an external solver
+    cfib fieldmap field name [voltages]     Print the field at a point for a voltage file (default the applied set)
+    cfib fieldmap voltages name --target    Solve for the electrode voltages of a target field
+    cfib dataserver [files]                 Serve the HDF5 data files to analysis clients
+    cfib data [file] [--follow slab]        List the served files or datasets, or follow a running scan
+    cfib record log command ...             Run a command, recording its hardware traffic to a session log
+    cfib replay [--speed s] log [command]   Run a command against a recorded session instead of the hardware
+                                            (without a command, print the streams of the session log)
+
+Each subcommand imports only the modules it needs, so e.g. 'cfib pressure' does not import matplotlib.
+"""
+
+####################################################################################################
+#Import modules
+####################################################################################################
+import argparse #Command line parsing
+import sys #System-specific parameters
+import time #Time access and conversions
+
+####################################################################################################
+#Define functions (one per subcommand)
+####################################################################################################
+
+def pressure(args):
+    from cfib.pressure import readpressure, gaugefile
+    readpressure(period = args.period, log = args.log, filename = args.gauges or gaugefile)
+
+def count(args):
+    if args.plot:
+        from cfib.plotting import makeplot
+        makeplot(t_span = args.span, sample_rate = args.rate)
+        return
+    from cfib.functions import NI_hardware_addresses
+    from cfib.daq import Counter
+    counter = Counter(NI_hardware_addresses[args.channel], gate_terminal = args.gate, gate_active = args.gate_active,
+                      gate_counter = args.gate_counter if args.gate else None, deadtime = args.deadtime)
+    counter.start()
+    count, gates = counter.readcount()[0], counter.gates
+    print('Press Ctrl-C to end.')
+    try:
+        while True:
+            time.sleep(1/args.rate)
+            if args.gate is None:
+                print("The count rate ({}) is {:.1f} Hz".format(args.channel, counter.readrate()))
+                continue
+            #Counts (and gates) since the last reading
+            lastcount, lastgates = count, gates
+            count, gates = counter.readcount()[0], counter.gates
+            dgates = gates - lastgates
+            print("{} counts in {} gates ({}){}".format(count - lastcount, dgates, args.channel,
+                  ", {:.2f} per gate".format((count - lastcount)/dgates) if dgates > 0 else ''))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        counter.close()
+    if counter.stats.n > 0:
+        print(counter.stats.report())
+
+def scan(args):
+    from cfib.scan import runscan
+    print('Data stored in slab {}'.format(runscan(args.spec, resume = args.resume, trace_file = args.trace)))
+
+def monitor(args):
+    from cfib.monitor import makedaemon, printmonitor
+    if args.view == 'view':
+        printmonitor(args.channels or None)
+    elif args.view is None:
+        makedaemon(shared = args.shared).run()
+    else:
+        sys.exit("Unknown monitor command {}; use 'cfib monitor' or 'cfib monitor view'".format(args.view))
+
+def log(args):
+    from cfib.logger import logmonitor, logfile
+    logmonitor(filename = args.file or logfile, channels = args.channels or None)
+
+def interlock(args):
+    from cfib.interlock import makeinterlock, rulefile
+    makeinterlock(args.rules or rulefile, dryrun = args.dry_run).run()
+
+def rateout(args):
+    from cfib.rateoutput import RateToAnalogue
+    RateToAnalogue(args.counter, args.ao, loop_rate = args.loop_rate, block = args.block,
+                   max_count_rate = args.max_count_rate, deadtime = args.deadtime).run()
+
+def run(args):
+    from cfib.orchestrate import runjobs
+    failed = runjobs(args.jobs, refresh = args.refresh)
+    if failed:
+        sys.exit('Jobs failed: ' + ', '.join(failed))
+
+def starkmap(args):
+    import numpy as np
+    from cfib.stark import StarkCalculator
+    calc = StarkCalculator(args.species, args.n, args.l, m = args.m, dn = args.dn, lmax = args.lmax)
+    print('Basis of {} states; diagonalising at {} fields...'.format(len(calc.basis), args.fields[2]))
+    result = calc.starkmap(np.linspace(args.fields[0], args.fields[1], int(args.fields[2])), neigs = args.neigs, workers = args.workers)
+    print('Stark map stored as {} in {}'.format(result.save(args.output), args.output))
+
+def fieldmap(args):
+    from cfib.fieldmap import FieldMap, FieldSolver, solvegeometry, importmap, linepoints
+    if args.action == 'solve':
+        if len(args.files) != 1:
+            sys.exit('Give one geometry file: cfib fieldmap solve name geometry.toml')
+        solvegeometry(args.name, args.files[0])
+        return
+    if args.action == 'import':
+        files = dict(f.split('=', 1) for f in args.files if '=' in f)
+        if len(files) != len(args.files) or not files:
+            sys.exit('Give the solution of each electrode as electrode=file, e.g. e21=e21.txt')
+        importmap(args.name, files, units = args.units)
+        return
+    #Voltages of the field (or fixed electrodes of the solution): a voltage file, or the set applied on the iCS2
+    from cfib.functions import registry
+    from cfib.voltagesets import defaultstore
+    if args.files:
+        voltages = registry.loadvoltages(args.files[0])
+    else:
+        store = defaultstore()
+        applied = store.applied()
+        if applied is None:
+            sys.exit('No electrode voltage set has been applied; give a voltage file')
+        voltages = store.get(applied)
+    fm = FieldMap(args.name)
+    if args.action == 'voltages':
+        varied = args.electrodes or fm.electrodes
+        points = linepoints(args.line[:3], args.line[3:], args.line_points) if args.line else [args.point]
+        solver = FieldSolver(fm, points, electrodes = varied, fixed = {e: v for e, v in voltages.items() if e not in varied})
+        voltages = solver.solve(args.target)
+        for e in solver.electrodes:
+            print('{}, {:.2f}'.format(e, voltages[e]))
+        print('#Largest deviation from the target: {:.3g} V/cm'.format(solver.error()))
+    F = fm.fieldat(voltages, args.point)
+    print('Field at {} mm: ({:.4g}, {:.4g}, {:.4g}) V/cm, |F| = {:.4g} V/cm'.format(args.point, *F, sum(F**2)**0.5))
+
+def dataserver(args):
+    from cfib.dataserver import DataServer
+    DataServer(args.files).run()
+
+def data(args):
+    from cfib.dataserver import printdata
+    printdata(args.file, follow = args.follow, address = args.address)
+
+def record(args):
+    from cfib.session import record
+    if not args.args:
+        sys.exit('Give the command to record, e.g. cfib record session.cfiblog scan spec.toml')
+    record(args.log)
+    main(args.args)
+
+def replay(args):
+    from cfib.session import replay, printlog
+    if not args.args:
+        printlog(args.log)
+        return
+    replay(args.log, speed = None if args.speed == 'max' else float(args.speed))
+    main(args.args)
+
+#Build the argument parser
+def makeparser():
+    parser = argparse.ArgumentParser(prog = 'cfib', description = 'CFIB control system')
+    sub = parser.add_subparsers(dest = 'command', metavar = 'command')
+    sub.required = True
+
+    p = sub.add_parser('pressure', help = 'read the pressure gauges')
+    p.add_argument('--log', action = 'store_true', help = 'append the readings to the slow-control log')
+    p.add_argument('--period', type = float, default = 1.0, help = 'seconds between readings')
+    p.add_argument('--gauges', help = 'gauge calibration file (default gauge_calibrations.txt)')
+    p.set_defaults(func = pressure)
+
+    p = sub.add_parser('count', help = 'print or plot a count rate')
+    p.add_argument('--plot', action = 'store_true', help = 'plot the CEM count rate in real time')
+    p.add_argument('--channel', default = 'Counter 2', help = 'counter name in NI_physical_addresses.txt')
+    p.add_argument('--rate', type = float, default = 50, help = 'samples per second (plot) or readings per second')
+    p.add_argument('--span', type = float, default = 1, help = 'time span of the plot in seconds')
+    p.add_argument('--gate', metavar = 'TERMINAL', help = 'only count while this PFI terminal is active, e.g. /Dev6229/PFI0')
+    p.add_argument('--gate-active', choices = ('high', 'low'), default = 'high', help = 'level of the gate during which edges are counted')
+    p.add_argument('--gate-counter', default = '/Dev6229/ctr1', help = 'counter used to count the gates')
+    p.add_argument('--deadtime', type = float, default = 0.0, help = 'dead time of the detector (s) the rates are corrected for')
+    p.set_defaults(func = count)
+
+    p = sub.add_parser('scan', help = 'run a Stark map scan')
+    p.add_argument('spec', nargs = '?', help = 'TOML scan spec (defaults are used for anything not given)')
+    p.add_argument('--resume', nargs = '?', const = '', metavar = 'SLAB',
+                   help = 'continue an interrupted scan in the data file of the spec (by default the latest incomplete slab)')
+    p.add_argument('--trace', metavar = 'FILE', help = 'write a Chrome trace of the phases of each point')
+    p.set_defaults(func = scan)
+
+    p = sub.add_parser('monitor', help = 'run the monitor daemon or view its stream')
+    p.add_argument('view', nargs = '?', help = "'view' to print the stream")
+    p.add_argument('channels', nargs = '*', help = 'channels to print (default all)')
+    p.add_argument('--shared', action = 'store_true', help = 'keep the channels in shared memory buffers (cfib_<channel>)')
+    p.set_defaults(func = monitor)
+
+    p = sub.add_parser('log', help = 'log the monitor stream')
+    p.add_argument('channels', nargs = '*', help = 'channels to log (default all)')
+    p.add_argument('--file', help = 'log file (default slow_control_log.hdf)')
+    p.set_defaults(func = log)
+
+    p = sub.add_parser('interlock', help = 'shut the HV down when a rule on the live channels trips')
+    p.add_argument('rules', nargs = '?', help = 'TOML rules file (default interlock_rules.toml in the configuration directory)')
+    p.add_argument('--dry-run', action = 'store_true', help = 'report trips without contacting the iCS2')
+    p.set_defaults(func = interlock)
+
+    p = sub.add_parser('rateout', help = 'run the CEM rate to analogue converter')
+    p.add_argument('--counter', default = '/Dev6229/ctr1', help = 'counter physical channel')
+    p.add_argument('--ao', default = '/Dev6229/ao0', help = 'analogue output physical channel')
+    p.add_argument('--loop-rate', type = float, default = 1000, help = 'AO sample clock rate')
+    p.add_argument('--block', type = int, default = 25, help = 'samples per loop iteration')
+    p.add_argument('--max-count-rate', type = float, default = 10000, help = 'count rate at full scale')
+    p.add_argument('--deadtime', type = float, default = 0.0, help = 'dead time of the CEM (s) the rates are corrected for')
+    p.set_defaults(func = rateout)
+
+    p = sub.add_parser('run', help = 'run independent acquisitions on several DAQ devices at once')
+    p.add_argument('jobs', help = 'TOML jobs file (see cfib/orchestrate.py)')
+    p.add_argument('--refresh', type = float, default = 2.0, help = 'seconds between progress tables')
+    p.set_defaults(func = run)
+
+    p = sub.add_parser('starkmap', help = 'calculate a Rydberg Stark map')
+    p.add_argument('n', type = int, help = 'principal quantum number of the target state')
+    p.add_argument('l', type = int, help = 'orbital angular momentum of the target state')
+    p.add_argument('--m', type = int, default = 0, help = 'magnetic quantum number')
+    p.add_argument('--species', default = 'Rb85', help = 'atom (Rb85, Rb87 or H)')
+    p.add_argument('--dn', type = int, default = 3, help = 'basis includes n - dn to n + dn')
+    p.add_argument('--lmax', type = int, help = 'largest l in the basis (default n - 1)')
+    p.add_argument('--fields', type = float, nargs = 3, default = [0, 5, 200], metavar = ('MIN', 'MAX', 'NUM'), help = 'fields in V/cm')
+    p.add_argument('--neigs', type = int, default = 40, help = 'levels calculated around the target state')
+    p.add_argument('--workers', type = int, help = 'processes used (default the number of CPUs)')
+    p.add_argument('--output', default = 'Stark_theory.hdf', help = 'HDF5 file the map is added to')
+    p.set_defaults(func = starkmap)
+
+    p = sub.add_parser('fieldmap', help = 'make or use a field map of the electrodes')
+    p.add_argument('action', choices = ['solve', 'import', 'field', 'voltages'], help = 'solve a geometry, import solutions, print a field or solve for voltages')
+    p.add_argument('name', help = 'name of the field map')
+    p.add_argument('files', nargs = '*', help = 'geometry file, electrode=file solutions, or a voltage file')
+    p.add_argument('--units', type = float, default = 1.0, help = 'mm per length unit of imported files (e.g. 1000 for m)')
+    p.add_argument('--point', type = float, nargs = 3, default = [0.0, 0.0, 0.0], metavar = ('X', 'Y', 'Z'), help = 'position (mm)')
+    p.add_argument('--target', type = float, nargs = 3, default = [0.0, 0.0, 500.0], metavar = ('EX', 'EY', 'EZ'), help = 'target field (V/cm)')
+    p.add_argument('--line', type = float, nargs = 6, metavar = ('X0', 'Y0', 'Z0', 'X1', 'Y1', 'Z1'), help = 'set the field along a line (mm) instead of at the point')
+    p.add_argument('--line-points', type = int, default = 5, help = 'points along the line')
+    p.add_argument('--electrodes', nargs = '+', help = 'electrodes varied (default every electrode of the map)')
+    p.set_defaults(func = fieldmap)
+
+    p = sub.add_parser('dataserver', help = 'serve the HDF5 data files to analysis clients')
+    p.add_argument('files', nargs = '*', help = 'data files to serve (files written by scans are added when claimed)')
+    p.set_defaults(func = dataserver)
+
+    p = sub.add_parser('data', help = 'list the data served, or follow a running scan')
+    p.add_argument('file', nargs = '?', help = 'data file (default: list the files served)')
+    p.add_argument('--follow', metavar = 'SLAB', help = 'print the points of a scan as they are measured')
+    p.add_argument('--address', default = 'tcp://127.0.0.1:5681', help = 'address of the data server')
+    p.set_defaults(func = data)
+
+    p = sub.add_parser('record', help = 'run a command, recording its hardware traffic')
+    p.add_argument('log', help = 'session log written')
+    p.add_argument('args', nargs = argparse.REMAINDER, help = 'command recorded, e.g. scan spec.toml')
+    p.set_defaults(func = record)
+
+    p = sub.add_parser('replay', help = 'run a command against a recorded session instead of the hardware')
+    p.add_argument('log', help = 'session log replayed')
+    p.add_argument('--speed', default = '1', help = "replay speed relative to the recording, or 'max' for no waiting (give it before the log)")
+    p.add_argument('args', nargs = argparse.REMAINDER, help = 'command replayed (the one recorded; none to print the streams of the log)')
+    p.set_defaults(func = replay)
+    return parser
+
+def main(argv = None):
+    args = makeparser().parse_args(argv)
+    args.func(args)
+
+####################################################################################################
+####################################################################################################
+# Code starts here
+####################################################################################################
+####################################################################################################
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+
+"""
+Define streaming statistics of counter data: 64 bit counts, dead time correction, running mean and
+variance, Allan deviation and a histogram of the count rate
+
+The NI counters are 32 bit, so a raw reading wraps every 2**32 counts (about 7 minutes at 10 MHz)
+and differences of raw readings go negative across a rollover. CountExtender keeps a 64 bit total
+from successive raw readings (the difference modulo 2**32 is correct as long as fewer than 2**32
+counts arrive between reads).
+
+CounterStats takes counts in intervals (or raw readings at a fixed interval), corrects the rates for
+the dead time of the CEM and its electronics, and keeps:
+    the total counts and time (the mean rate over the run)
+    the running mean, variance, minimum and maximum of the interval rates (Welford, or combined per block)
+    the Allan deviation at octave averaging times tau0*2**k (AllanDeviation)
+    a histogram of the interval rates in logarithmic bins (RateHistogram)
+Each update costs a fixed amount of work per interval and the memory does not grow with the run, so
+the statistics can be kept for the whole of a long run and read at any time (summary(), allandeviation()).
+save() writes the state to an HDF5 group (e.g. next to a scan slab) and load() restores it, so the
+statistics of an interrupted scan continue when it is resumed.
+
+The Allan deviation assumes the intervals are of equal length (tau0: the given bin time, or the
+mean interval of the first update); it is given in Hz, for a Poisson source sqrt(rate/tau).
+"""
+
+####################################################################################################
+#Import modules
+####################################################################################################
+import bisect #Histogram bin of a single rate
+import json #Summary attribute
+import numpy as np #For maths
+
+####################################################################################################
+#Definitions
+####################################################################################################
+
+#Dead time models: non-paralysable (counts in the dead time are lost) and paralysable (they extend it)
+deadtimemodels = ('nonparalysable', 'paralysable')
+
+####################################################################################################
+#Define functions
+####################################################################################################
+
+#True rate from a measured rate for the dead time (s) of the detector
+#Rates beyond the largest the model can measure (1/deadtime, or 1/(e*deadtime) when paralysable) give nan
+def deadtimecorrect(rate, deadtime, model = 'nonparalysable'):
+    rate = np.asarray(rate, dtype = np.float64)
+    if deadtime <= 0:
+        return rate
+    x = rate*deadtime
+    if model == 'nonparalysable':
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            return np.where(x < 1, rate/(1 - x), np.nan)
+    if model == 'paralysable':
+        from scipy.special import lambertw #Measured rate m = n*exp(-n*deadtime), principal branch
+        return np.where(x <= 1/np.e, -lambertw(-np.minimum(x, 1/np.e)).real/deadtime, np.nan)
+    raise ValueError("Unknown dead time model {!r} (use one of {})".format(model, deadtimemodels))
+
+####################################################################################################
+#Define classes
+####################################################################################################
+
+####################################################################################################
+# CountExtender class: 64 bit totals from successive raw readings of a 32 bit counter
+class CountExtender:
+    def __init__(self, bits = 32):
+        self.modulus = 2**bits #The raw readings wrap at this value
+        self.last = None #Last raw reading
+        self.total = 0 #64 bit total at the last reading
+
+    # Extend a raw reading (or an array of successive readings), returning the 64 bit total(s)
+    # The first reading is taken as the total, so counts since the start of the counter are kept
+    def extend(self, raw):
+        raw = np.asarray(raw, dtype = np.int64)
+        values = raw.ravel()
+        if values.size == 0:
+            return values
+        if self.last is None:
+            self.last = int(values[0])
+            self.total = int(values[0])
+        steps = np.diff(values, prepend = self.last) % self.modulus
+        totals = self.total + np.cumsum(steps)
+        self.last = int(values[-1])
+        self.total = int(totals[-1])
+        return totals.reshape(raw.shape) if raw.ndim else int(totals[0])
+
+    # Forget the readings; the next reading starts the total again
+    def reset(self):
+        self.last = None
+        self.total = 0
+
+####################################################################################################
+# AllanDeviation class: non-overlapping Allan deviation at averaging times tau0*2**k, k < levels
+# Each level keeps the last average (for the differences) and an average waiting for its partner,
+# the pair making one average of the next level, so the memory is fixed and the work per value is
+# constant on average
+class AllanDeviation:
+    def __init__(self, tau0 = None, levels = 32):
+        self.tau0 = tau0 #Averaging time of the values added (s)
+        self.levels = levels #Number of averaging times
+        self.reset()
+
+    # Forget all values
+    def reset(self):
+        self.previous = np.full(self.levels, np.nan) #Last average at each level
+        self.pending = np.full(self.levels, np.nan) #Average waiting for its partner at each level
+        self.sumsq = np.zeros(self.levels) #Sum of squared differences of consecutive averages
+        self.count = np.zeros(self.levels, dtype = np.int64) #Number of differences
+
+    # Add values (each the mean over tau0)
+    def add(self, values):
+        values = np.asarray(values, dtype = np.float64).ravel()
+        for k in range(self.levels):
+            if values.size == 0:
+                break
+            chain = values if np.isnan(self.previous[k]) else np.concatenate(([self.previous[k]], values))
+            d = np.diff(chain)
+            self.sumsq[k] += d @ d
+            self.count[k] += d.size
+            self.previous[k] = values[-1]
+            #Pair up the averages (with the one left over last time) for the next level
+            if not np.isnan(self.pending[k]):
+                values = np.concatenate(([self.pending[k]], values))
+            if values.size % 2:
+                self.pending[k] = values[-1]
+                values = values[:-1]
+            else:
+                self.pending[k] = np.nan
+            values = 0.5*(values[0::2] + values[1::2])
+
+    # Add one value (the same as add for a single value, without the array overheads)
+    def addone(self, value):
+        for k in range(self.levels):
+            previous = self.previous[k]
+            if previous == previous: #Not nan
+                self.sumsq[k] += (value - previous)**2
+                self.count[k] += 1
+            self.previous[k] = value
+            pending = self.pending[k]
+            if pending != pending:
+                self.pending[k] = value
+                return
+            self.pending[k] = np.nan
+            value = 0.5*(pending + value)
+
+    # Averaging times (s), Allan deviations and number of differences of each at least min_count times
+    def deviation(self, min_count = 1):
+        use = self.count >= max(min_count, 1)
+        taus = (self.tau0 or 1.0)*2.0**np.arange(self.levels)
+        return taus[use], np.sqrt(self.sumsq[use]/(2*self.count[use])), self.count[use]
+
+####################################################################################################
+# RateHistogram class: histogram of rates in bins_per_decade logarithmic bins from min_rate to max_rate
+# Rates below min_rate (including zero) go in the first bin and rates above max_rate in the last
+class RateHistogram:
+    def __init__(self, min_rate = 1.0, max_rate = 1e8, bins_per_decade = 10):
+        decades = np.log10(max_rate/min_rate)
+        self.edges = np.logspace(np.log10(min_rate), np.log10(max_rate), int(round(decades*bins_per_decade)) + 1)
+        self.edgelist = self.edges.tolist() #For bisect
+        self.counts = np.zeros(self.edges.size + 1, dtype = np.int64) #Underflow, bins, overflow
+
+    # Add rates (nan rates are left out)
+    def add(self, rates):
+        rates = np.asarray(rates, dtype = np.float64).ravel()
+        rates = rates[~np.isnan(rates)]
+        self.counts += np.bincount(np.searchsorted(self.edges, rates, side = 'right'), minlength = self.counts.size)
+
+    # Add one rate
+    def addone(self, rate):
+        if rate == rate:
+            self.counts[bisect.bisect_right(self.edgelist, rate)] += 1
+
+    # Forget all rates
+    def reset(self):
+        self.counts[:] = 0
+
+    # Rate at which a fraction q of the rates are below (interpolated within a bin)
+    def quantile(self, q):
+        total = self.counts.sum()
+        if total == 0:
+            return np.nan
+        cumulative = np.cumsum(self.counts)/total
+        i = int(np.searchsorted(cumulative, q))
+        if i == 0:
+            return self.edges[0]
+        if i > self.edges.size - 1:
+            return self.edges[-1]
+        below = cumulative[i - 1]
+        fraction = (q - below)/(cumulative[i] - below) if cumulative[i] > below else 0.0
+        return self.edges[i - 1]*(self.edges[i]/self.edges[i - 1])**fraction
+
+####################################################################################################
+# CounterStats class: streaming statistics of the count rate of a counter
+# bin_time: length of each interval (s) for addraw and the Allan deviation (None: from the first update)
+# deadtime: dead time of the detector (s), with the model from deadtimemodels
+class CounterStats:
+    def __init__(self, bin_time = None, deadtime = 0.0, model = 'nonparalysable', min_rate = 1.0, max_rate = 1e8,
+                 bins_per_decade = 10, levels = 32):
+        if model not in deadtimemodels:
+            raise ValueError("Unknown dead time model {!r} (use one of {})".format(model, deadtimemodels))
+        self.bin_time = bin_time #Length of each interval (s)
+        self.deadtime = deadtime #Dead time of the detector (s)
+        self.model = model #Dead time model
+        self.extender = CountExtender() #64 bit totals of raw readings (addraw)
+        self.allan = AllanDeviation(bin_time, levels)
+        self.histogram = RateHistogram(min_rate, max_rate, bins_per_decade)
+        self.reset()
+
+    # Forget all values
+    def reset(self):
+        self.extender.reset()
+        self.allan.reset()
+        self.histogram.reset()
+        self.counts = 0 #Total counts (64 bit)
+        self.time = 0.0 #Total time of the intervals (s)
+        self.n = 0 #Number of intervals
+        self.mean = 0.0 #Running mean of the corrected interval rates (Hz)
+        self.m2 = 0.0 #Running sum of squared deviations of the rates
+        self.min = np.inf #Smallest rate
+        self.max = -np.inf #Largest rate
+        self.lost = 0 #Intervals whose rate could not be corrected (beyond the largest measurable rate)
+
+    # Add raw cumulative readings of the counter (scalar or array), one every bin_time
+    # The first reading only starts the count
+    def addraw(self, raw):
+        if self.bin_time is None:
+            raise ValueError("Raw readings need the bin_time between them")
+        previous = None if self.extender.last is None else self.extender.total
+        totals = np.atleast_1d(self.extender.extend(raw))
+        counts = np.diff(totals) if previous is None else np.diff(totals, prepend = previous)
+        if counts.size:
+            self.addcounts(counts, self.bin_time)
+
+    # Add the counts in intervals of length dt (s): scalars, or arrays with one value per interval
+    # Returns the dead time corrected rates of the intervals (Hz)
+    def addcounts(self, counts, dt):
+        if np.ndim(counts) == 0 and np.ndim(dt) == 0:
+            return self.addcount(counts, dt)
+        counts = np.atleast_1d(np.asarray(counts, dtype = np.int64))
+        dt = np.broadcast_to(np.asarray(dt, dtype = np.float64), counts.shape)
+        if counts.size == 0:
+            return np.zeros(0)
+        if self.allan.tau0 is None:
+            self.allan.tau0 = float(dt.mean())
+        self.counts += int(counts.sum())
+        self.time += float(dt.sum())
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            rates = deadtimecorrect(counts/dt, self.deadtime, self.model)
+        good = rates[np.isfinite(rates)]
+        self.lost += rates.size - good.size
+        if good.size:
+            #Combine the mean and variance of the block with the running ones (Chan et al.)
+            n = self.n + good.size
+            mean = good.mean()
+            delta = mean - self.mean
+            self.m2 += ((good - mean)**2).sum() + delta**2*self.n*good.size/n
+            self.mean += delta*good.size/n
+            self.n = n
+            self.min = min(self.min, good.min())
+            self.max = max(self.max, good.max())
+            self.allan.add(good)
+            self.histogram.add(good)
+        return rates
+
+    # Add the counts in one interval of length dt (s), returning its corrected rate (Hz)
+    def addcount(self, count, dt):
+        count, dt = int(count), float(dt)
+        if self.allan.tau0 is None:
+            self.allan.tau0 = dt
+        self.counts += count
+        self.time += dt
+        rate = count/dt if dt > 0 else np.nan
+        if self.deadtime > 0:
+            rate = float(deadtimecorrect(rate, self.deadtime, self.model))
+        if not np.isfinite(rate):
+            self.lost += 1
+            return rate
+        #Welford update
+        self.n += 1
+        delta = rate - self.mean
+        self.mean += delta/self.n
+        self.m2 += delta*(rate - self.mean)
+        self.min = min(self.min, rate)
+        self.max = max(self.max, rate)
+        self.allan.addone(rate)
+        self.histogram.addone(rate)
+        return rate
+
+    # Mean rate over all the intervals, corrected for the dead time (Hz)
+    @property
+    def rate(self):
+        if self.time <= 0:
+            return np.nan
+        return float(deadtimecorrect(self.counts/self.time, self.deadtime, self.model))
+
+    # Variance and standard deviation of the interval rates
+    @property
+    def variance(self):
+        return self.m2/(self.n - 1) if self.n > 1 else 0.0
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    # Averaging times (s) and Allan deviations of the rate (Hz)
+    def allandeviation(self, min_count = 1):
+        taus, adev, count = self.allan.deviation(min_count)
+        return taus, adev
+
+    # Dictionary of the statistics
+    def summary(self):
+        return {'counts': self.counts, 'time': self.time, 'rate': self.rate, 'intervals': self.n, 'mean': self.mean,
+                'std': self.std, 'min': self.min if self.n else np.nan, 'max': self.max if self.n else np.nan,
+                'median': self.histogram.quantile(0.5), 'lost': self.lost, 'deadtime': self.deadtime, 'model': self.model}
+
+    # One line summary of the rate
+    def report(self):
+        taus, adev = self.allandeviation(min_count = 2)
+        allan = ', Allan dev. {:.1f} Hz at {:.3g} s'.format(adev[-1], taus[-1]) if taus.size else ''
+        return 'Rate {:.1f} Hz, interval rates {:.1f} +/- {:.1f} Hz (min {:.1f}, max {:.1f}){}'.format(
+            self.rate, self.mean, self.std, self.min, self.max, allan)
+
+    # Write the state to the group name of an HDF5 file or group (replacing what is there)
+    # The summary and the Allan deviation are attributes, the histogram a dataset with its edges
+    def save(self, h5obj, name):
+        group = h5obj.require_group(name)
+        state = {'counts': self.counts, 'time': self.time, 'n': self.n, 'mean': self.mean, 'm2': self.m2,
+                 'min': self.min, 'max': self.max, 'lost': self.lost, 'tau0': self.allan.tau0,
+                 'bin_time': self.bin_time, 'deadtime': self.deadtime, 'model': self.model}
+        group.attrs['state'] = json.dumps(state)
+        group.attrs['summary'] = json.dumps(self.summary())
+        for key, value in (('allan_previous', self.allan.previous), ('allan_pending', self.allan.pending),
+                           ('allan_sumsq', self.allan.sumsq), ('allan_count', self.allan.count)):
+            group.attrs[key] = value
+        taus, adev = self.allandeviation()
+        group.attrs['allan_tau'] = taus
+        group.attrs['allan_deviation'] = adev
+        if 'histogram' in group and group['histogram'].shape != self.histogram.counts.shape:
+            del group['histogram']
+        hist = group.require_dataset('histogram', self.histogram.counts.shape, 'int64')
+        hist[...] = self.histogram.counts
+        hist.attrs['edges'] = self.histogram.edges
+        hist.attrs['data_layout'] = '(below edges[0], edges[i] to edges[i+1], above edges[-1]) in Hz'
+
+    # Restore the state written by save (the extender is not saved: the counter restarts with the run)
+    def load(self, group):
+        state = json.loads(group.attrs['state'])
+        for key in ('counts', 'time', 'n', 'mean', 'm2', 'min', 'max', 'lost'):
+            setattr(self, key, state[key])
+        self.allan.tau0 = state['tau0']
+        self.allan.previous[:] = group.attrs['allan_previous']
+        self.allan.pending[:] = group.attrs['allan_pending']
+        self.allan.sumsq[:] = group.attrs['allan_sumsq']
+        self.allan.count[:] = group.attrs['allan_count']
+        self.histogram.edges = group['histogram'].attrs['edges']
+        self.histogram.edgelist = self.histogram.edges.tolist()
+        self.histogram.counts = group['histogram'][...]
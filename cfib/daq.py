@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+
+'''
+daq.py: Classes for the NI DAQ (analogue output, analogue input and counters) and analogue ramps.
+A. J. McCulloch, November 2018
+
+####################################################################################################
+
+Largely built from previous code; however a useful resource is given below:
+Parts taken from https://github.com/MarcoForte/PyDAQmx_Helper/blob/master/pydaqmx_helper/counter.py
+'''
+
+####################################################################################################
+# Import modules
+####################################################################################################
+
+from PyDAQmx import * #PyDAQmx module for working with the NI DAQ
+import ctypes #Module required for creating C type ojects - required for some PyDAQmx operations
+import time #Time access and conversions
+import numpy as np #For maths
+from cfib.functions import * #Function definitions
+from cfib.counterstats import CountExtender, CounterStats #64 bit counts and rate statistics
+
+####################################################################################################
+# Define classes
+####################################################################################################
+
+####################################################################################################
+# AOsimple class for simple analogue output
+class AOsimple:
+    # Initialise the analogue out task
+    def __init__(self, ao_physchan = NI_hardware_addresses['AO01'], V_default = 0):
+        self.task = Task() #Define the task as Task()
+        self.ao_physchan = ao_physchan #Define the analogue output physical channel
+        self.voltage = V_default #Set the default voltage
+        self.task.CreateAOVoltageChan(ao_physchan,"",-10.0,10.0,DAQmx_Val_Volts,None) #Set the analogu output task
+
+    # Set the AO voltage
+    def setvoltage(self, value, confirm = False):
+        #Write the voltage
+        self.task.WriteAnalogF64(1,1,10.0,DAQmx_Val_GroupByChannel,np.array(float(value)),None,None)
+        #Update the voltage attribute
+        self.voltage = value
+        #Print a confimation if required
+        if confirm == True:
+            #Figure out which AO channel is being addressed
+            chan = registry.channelname(self.ao_physchan)
+            print("Channel {} was set to {} V".format(chan, value))
+
+    # Clear the task
+    def clear(self, zero = True, quiet = False):
+        #Zero the channel
+        if zero == True:
+            self.setvoltage(0, True)
+        #Clear the task
+        self.task.ClearTask()
+        if quiet == False:
+            print("Analogue output task cleared")
+
+####################################################################################################
+# AIsimple class for simple analogue input reading
+# ai_physchan may be a comma separated list of channels, in which case readvoltage returns one mean per channel
+class AIsimple:
+    def __init__(self, samples = 10, sample_rate = 10000, ai_physchan = NI_hardware_addresses['AI01'], read_most_recent = False):
+        self.task = Task() #Define the task as Task()
+        self.samples = samples #Number of samples per channel
+        self.sample_rate = sample_rate #Sampling rate of the analogue input
+        self.ai_physchan = ai_physchan #Physical address of the analogue input channel(s)
+        self.nchan = len(ai_physchan.split(',')) #Number of channels in the task
+        self.read = ctypes.c_int32() #Make a ctype to store the measurement
+        self.data = np.zeros(self.samples*self.nchan, dtype=np.float64) #Make a data array
+        self.task.CreateAIVoltageChan(self.ai_physchan, '', DAQmx_Val_Cfg_Default, -10.0, 10.0, DAQmx_Val_Volts, None) #Create the AI task
+        self.buffer_size = 10000 #NOTE: Infrequent measurement/insufficient buffer size will cause overflow!
+        self.task.CfgSampClkTiming('', self.sample_rate, DAQmx_Val_Rising, DAQmx_Val_ContSamps, self.buffer_size) #Set the sampling of the task
+        #This is legacy code (R. Speirs, 2018), not certain of functionality
+        if read_most_recent:
+            self.task.SetReadRelativeTo(DAQmx_Val_MostRecentSamp)#be careful with this. Depends what you want to do.
+            #self.task.SetReadOffset(-self.samples)
+
+    # Measure the analogue input. Task is started and stopped to avoid buffer overflow
+    def readvoltage(self, returnmean = True):
+        #Start the task
+        self.task.StartTask()
+        #Perform the measurement
+        self.task.ReadAnalogF64(self.samples, 10.0, DAQmx_Val_GroupByScanNumber, self.data, self.data.size, ctypes.byref(self.read), None)
+        #Return the mean of the measured values
+        if returnmean == True:
+            if self.nchan == 1:
+                toreturn = self.data.mean()
+            else:
+                toreturn = self.data.reshape(self.samples, self.nchan).mean(axis = 0)
+        #Retrun an array of measured values (samples x channels for more than one channel)
+        elif returnmean == False:
+            toreturn = self.data if self.nchan == 1 else self.data.reshape(self.samples, self.nchan)
+        #Stop the task
+        self.task.StopTask()
+        return toreturn
+
+    #Clear the task
+    def close(self, quiet = False):
+        self.task.ClearTask()
+        if quiet == False:
+            print("Analogue input task cleared")
+
+####################################################################################################
+# Counter class for defining counter objects
+# With a gate_terminal, edges are only counted while the gate (a PFI line) is active, starting at the first gate;
+# with a gate_counter as well, the number of gates is counted on that counter (see gatecounter)
+# The 32 bit readings are extended to 64 bits, so counts and differences are correct across rollovers.
+# The rates of getfreq and readrate are corrected for the detector deadtime (s), and their statistics
+# (mean, standard deviation, Allan deviation, histogram) are kept in stats (cfib.counterstats)
+class Counter:
+    #Initialise the counting task
+    def __init__(self, ctr_physchan = NI_hardware_addresses['Counter 1'], gate_terminal = None, gate_active = 'high', gate_counter = None,
+                 deadtime = 0.0):
+        self.ctr_physchan = ctr_physchan #Define the physical channel for the coutner
+        self.task = Task() #Define the task as Task()
+        self.task.CreateCICountEdgesChan(ctr_physchan, '', DAQmx_Val_Rising, 0, DAQmx_Val_CountUp) #Set the counting task
+        self.cnt = (ctypes.c_ulong*4)() #Initialise the count - must be unsigned long!
+        ctypes.cast(self.cnt, ctypes.POINTER(ctypes.c_ulong))  #Use ctypes cast to constuct a pointer
+        self.extender = CountExtender() #Extends the 32 bit readings to 64 bits
+        self.stats = CounterStats(deadtime = deadtime) #Statistics of the rates measured
+        self.count = 0 #The most recent count measurement (64 bit, since start)
+        self.freq = 0 #The most recent frequency measurement
+        self.time = time.time() #Time of the last measurement
+        self.gate_terminal = gate_terminal #PFI line gating the counter (None for continuous counting)
+        self.gatetask = None #Task counting the gates
+        self.gates = 0 #Number of gates since start at the last read
+        if gate_terminal is not None:
+            gatecounter(self.task, gate_terminal, gate_active)
+            if gate_counter is not None:
+                self.gatetask = gatecountertask(gate_counter, gate_terminal, gate_active)
+                self.gatecnt = (ctypes.c_ulong*1)()
+
+    # Start the counter
+    def start(self):
+        #count_data = (ctypes.c_ulong*1)()
+        #ctypes.cast(count_data, ctypes.POINTER(ctypes.c_ulong))
+        #Start counting gates first, so the first gate of the counter is not missed
+        if self.gatetask is not None:
+            self.gatetask.StartTask()
+        self.task.StartTask()
+        if self.gate_terminal is not None:
+            print("DAQ is armed and will count in the gates on {}...".format(self.gate_terminal))
+        else:
+            print("DAQ is armed and counting...")
+
+    # Read the counter and return the counts since start, extended to 64 bits
+    def readraw(self):
+        self.task.ReadCounterScalarU32(10.0, self.cnt, None)
+        return self.extender.extend(self.cnt[0])
+
+    # Read the counter (counts since start) and the time of the read, updating the attributes
+    def readcount(self):
+        self.count = self.readraw() # Read the counter and update the count attribute
+        self.time = time.time() # Update the time attribute
+        if self.gatetask is not None:
+            self.readgates()
+        return self.count, self.time
+
+    # Read the number of gates since start (None if the gates are not counted)
+    def readgates(self):
+        if self.gatetask is None:
+            return None
+        self.gatetask.ReadCounterScalarU32(10.0, self.gatecnt, None)
+        self.gates = self.gatecnt[0]
+        return self.gates
+
+    # Return a count without stopping the counter
+    def getCount(self, totalcount = False, sample_rate = 0, samples = 1):
+        #Initialise list
+        meas = []
+        #Perform measurement to initialise the attributes
+        value = self.readraw()
+        #Update the count attribute
+        self.count = value
+        #Update the time attribute
+        self.time = time.time()
+        #Include a pause to allow for sampling at a particular rate
+        if sample_rate > 0:
+            time.sleep(1/sample_rate)
+        #Loop over the number of samples
+        for i in range(samples):
+            #Read the counter
+            count = self.readraw()
+            #Update the time attribute
+            self.time = time.time()
+            #Return either the total count (from start) or since last measurement
+            #Option 1: The counts since start
+            if totalcount == True:
+                value = count
+            #Option 2: The coutns since last count measurement (default)
+            elif totalcount == False:
+                #Difference between the measured count (since start) and previous measurment (since start)
+                value = count - self.count
+
+            #Update the count attribute
+            self.count = count
+            #Append the measured value
+            meas.append(int(value))
+
+            #Include a pause to allow for sampling at a particular rate
+            if sample_rate > 0:
+                time.sleep(1/sample_rate)
+        if samples == 1:
+            meas = meas[0]
+        return meas
+
+    # Return a frequency without stopping the counter
+    def getfreq(self, sample_rate = 0, samples = 1):
+        # Measurement initialisation
+        meas = [] # Initialise list
+        self.count = self.readraw() # Perform measurement to initialise the attributes
+        # Update the time attribute
+        if samples > 1:
+            self.time = time.time()
+        # Include a pause to allow for sampling at a particular rate
+        if sample_rate > 0:
+            time.sleep(1/sample_rate)
+
+        # Loop over the number of samples
+        for i in range(samples):
+            # Initialisation
+            t_old = self.time # Time since last measurement
+
+            # Measurement
+            count = self.readraw() # Read the counter
+            self.time = time.time() # Update the time attribute
+            numcounts = count - self.count # Difference between the measured count (since start) and previous measurment (since start)
+            value = self.stats.addcount(numcounts, self.time - t_old)  # Calculate the (dead time corrected) count rate
+            self.freq = value # Update the frequency attribute
+            self.count = count # Update the count attribute
+            meas.append(value) # Append the measured value
+
+            # Include a pause to allow for sampling at a particular rate
+            if sample_rate > 0:
+                time.sleep(1/sample_rate)
+
+        if samples == 1:
+            meas = meas[0]
+        return meas
+
+    # Return the count rate since the previous read without pausing (for use in an acquisition thread)
+    def readrate(self):
+        t_old = self.time # Time of the previous measurement
+        count = self.readraw() # Read the counter
+        self.time = time.time() # Update the time attribute
+        if self.time > t_old:
+            self.freq = self.stats.addcount(count - self.count, self.time - t_old) # Calculate the (dead time corrected) count rate
+        self.count = count # Update the count attribute
+        return self.freq
+
+    # Stop the counter and return the count
+    def stop(self, totalcount = False):
+        #Get the counter value
+        value = self.getCount(totalcount)
+        #Stop the task
+        self.task.StopTask()
+        if self.gatetask is not None:
+            self.gatetask.StopTask()
+        print("DAQ is armed but no longer counting")
+        return value
+
+    # Stop the counter and clear the task
+    def close(self):
+        for task in (self.task, self.gatetask):
+            if task is not None:
+                task.StopTask()
+                task.ClearTask()
+        print("DAQ is no longer armed and tasks have been cleared")
+
+####################################################################################################
+# Define functions
+####################################################################################################
+
+####################################################################################################
+# Functions for gated counting
+
+# Gate a counter task on a PFI line with a pause trigger: edges are only counted while the gate is active ('high' or 'low').
+# With arm = True counting also starts on the opening edge of a gate, so the first window starts at a fixed phase
+def gatecounter(task, terminal, active = 'high', arm = True):
+    if active not in ('high', 'low'):
+        raise ValueError("Gate active level {} must be either high or low".format(active))
+    task.SetPauseTrigType(DAQmx_Val_DigLvl)
+    task.SetDigLvlPauseTrigSrc(terminal)
+    task.SetDigLvlPauseTrigWhen(DAQmx_Val_Low if active == 'high' else DAQmx_Val_High) # Paused when the gate is inactive
+    if arm == True:
+        task.SetArmStartTrigType(DAQmx_Val_DigEdge)
+        task.SetDigEdgeArmStartTrigSrc(terminal)
+        task.SetDigEdgeArmStartTrigEdge(DAQmx_Val_Rising if active == 'high' else DAQmx_Val_Falling)
+
+# Make a task counting the gates (their opening edges) on a PFI line with a second counter
+def gatecountertask(ctr_physchan, terminal, active = 'high'):
+    task = Task()
+    task.CreateCICountEdgesChan(ctr_physchan, '', DAQmx_Val_Rising if active == 'high' else DAQmx_Val_Falling, 0, DAQmx_Val_CountUp)
+    task.SetCICountEdgesTerm(ctr_physchan, terminal)
+    return task
+
+####################################################################################################
+# Functions for performing ramps
+
+# Generate a linear array of length points between minval and maxval
+def makeramp(minval, maxval, points):
+    ramp = np.linspace(minval, maxval, points)
+    return ramp
+
+# Execute an AO ramp on a channel, ranging between [minval, maxval] in points steps. Dwell and slew are ramp parameters and showplot is for visualisation
+def executeAOramp(channel, minval, maxval, points, dwell, slew = 0, slewpoints = 5, showplot = True, wavereport = False, verbose = False):
+    if verbose == True: #Start the timer
+        t_start = time.time()
+    # Generate the AO task
+    rampAO = AOsimple(channel) # Make the task
+    # Generate the required voltage ramp to feed to the AO
+    vramp = makeramp(minval, maxval, points)
+    vramp = np.insert(vramp, 0, 0) # Insert a zero start value
+    vramp = np.append(vramp, 0) # Append a zero end value
+
+    # Ramp parameters
+    dwelltime = dwell # Dwell time during wavelength scan
+    slewtime = slew # Time for slewing between setpoints
+    steptime = dwelltime + slewtime # Total time for a step (dwell and slew)
+
+    if showplot == True:
+        import matplotlib.pyplot as plt # Only needed for the plot
+        # Generate ramp plot
+        longramp = vramp # Make a copy of the ramp to augment with a slew
+        fullramp = [] # Initialise the array to store the time/voltage array
+        # Loop over the voltage set points to add a slew to the next ramp setpoint at the end
+        for i in range(len(longramp)-1):
+            vslew = list(zip(steptime * i + makeramp(0, slewtime, slewpoints),makeramp(longramp[i],longramp[i+1], slewpoints)))
+            fullramp.extend(vslew)
+
+        v, t = zip(*fullramp) # Make lists for plotting
+        # Make the plot
+        plt.step(v, t, where = 'post')
+        plt.xlabel('Time [s]')
+        plt.ylabel('Voltage [V]')
+        plt.show()
+
+    # Optionally record the wavelength as scan is performed
+    if wavereport == True: # Initialise wavemeter polling
+        from cfib.wavemeter import wavemeter
+        lambda_meas = wavemeter('192.168.68.43') # Define a wavemeter object (requires IP address of wavemeter machine)
+        lambda_meas.initialise() # Initialise the polling of the wavemeter
+        toreturn = [] # Initialise list to return
+    elif wavereport == False:
+        toreturn = None # Define toreturn to allow a general return statement
+
+    # Ramp the laser wavelength
+    # Set ramp voltage and wait for a dwell time before changing
+    # Case 1: no slew. Simple ramp and pause
+    if slew == 0:
+        for voltage in vramp:
+            rampAO.setvoltage(voltage) # Set the AO voltage
+            t0 = time.time() # Record the time with voltage a vramp[i]
+            # If the wavelength is being recorded, split the pause to make the measurement
+            if wavereport == True: # Measure the wavelength halfway through the dwell
+                time.sleep(dwelltime/2) # Don't do anything for a time = dwelltime/2
+                lambda_meas.getwavelength() # Return the most recent measurement of the wavemeter
+                toreturn.append((voltage, lambda_meas.wavelength)) # Append toreturn with a tuple of voltage and measured wavelength
+                tr = dwelltime - (time.time() - t0) # remaining time for a complete dwell
+                if tr > 0: # Only pause if it is required to reach a full dwelltime
+                    time.sleep(tr) # Don't do anything for a time = tr
+            elif wavereport == False:
+                time.sleep(dwelltime) # Don't do anything for a time = dwelltime
+    # Case 2: non-zero slew. Generate ramp between set points, ramp the (slew) voltage and then pause
+    elif slew > 0:
+        for i in range(len(vramp)-1):
+            toset = makeramp(vramp[i],vramp[i+1], slewpoints) # Create ramp between set points
+            # Ramp the voltage over the slew
+            for voltage in toset:
+                rampAO.setvoltage(voltage) # Set the AO voltage
+                time.sleep(slewtime/(slewpoints-1)) # Don't do anything for a time = slewtime/(slewpoints-1)
+            t0 = time.time() # Record the time with voltage a vramp[i]
+            # If the wavelength is being recorded, split the pause to make the measurement
+            if wavereport == True: # Measure the wavelength halfway through the dwell
+                time.sleep(dwelltime/2) # Don't do anything for a time = dwelltime/2
+                lambda_meas.getwavelength() # Return the most recent measurement of the wavemeter
+                if i < len(vramp)-2: # Don't record the last wavelength when the voltage is ramped back to zero
+                    toreturn.append((voltage, lambda_meas.wavelength)) # Append toreturn with a tuple of voltage and measured wavelength
+                tr = dwelltime - time.time() + t0 # remaining time for a complete dwell
+                if tr > 0: # Only pause if it is required to reach a full dwelltime
+                    time.sleep(tr) # Don't do anything for a time = tr
+            elif wavereport == False:
+                time.sleep(dwelltime) # Don't do anything for a time = dwelltime
+    if verbose == True:
+        print("Ramp completed, reseting voltage and clearing task")
+    rampAO.setvoltage(0) # Zero the AO voltage (otherwise laser will have an offset)
+    # If verbose is true, make rampAO.clear print
+    if verbose == True:
+        q = False
+    elif verbose == False:
+        q = True
+    rampAO.clear(zero = False, quiet = q) #Clear the AO task (and zero the AO)
+    # If verbose is true, print the function runtime
+    if verbose == True:
+        t_expected = (dwell + slew) * points + slew # All points have a dwell, points-1 have slews but there are two additional slews
+        t_total = time.time()-t_start
+        print("The expected run time was {0:.2f} seconds and the actual run time was {1:.2f} seconds".format(t_expected,t_total))
+    return toreturn
@@ -0,0 +1,492 @@
+#!/usr/bin/env python
+
+"""
+dataserver.py: A local service which owns the HDF5 data files and serves them to analysis clients
+
+Only the data server (and a scan writing a file) opens the data files, so clients never contend
+for the HDF5 file lock, never see a file half written, and need no copy of Stark_data.hdf. Clients
+send requests over ZMQ and receive NumPy arrays in a compact binary framing:
+
+    request:  [command, JSON arguments]
+    reply:    [b'ok' or b'error', JSON header, raw array data...]
+
+where the header lists the dtype and shape of each array frame (sent without copying). Commands:
+
+    files                             the files served, and whether a scan is writing them
+    list     file                     datasets (slabs) of a file: shape, dtype, data layout, scan status
+    attrs    file, dataset            attributes of a dataset (JSON, arrays as lists)
+    read     file, dataset, slices    a hyperslab, [[start, stop, step], ...] per axis (null for the
+                                      whole axis); replies are limited to max_reply_bytes, and
+                                      DataClient.read splits larger reads into chunks along the first axis
+    tail     file, slab, since        the points of a scan measured at or after flat index 'since'
+                                      (from <slab>_done): their indices, data rows and the next cursor
+
+A scan claims its file before opening it for writing: the server closes its own handle and forwards
+requests for the file to a WriterService thread in the scan, which serves them from the scan's open
+file (reads are limited in size, so the writer waits for at most one chunk). When the scan closes
+the file it releases it, and the server opens it (read only) again on the next request. Requests
+made while the file changes hands get a 'retry' error, which DataClient retries.
+
+Run the server with:        cfib dataserver [files]
+List or follow with:        cfib data [file] [--follow slab]
+
+    client = DataClient('tcp://labpc:5681')
+    client.slabs('Stark_data.hdf')
+    data = client.read('Stark_data.hdf', 'data_slab_20191014:10:00:00')
+"""
+
+####################################################################################################
+#Import modules
+####################################################################################################
+import os #Operating system interfacing
+import sys #System-specific parameters
+import json #Headers and arguments
+import time #Time access and conversions
+import threading #Writer service thread
+import numpy as np #For maths
+import zmq #Used for ZeroMQ distributed messaging
+
+####################################################################################################
+#Definitions
+####################################################################################################
+
+#Address of the data server. Clients connect to it, the server binds to it
+#(the wavemeter is on 5678, the scan plotter on 5679 and the monitor on 5680)
+dataport = '5681'
+dataaddress = 'tcp://127.0.0.1:' + dataport
+
+#Largest reply (bytes of array data); bigger reads are made in chunks
+max_reply_bytes = 8*2**20
+
+#Time to wait for a reply (s)
+requesttimeout = 5.0
+
+####################################################################################################
+#Define functions
+####################################################################################################
+
+#Make a reply: [b'ok', header with the dtype and shape of each array, array data...]
+def packreply(header, *arrays):
+    arrays = [np.ascontiguousarray(a) for a in arrays]
+    header = dict(header, arrays = [[a.dtype.str, list(a.shape)] for a in arrays])
+    return [b'ok', json.dumps(header).encode()] + [memoryview(a).cast('B') if a.size else b'' for a in arrays]
+
+#Make an error reply (retry: the request will succeed if made again shortly)
+def packerror(message, retry = False):
+    return [b'error', json.dumps({'error': message, 'retry': retry}).encode()]
+
+#Unpack a reply into (header, [arrays]); errors raise a RuntimeError (a RetryError if they are temporary)
+def unpackreply(frames):
+    header = json.loads(bytes(frames[1]))
+    if frames[0] != b'ok':
+        raise (RetryError if header.get('retry') else RuntimeError)(header['error'])
+    arrays = [np.frombuffer(frame, dtype = np.dtype(dtype)).reshape(shape) for (dtype, shape), frame in zip(header['arrays'], frames[2:])]
+    return header, arrays
+
+#Convert an HDF5 attribute value to something JSON can hold
+def jsonable(value):
+    if isinstance(value, bytes):
+        return value.decode(errors = 'replace')
+    if isinstance(value, np.ndarray):
+        return [jsonable(x) for x in value.tolist()] if value.dtype.kind in 'OSU' else value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+#Status of a checkpointed scan slab (None for other datasets)
+def scanstatus(dataset):
+    if 'checkpoint' not in dataset.attrs:
+        return None
+    return json.loads(dataset.attrs['checkpoint']).get('status')
+
+#Send a request on a REQ socket and wait for the reply; None if none arrives within the timeout
+def request(socket, command, args, timeout = requesttimeout):
+    socket.send_multipart([command.encode(), json.dumps(args).encode()])
+    if not socket.poll(1000*timeout):
+        return None
+    return socket.recv_multipart(copy = False)
+
+####################################################################################################
+#Define classes
+####################################################################################################
+
+#Error of a request which will succeed if made again shortly (a file changing hands)
+class RetryError(RuntimeError):
+    pass
+
+####################################################################################################
+# FileReader class: answers list, attrs, read and tail requests from an open HDF5 file
+class FileReader:
+    def __init__(self, h5file):
+        self.file = h5file
+
+    # Handle a request; returns the reply frames
+    def handle(self, command, args):
+        try:
+            if command == 'list':
+                return packreply({'datasets': self.datasets()})
+            if command == 'attrs':
+                return packreply({'attrs': {k: jsonable(v) for k, v in self.file[args['dataset']].attrs.items()}})
+            if command == 'read':
+                return self.read(args['dataset'], args.get('slices'))
+            if command == 'tail':
+                return self.tail(args['slab'], int(args.get('since', 0)), int(args.get('max_points', 10000)))
+            return packerror('Unknown command {}'.format(command))
+        except (KeyError, ValueError, TypeError, OSError) as e:
+            return packerror('{}: {}'.format(type(e).__name__, e))
+
+    # Shape, dtype, layout and scan status of every dataset (including those in groups)
+    def datasets(self):
+        found = {}
+        def visit(name, obj):
+            if hasattr(obj, 'shape'):
+                found[name] = {'shape': list(obj.shape), 'dtype': obj.dtype.str, 'layout': jsonable(obj.attrs.get('data_layout')),
+                               'status': scanstatus(obj)}
+        self.file.visititems(visit)
+        return found
+
+    # A hyperslab of a dataset
+    def read(self, name, slices):
+        dataset = self.file[name]
+        slices = slices or []
+        selection = tuple(slice(*s) if s is not None else slice(None) for s in slices)
+        shape = [len(range(*sl.indices(n))) for sl, n in zip(selection + (slice(None),)*(dataset.ndim - len(selection)), dataset.shape)]
+        nbytes = int(np.prod(shape))*dataset.dtype.itemsize
+        if nbytes > max_reply_bytes:
+            raise ValueError("{} bytes requested; read at most {} at a time".format(nbytes, max_reply_bytes))
+        return packreply({}, dataset[selection] if selection else dataset[...])
+
+    # The points of a scan measured at or after flat index since (at most max_points, and no more than fit in
+    # a reply); only the part of the slab holding them is read, as the scan is measuring meanwhile
+    def tail(self, slab, since, max_points):
+        done = self.file[slab + '_done'][...]
+        data = self.file[slab]
+        ncols = done.shape[1] #Points per row of the slab
+        pointsize = int(np.prod(data.shape[2:])) #Values per point
+        max_points = min(max_points, max(max_reply_bytes//max(pointsize*data.dtype.itemsize, 1), 1))
+        indices = np.flatnonzero(done.ravel()[since:])[:max_points] + since
+        if indices.size:
+            #Keep the points in the rows a reply can hold (at least the first row)
+            first = int(indices[0])//ncols
+            indices = indices[indices//ncols < first + max(max_points//ncols, 1)]
+            last = int(indices[-1])//ncols
+            if first == last:
+                #One row: read the columns from the first point to the last
+                start = int(indices[0]) % ncols
+                block = data[first, start:int(indices[-1]) % ncols + 1]
+            else:
+                #Several rows: read them whole
+                start = 0
+                block = data[first:last + 1]
+            rows = block.reshape(-1, pointsize)[indices - first*ncols - start]
+        else:
+            rows = np.zeros((0, pointsize), dtype = data.dtype)
+        cursor = int(indices[-1]) + 1 if indices.size else since
+        return packreply({'cursor': cursor, 'total': int(done.size), 'status': scanstatus(data)}, indices.astype(np.int64), rows)
+
+####################################################################################################
+# WriterService class: serves the file a scan is writing, from the scan process, on a local port
+class WriterService(threading.Thread):
+    def __init__(self):
+        threading.Thread.__init__(self, daemon = True)
+        self.ctx = zmq.Context.instance()
+        self.rep = self.ctx.socket(zmq.REP)
+        port = self.rep.bind_to_random_port('tcp://127.0.0.1')
+        self.address = 'tcp://127.0.0.1:{}'.format(port) #Address the data server forwards requests to
+        self.reader = None #FileReader of the open file (set by serve)
+        self.lock = threading.Lock() #Held while a request is answered, so the file is not detached mid-read
+        self.stopflag = threading.Event()
+
+    # Start serving an open HDF5 file
+    def serve(self, h5file):
+        self.reader = FileReader(h5file)
+        self.start()
+
+    # Answer requests until stopped (polling, so stop() returns promptly)
+    def run(self):
+        while not self.stopflag.is_set():
+            if not self.rep.poll(100):
+                continue
+            command, args = self.rep.recv_multipart()
+            with self.lock:
+                if self.reader is None:
+                    reply = packerror('The file is being closed by the scan', retry = True)
+                else:
+                    reply = self.reader.handle(command.decode(), json.loads(args))
+            self.rep.send_multipart(reply, copy = False)
+
+    # Stop reading the file (before it is closed); requests are answered with a retry error until stop()
+    def detach(self):
+        with self.lock:
+            self.reader = None
+
+    # Stop answering (after the file has been released) and close the socket
+    def stop(self):
+        self.stopflag.set()
+        if self.is_alive():
+            self.join(1.0)
+        self.rep.close(linger = 0)
+
+####################################################################################################
+# DataServer class: owns the data files and answers client requests
+class DataServer:
+    def __init__(self, files = [], address = 'tcp://*:' + dataport):
+        self.files = {} #Name (file name without the directory) -> path
+        self.open = {} #Name -> FileReader of the file opened read only
+        self.writers = {} #Name -> (address of the writer service, REQ socket)
+        self.address = address #Address the server is bound to
+        self.ctx = zmq.Context.instance()
+        self.rep = self.ctx.socket(zmq.REP)
+        self.rep.bind(address)
+        for filename in files:
+            self.add(filename)
+
+    # Serve a file
+    def add(self, filename):
+        name = os.path.basename(filename)
+        path = os.path.abspath(filename)
+        if self.files.get(name, path) != path:
+            raise ValueError("{} and {} have the same name".format(path, self.files[name]))
+        self.files[name] = path
+        return name
+
+    # Name of a file given by a client (its name or path)
+    def lookup(self, filename):
+        name = os.path.basename(filename)
+        if name not in self.files:
+            raise KeyError("{} is not served".format(filename))
+        return name
+
+    # Reader of a file that no scan is writing (opened on first use)
+    def reader(self, name):
+        if name not in self.open:
+            import h5py
+            self.open[name] = FileReader(h5py.File(self.files[name], 'r'))
+        return self.open[name]
+
+    # Close the server's handle of a file
+    def closefile(self, name):
+        reader = self.open.pop(name, None)
+        if reader is not None:
+            reader.file.close()
+
+    # A scan is about to write a file: close it here, and forward its requests to the scan
+    def claim(self, filename, address):
+        name = self.add(filename)
+        self.closefile(name)
+        self.release(name)
+        socket = self.ctx.socket(zmq.REQ)
+        socket.connect(address)
+        self.writers[name] = (address, socket)
+        print('{} is being written by a scan (served from {})'.format(name, address))
+        return packreply({})
+
+    # A scan has closed a file
+    def release(self, filename):
+        name = os.path.basename(filename)
+        writer = self.writers.pop(name, None)
+        if writer is not None:
+            writer[1].close(linger = 0)
+            print('{} released by the scan'.format(name))
+        return packreply({})
+
+    # Forward a request to the scan writing a file; a scan which does not answer is taken to have ended
+    def forward(self, name, command, args):
+        address, socket = self.writers[name]
+        reply = request(socket, command, args, requesttimeout/2)
+        if reply is None:
+            print('The scan writing {} is not answering; serving the file from disk'.format(name))
+            self.release(name)
+            return self.reader(name).handle(command, args)
+        return reply
+
+    # Answer one request (its command and JSON arguments as received); a malformed request gets an error reply
+    def handle(self, command, args):
+        try:
+            command, args = command.decode(), json.loads(args)
+            if command == 'files':
+                return packreply({'files': {name: {'path': path, 'writing': name in self.writers} for name, path in self.files.items()}})
+            if command == 'claim':
+                return self.claim(args['file'], args['address'])
+            if command == 'release':
+                return self.release(args['file'])
+            name = self.lookup(args['file'])
+            if name in self.writers:
+                return self.forward(name, command, args)
+            return self.reader(name).handle(command, args)
+        except (KeyError, ValueError, TypeError, zmq.ZMQError) as e: #ZMQError: a claim with a bad address
+            return packerror('{}: {}'.format(type(e).__name__, e))
+        except OSError as e: #Usually the file is still open in a writer which has not released it yet
+            return packerror('{}: {}'.format(type(e).__name__, e), retry = True)
+
+    # Answer requests until interrupted
+    def run(self):
+        print('Data server is serving {} on {}'.format(', '.join(self.files) or 'no files yet', self.address))
+        print('Press Ctrl-C to end. (Or Command + . on OSX)')
+        try:
+            while True:
+                frames = self.rep.recv_multipart()
+                if len(frames) != 2:
+                    reply = packerror('A request is [command, JSON arguments], not {} frames'.format(len(frames)))
+                else:
+                    reply = self.handle(*frames)
+                self.rep.send_multipart(reply, copy = False)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    # Close the files and sockets
+    def close(self):
+        for name in list(self.open):
+            self.closefile(name)
+        for name in list(self.writers):
+            self.release(name)
+        self.rep.close(linger = 0)
+
+####################################################################################################
+# DataClient class: requests to the data server
+class DataClient:
+    def __init__(self, address = dataaddress, timeout = requesttimeout):
+        self.address = address
+        self.timeout = timeout #Time to wait for a reply (s)
+        self.ctx = zmq.Context.instance()
+        self.connect()
+
+    # (Re)connect the socket; a REQ socket cannot be used again after a request goes unanswered
+    def connect(self):
+        self.req = self.ctx.socket(zmq.REQ)
+        self.req.connect(self.address)
+
+    # Send a request and return (header, [arrays]); temporary errors are retried until the timeout
+    def request(self, command, **args):
+        deadline = time.perf_counter() + self.timeout
+        while True:
+            reply = request(self.req, command, args, self.timeout)
+            if reply is None:
+                self.req.close(linger = 0)
+                self.connect()
+                raise TimeoutError("No reply from the data server at {}".format(self.address))
+            try:
+                return unpackreply([frame.bytes for frame in reply])
+            except RetryError:
+                if time.perf_counter() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    # Files served: {name: {path, writing}}
+    def files(self):
+        return self.request('files')[0]['files']
+
+    # Datasets of a file: {name: {shape, dtype, layout, status}}
+    def datasets(self, filename):
+        return self.request('list', file = filename)[0]['datasets']
+
+    # Scan slabs of a file (the datasets with a scan status), oldest first
+    def slabs(self, filename):
+        return sorted(name for name, d in self.datasets(filename).items() if d['status'] is not None)
+
+    # Attributes of a dataset
+    def attrs(self, filename, dataset):
+        return self.request('attrs', file = filename, dataset = dataset)[0]['attrs']
+
+    # A hyperslab of a dataset: slices is a list of slice objects (or None for a whole axis);
+    # reads larger than a reply are made in chunks along the first axis
+    def read(self, filename, dataset, slices = None):
+        info = self.datasets(filename)[dataset]
+        shape, itemsize = info['shape'], np.dtype(info['dtype']).itemsize
+        slices = list(slices or []) + [slice(None)]*(len(shape) - len(slices or []))
+        slices = [s if s is not None else slice(None) for s in slices]
+        if not shape:
+            return self.request('read', file = filename, dataset = dataset)[1][0]
+        first = range(*slices[0].indices(shape[0]))
+        rowshape = [len(range(*s.indices(n))) for s, n in zip(slices[1:], shape[1:])]
+        if not len(first):
+            return np.zeros([0] + rowshape, dtype = np.dtype(info['dtype']))
+        rowbytes = itemsize*int(np.prod(rowshape))
+        rows = max(max_reply_bytes//max(rowbytes, 1), 1)
+        chunks = []
+        for i in range(0, len(first), rows):
+            part = first[i:i + rows]
+            stop = part[-1] + part.step #One past the last row (None when that is before the start of the axis)
+            sel = [[part.start, stop if stop >= 0 else None, part.step]] + [[s.start, s.stop, s.step] for s in slices[1:]]
+            chunks.append(self.request('read', file = filename, dataset = dataset, slices = sel)[1][0])
+        return np.concatenate(chunks) if len(chunks) != 1 else chunks[0]
+
+    # Points of a scan measured at or after flat index since: returns (cursor, indices, rows, status)
+    def tail(self, filename, slab, since = 0):
+        header, (indices, rows) = self.request('tail', file = filename, slab = slab, since = since)
+        return header['cursor'], indices, rows, header['status']
+
+    # Yield (indices, rows) of a scan as its points are measured, until the scan is no longer running
+    def follow(self, filename, slab, period = 1.0):
+        cursor = 0
+        while True:
+            cursor, indices, rows, status = self.tail(filename, slab, cursor)
+            if indices.size:
+                yield indices, rows
+            elif status != 'running':
+                return
+            else:
+                time.sleep(period)
+
+    # Close the socket
+    def close(self):
+        self.req.close(linger = 0)
+
+####################################################################################################
+#Functions for writers
+####################################################################################################
+
+#Hand a file to the scan about to write it: the server closes it and forwards its requests to a new
+#WriterService. Returns the service (start it with serve(h5file) once the file is open), or None if no
+#data server is running
+def claimfile(filename, address = dataaddress, timeout = 0.5):
+    service = WriterService()
+    socket = zmq.Context.instance().socket(zmq.REQ)
+    socket.connect(address)
+    try:
+        reply = request(socket, 'claim', {'file': os.path.abspath(filename), 'address': service.address}, timeout)
+    finally:
+        socket.close(linger = 0)
+    if reply is None:
+        service.stop()
+        return None
+    return service
+
+#Tell the data server a file has been closed by its writer
+def releasefile(filename, address = dataaddress, timeout = 0.5):
+    socket = zmq.Context.instance().socket(zmq.REQ)
+    socket.connect(address)
+    try:
+        request(socket, 'release', {'file': os.path.abspath(filename)}, timeout)
+    finally:
+        socket.close(linger = 0)
+
+#Print the files served, the datasets of a file, or follow a scan
+def printdata(filename = None, follow = None, address = dataaddress):
+    client = DataClient(address)
+    try:
+        if filename is None:
+            for name, f in client.files().items():
+                print('{}{} ({})'.format(name, ' [scan writing]' if f['writing'] else '', f['path']))
+        elif follow is None:
+            for name, d in sorted(client.datasets(filename).items()):
+                print('{:<45}{:<18}{:<8}{}'.format(name, str(tuple(d['shape'])), d['dtype'], d['status'] or ''))
+        else:
+            for indices, rows in client.follow(filename, follow):
+                for i, row in zip(indices, rows):
+                    print('{:>8d}: {}'.format(int(i), ', '.join('{:.6g}'.format(x) for x in row)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.close()
+
+####################################################################################################
+####################################################################################################
+# Code starts here
+####################################################################################################
+####################################################################################################
+
+if __name__ == '__main__':
+    DataServer(sys.argv[1:]).run()
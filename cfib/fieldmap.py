@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+
+"""
+fieldmap.py: Electric field maps of the electrode configurations, by superposition
+
+The potential is linear in the electrode voltages, so the potential (and field) of any electrode
+voltage set is the sum over electrodes of voltage x the unit solution of that electrode (1 V on it,
+0 V on every other electrode and the chamber). A field map holds the unit solutions of each
+electrode on a regular 3D grid, in field_maps/<name> of the configuration directory:
+    fieldmap.json    electrodes, grid (origin and spacing in mm, shape) and the source of each solution
+    potential.npy    float32 (electrode, x, y, z), V per V on the electrode
+    field.npy        float32 (electrode, component, x, y, z), V/cm per V on the electrode
+The arrays are memory-mapped, so only the parts used are read. The unit solutions are imported from
+an external solver (a text export of x, y, z, V on the grid, as COMSOL or SIMION write it; see
+importmap), or calculated with the finite difference Laplace solver here from a geometry file (see
+solvegeometry):
+
+    [grid]
+    origin = [-20.0, -20.0, -50.0] # mm
+    spacing = [1.0, 1.0, 1.0]
+    shape = [41, 41, 101]
+
+    [electrodes.e21]
+    boxes = [[-20.0, 20.0, -20.0, 20.0, -50.0, -48.0]] # [xmin, xmax, ymin, ymax, zmin, zmax]
+    rings = [[0.0, 0.0, 5.0, 20.0, -10.0, -8.0]] # Annuli about z: [x, y, rmin, rmax, zmin, zmax]
+
+The field of a voltage set is then one weighted sum (FieldMap.field), and the field at a point is a
+matrix product with the interpolated unit fields there (FieldMap.fieldat), cheap enough for every
+point of a scan ([fieldmap] in cfib/scan.py).
+
+    fm = FieldMap('chamber')
+    F = fm.fieldat({'e21': 120, 'e22': 130}, (0, 0, 0)) # V/cm
+
+The inverse problem, the electrode voltages giving a target field at a set of points (e.g. 500 V/cm
+along z at points on the beam axis), is a bounded least squares problem over the unit fields there:
+each voltage is kept within its channel limit and polarity (the limits of cfib.functions), with a
+small penalty on the voltages so the smallest of equally good solutions is found. FieldSolver
+builds the matrix once for the points, so each solve takes about a millisecond and can be done for
+every step of a field scan ([field] in cfib/scan.py):
+
+    solver = FieldSolver(fm, linepoints((0, 0, -2), (0, 0, 2), 5), fixed = {'e11': -100})
+    voltages = solver.solve((0, 0, 500)) # {electrode: voltage}; solver.residual is the error (V/cm)
+"""
+
+####################################################################################################
+#Import modules
+####################################################################################################
+import os #Operating system interfacing
+import json #Map description file format
+import numpy as np #For maths
+from cfib.registry import configdir #Directory of the configuration files
+
+####################################################################################################
+#Definitions
+####################################################################################################
+
+#Directory of the field maps (in the configuration directory)
+mapdir = os.path.join(configdir, 'field_maps')
+
+#Field of a potential gradient of 1 V/mm (V/cm)
+fieldscale = 10.0
+
+####################################################################################################
+#Define functions
+####################################################################################################
+
+#Field (V/cm, component first) of a potential (V) on a grid with the given spacing (mm): E = -grad V
+def fieldfrompotential(potential, spacing):
+    return -fieldscale*np.stack(np.gradient(potential, *spacing))
+
+#Read an external solver export: one point per line, x y z V (whitespace or comma separated; lines
+#starting with % or # are comments). The points must fill a regular grid, in any order.
+#Returns (origin, spacing, potential), with lengths multiplied by units to give mm
+def readgridfile(filename, units = 1.0):
+    with open(filename, 'r') as f:
+        rows = [line.replace(',', ' ') for line in f if line.strip() and line.lstrip()[0] not in '%#']
+    data = np.loadtxt(rows, ndmin = 2)
+    if data.shape[1] != 4:
+        raise ValueError("{} has {} columns; expected x, y, z, V".format(filename, data.shape[1]))
+    axes = [np.unique(data[:, i]) for i in range(3)]
+    shape = tuple(len(a) for a in axes)
+    if np.prod(shape) != len(data):
+        raise ValueError("The {} points in {} do not fill a regular grid of {}".format(len(data), filename, shape))
+    spacing = [(a[-1] - a[0])/(len(a) - 1) if len(a) > 1 else 1.0 for a in axes]
+    for a, d in zip(axes, spacing):
+        if len(a) > 2 and not np.allclose(np.diff(a), d, rtol = 1e-6):
+            raise ValueError("The grid in {} is not evenly spaced".format(filename))
+    potential = np.full(shape, np.nan)
+    potential[tuple(np.searchsorted(a, data[:, i]) for i, a in enumerate(axes))] = data[:, 3]
+    return [units*a[0] for a in axes], [units*d for d in spacing], potential
+
+#Boolean mask of the grid points inside an electrode of a geometry file (boxes and rings)
+def electrodemask(electrode, origin, spacing, shape):
+    x, y, z = [origin[i] + spacing[i]*np.arange(shape[i]) for i in range(3)]
+    X, Y, Z = np.meshgrid(x, y, z, indexing = 'ij')
+    tol = 1e-9*min(spacing)
+    mask = np.zeros(shape, bool)
+    for xmin, xmax, ymin, ymax, zmin, zmax in electrode.get('boxes', []):
+        mask |= (X >= xmin - tol) & (X <= xmax + tol) & (Y >= ymin - tol) & (Y <= ymax + tol) & (Z >= zmin - tol) & (Z <= zmax + tol)
+    for x0, y0, rmin, rmax, zmin, zmax in electrode.get('rings', []):
+        R = np.hypot(X - x0, Y - y0)
+        mask |= (R >= rmin - tol) & (R <= rmax + tol) & (Z >= zmin - tol) & (Z <= zmax + tol)
+    return mask
+
+#Finite difference (7 point) Laplace operator of the free grid points: returns (A, B, free) such that
+#A @ V[free] = B @ V[~free] for a potential V fixed on ~free (flattened), with A symmetric positive definite
+def laplaceoperator(fixed, spacing):
+    import scipy.sparse as sp
+    shape = fixed.shape
+    size = fixed.size
+    number = np.arange(size).reshape(shape)
+    free = ~fixed.ravel()
+    rows, cols, weights = [], [], []
+    for axis in range(3):
+        w = 1/spacing[axis]**2
+        lo = [slice(None)]*3
+        hi = [slice(None)]*3
+        lo[axis] = slice(0, -1)
+        hi[axis] = slice(1, None)
+        p, q = number[tuple(lo)].ravel(), number[tuple(hi)].ravel()
+        rows += [p, q]
+        cols += [q, p]
+        weights += [np.full(p.size, w)]*2
+    rows, cols, weights = np.concatenate(rows), np.concatenate(cols), np.concatenate(weights)
+    #Coupling of every point to its neighbours, and the diagonal (the sum of the couplings)
+    coupling = sp.csr_matrix((weights, (rows, cols)), shape = (size, size))
+    diagonal = np.asarray(coupling.sum(axis = 1)).ravel()
+    A = sp.diags(diagonal[free]) - coupling[free][:, free]
+    B = coupling[free][:, ~free]
+    return A.tocsr(), B.tocsr(), free
+
+#Solve Laplace's equation on a grid (spacing in mm) with the potential fixed where fixed is True
+#(conjugate gradient, Jacobi preconditioned). The edges of the grid should be fixed (e.g. grounded)
+def solvelaplace(fixed, values, spacing, tol = 1e-8, operator = None):
+    import scipy.sparse as sp
+    from scipy.sparse.linalg import cg
+    A, B, free = operator if operator is not None else laplaceoperator(fixed, spacing)
+    flat = values.ravel().astype(np.float64)
+    rhs = B @ flat[~free]
+    M = sp.diags(1/A.diagonal())
+    try:
+        solution, info = cg(A, rhs, rtol = tol, maxiter = 10*A.shape[0], M = M)
+    except TypeError: #scipy < 1.12
+        solution, info = cg(A, rhs, tol = tol, maxiter = 10*A.shape[0], M = M)
+    if info != 0:
+        print('WARNING: the Laplace solution did not converge ({})'.format(info))
+    potential = flat.copy()
+    potential[free] = solution
+    return potential.reshape(values.shape)
+
+#Points (mm) evenly spaced along a line, e.g. the beam axis through the interaction region
+def linepoints(start, end, num):
+    return np.linspace(np.asarray(start, float), np.asarray(end, float), int(num))
+
+#Lower and upper voltage bounds of electrodes from their channel limits (the sign of a limit is the polarity)
+def voltagebounds(electrodes, limits):
+    return np.array([min(limits[e], 0) for e in electrodes], float), np.array([max(limits[e], 0) for e in electrodes], float)
+
+#Make a field map from the unit solutions of an external solver, given as {electrode: filename}
+#(see readgridfile); lengths in the files are multiplied by units to give mm
+def importmap(name, files, units = 1.0, directory = mapdir):
+    fieldmap = None
+    for electrode, filename in files.items():
+        origin, spacing, potential = readgridfile(filename, units)
+        if fieldmap is None:
+            fieldmap = FieldMap.create(name, list(files), origin, spacing, potential.shape, directory = directory)
+        elif potential.shape != fieldmap.shape or not (np.allclose(origin, fieldmap.origin) and np.allclose(spacing, fieldmap.spacing)):
+            raise ValueError("The grid of {} differs from the grid of the other files".format(filename))
+        if np.isnan(potential).any():
+            raise ValueError("{} does not cover the grid".format(filename))
+        fieldmap.setelectrode(electrode, potential, 'file {}'.format(os.path.abspath(filename)))
+        print('Imported {} from {}'.format(electrode, filename))
+    return fieldmap
+
+#Make a field map by solving Laplace's equation for a geometry file (see the module description);
+#the edges of the grid are the grounded chamber
+def solvegeometry(name, filename, directory = mapdir, tol = 1e-8):
+    try:
+        import tomllib
+    except ImportError:
+        import tomli as tomllib
+    with open(filename, 'rb') as f:
+        geometry = tomllib.load(f)
+    grid = geometry['grid']
+    origin, spacing, shape = [float(x) for x in grid['origin']], [float(x) for x in grid['spacing']], tuple(int(x) for x in grid['shape'])
+    electrodes = list(geometry['electrodes'])
+    masks = {e: electrodemask(geometry['electrodes'][e], origin, spacing, shape) for e in electrodes}
+    fixed = np.zeros(shape, bool)
+    for axis in range(3):
+        edge = [slice(None)]*3
+        for i in (0, -1):
+            edge[axis] = i
+            fixed[tuple(edge)] = True
+    for e in electrodes:
+        if not masks[e].any():
+            raise ValueError("Electrode {} has no grid points; check its shapes against the grid".format(e))
+        fixed |= masks[e]
+    print('Solving for {} electrodes on a {} grid ({} free points)...'.format(len(electrodes), shape, int((~fixed).sum())))
+    operator = laplaceoperator(fixed, spacing) #The same for every electrode
+    fieldmap = FieldMap.create(name, electrodes, origin, spacing, shape, directory = directory)
+    for e in electrodes:
+        values = np.zeros(shape)
+        values[masks[e]] = 1.0
+        fieldmap.setelectrode(e, solvelaplace(fixed, values, spacing, tol, operator), 'solved from {}'.format(os.path.abspath(filename)))
+        print('Solved {}'.format(e))
+    return fieldmap
+
+####################################################################################################
+#Define classes
+####################################################################################################
+
+####################################################################################################
+# FieldMap class: memory-mapped unit solutions of each electrode, summed for a voltage set
+class FieldMap:
+    def __init__(self, name, directory = mapdir, mode = 'r'):
+        self.name = name
+        self.path = os.path.join(directory, name) #Directory of the map
+        with open(os.path.join(self.path, 'fieldmap.json'), 'r') as f:
+            description = json.load(f)
+        self.electrodes = description['electrodes'] #Electrodes in the order of the arrays
+        self.index = {e: i for i, e in enumerate(self.electrodes)} #Electrode -> index
+        self.origin = np.array(description['origin']) #Position of the first grid point (mm)
+        self.spacing = np.array(description['spacing']) #Grid spacing (mm)
+        self.shape = tuple(description['shape']) #Grid points along x, y and z
+        self.sources = description['sources'] #Electrode -> where its solution came from
+        self.potential = np.load(os.path.join(self.path, 'potential.npy'), mmap_mode = mode) #(electrode, x, y, z)
+        self.unitfield = np.load(os.path.join(self.path, 'field.npy'), mmap_mode = mode) #(electrode, component, x, y, z)
+        self.pointbases = {} #Point -> unit fields at the point (electrode, component)
+        self.missing = set() #Electrodes with a voltage but not in the map (reported once)
+
+    # Make an empty map (every unit solution zero) to be filled with setelectrode
+    @classmethod
+    def create(cls, name, electrodes, origin, spacing, shape, directory = mapdir):
+        path = os.path.join(directory, name)
+        os.makedirs(path, exist_ok = True)
+        description = {'electrodes': list(electrodes), 'origin': [float(x) for x in origin], 'spacing': [float(x) for x in spacing],
+                       'shape': [int(x) for x in shape], 'sources': {}}
+        for filename, size in (('potential.npy', (len(electrodes),) + tuple(shape)), ('field.npy', (len(electrodes), 3) + tuple(shape))):
+            np.lib.format.open_memmap(os.path.join(path, filename), mode = 'w+', dtype = np.float32, shape = size).flush()
+        with open(os.path.join(path, 'fieldmap.json'), 'w') as f:
+            json.dump(description, f, indent = 1)
+        return cls(name, directory, mode = 'r+')
+
+    # Store the unit solution (potential with 1 V on the electrode) of an electrode, and its field
+    def setelectrode(self, electrode, potential, source = ''):
+        i = self.index[electrode]
+        self.potential[i] = potential
+        self.unitfield[i] = fieldfrompotential(np.asarray(potential, np.float64), self.spacing)
+        self.potential.flush()
+        self.unitfield.flush()
+        self.sources[electrode] = source
+        with open(os.path.join(self.path, 'fieldmap.json'), 'w') as f:
+            json.dump({'electrodes': self.electrodes, 'origin': self.origin.tolist(), 'spacing': self.spacing.tolist(),
+                       'shape': list(self.shape), 'sources': self.sources}, f, indent = 1)
+        self.pointbases = {}
+
+    # Voltages ({electrode: voltage}) as a vector in the order of the map's electrodes
+    def weights(self, voltages):
+        w = np.zeros(len(self.electrodes))
+        for electrode, voltage in voltages.items():
+            if electrode in self.index:
+                w[self.index[electrode]] = voltage
+            elif voltage != 0 and electrode not in self.missing:
+                self.missing.add(electrode)
+                print('WARNING: {} is not in field map {}; its voltage is ignored'.format(electrode, self.name))
+        return w
+
+    # Positions of the grid points along each axis (mm)
+    def axes(self):
+        return [self.origin[i] + self.spacing[i]*np.arange(self.shape[i]) for i in range(3)]
+
+    # Potential (V) of a voltage set on the grid
+    def potentialfor(self, voltages):
+        return np.tensordot(self.weights(voltages), self.potential, axes = 1)
+
+    # Field (V/cm, component first) of a voltage set on the grid
+    def field(self, voltages):
+        return np.tensordot(self.weights(voltages), self.unitfield, axes = 1)
+
+    # Unit fields at a point (mm) as (electrode, component), interpolated linearly between grid points
+    def pointbasis(self, point):
+        key = tuple(float(x) for x in point)
+        if key not in self.pointbases:
+            u = (np.asarray(key) - self.origin)/self.spacing
+            if np.any(u < 0) or np.any(u > np.array(self.shape) - 1):
+                raise ValueError("Point {} mm is outside field map {}".format(key, self.name))
+            i0 = np.minimum(np.floor(u).astype(int), np.array(self.shape) - 2).clip(0)
+            f = u - i0
+            basis = np.zeros((len(self.electrodes), 3))
+            for corner in np.ndindex(2, 2, 2):
+                weight = np.prod([f[k] if corner[k] else 1 - f[k] for k in range(3)])
+                if weight > 0:
+                    basis += weight*self.unitfield[(slice(None), slice(None)) + tuple(i0 + corner)]
+            self.pointbases[key] = basis
+        return self.pointbases[key]
+
+    # Field (V/cm, (Ex, Ey, Ez)) of a voltage set at a point (mm)
+    def fieldat(self, voltages, point):
+        return self.weights(voltages) @ self.pointbasis(point)
+
+####################################################################################################
+# FieldSolver class: electrode voltages (within the channel limits) giving a target field at a set of points
+# electrodes: electrodes that are varied (default every electrode of the map not in fixed)
+# fixed: {electrode: voltage} of the electrodes that keep their voltage (e.g. the rest of the voltage set)
+# limits: {electrode: limit} (default the channel limits of cfib.functions)
+class FieldSolver:
+    def __init__(self, fieldmap, points, electrodes = None, fixed = None, limits = None, regularisation = 1e-6):
+        if limits is None:
+            from cfib.functions import registry
+            limits = registry.limits
+        self.fieldmap = fieldmap
+        self.points = np.atleast_2d(np.asarray(points, float)) #Points at which the field is set (mm)
+        self.fixed = dict(fixed or {})
+        self.electrodes = [e for e in (electrodes or fieldmap.electrodes) if e not in self.fixed] #Electrodes varied
+        unknown = [e for e in self.electrodes if e not in fieldmap.index]
+        if unknown:
+            raise ValueError("Electrodes {} are not in field map {}".format(unknown, fieldmap.name))
+        #Field at every point (Ex, Ey, Ez of each point) = matrix @ voltages + offset (from the fixed electrodes)
+        basis = np.concatenate([fieldmap.pointbasis(p) for p in self.points], axis = 1)
+        self.matrix = basis[[fieldmap.index[e] for e in self.electrodes]].T
+        self.offset = fieldmap.weights(self.fixed) @ basis
+        self.lower, self.upper = voltagebounds(self.electrodes, limits)
+        #The penalty on the voltages is relative to the mean squared unit field, so it does not depend on the units
+        penalty = np.sqrt(regularisation*np.sum(self.matrix**2)/len(self.electrodes))
+        self.augmented = np.vstack([self.matrix, penalty*np.eye(len(self.electrodes))])
+        self.residual = None #Field minus target at each point (V/cm) of the last solution
+
+    # Voltages ({electrode: voltage}, including the fixed electrodes) giving the target field (V/cm): one
+    # (Ex, Ey, Ez) for every point, or an array of one per point
+    def solve(self, target):
+        from scipy.optimize import lsq_linear
+        target = np.broadcast_to(np.asarray(target, float), self.points.shape).ravel()
+        rhs = np.concatenate([target - self.offset, np.zeros(len(self.electrodes))])
+        solution = lsq_linear(self.augmented, rhs, bounds = (self.lower, self.upper), method = 'bvls').x
+        solution = np.clip(solution, self.lower, self.upper)
+        self.residual = (self.matrix @ solution + self.offset - target).reshape(self.points.shape)
+        voltages = dict(self.fixed)
+        voltages.update(zip(self.electrodes, solution.tolist()))
+        return voltages
+
+    # Largest deviation of the last solution from the target field (V/cm)
+    def error(self):
+        return float(np.max(np.linalg.norm(self.residual, axis = 1)))
@@ -0,0 +1,476 @@
+#!/usr/bin/env python
+
+"""
+interlock.py: A daemon which watches the live channels and shuts the HV down when a rule trips.
+
+Rules are read from a TOML file (interlock_rules.toml in the configuration directory by default).
+Each rule watches one channel of the monitor stream (cfib.monitor) and trips when its value is
+above or below a limit for count readings in a row (e.g. a saturated CEM, as the overcount of the
+proportional output), or when no reading arrives for stale seconds (e.g. the monitor has stopped):
+
+    [[rule]]
+    name = "chamber pressure"
+    channel = "pressure"
+    above = 1e-6
+    count = 2
+    stale = 5.0
+
+The daemon keeps its own websocket sessions with the iCS2. A thread polls Status.isAlive and
+Status.temperature of every module on one of them and feeds them to the rules as the channels
+ics2_alive (the lowest value; 0 when the iCS2 does not reply) and ics2_temperature (the highest).
+The shutdown command (all set voltages to zero and all channels off, in one batched request) is
+built when the other session is opened, so a trip costs one send on an open socket. For every trip
+the time from the reading to the detection and from the detection to the send is printed and written
+to the log (JSON lines), and the daemon prints a summary of the latencies when it stops. A shutdown
+which cannot be sent (e.g. the iCS2 is down) is logged as not sent and tried again every
+retry_period seconds until it is; the rules are evaluated meanwhile.
+
+Run with 'cfib interlock [rules.toml] [--dry-run]'. With --dry-run nothing is sent to the iCS2 (the
+latencies then measure the detection only) and the iCS2 is not polled, so the rules on the ics2_
+channels are left out. The iCS2 password is taken from the CFIB_ICS2_PASSWORD environment variable
+if set, otherwise it is requested once at start.
+"""
+
+####################################################################################################
+#Import modules
+####################################################################################################
+import os #Operating system interfacing
+import copy #For copying the default settings
+import json #Websocket packets and the trip log
+import time #Time access and conversions
+import getpass #Hides inputs when entering passwords
+import threading #Polls the iCS2 status alongside the monitor stream
+import numpy as np #For maths
+import zmq #Used for ZeroMQ distributed messaging
+from cfib.functions import * #Function definitions
+from cfib.registry import configdir #Location of the configuration files
+from cfib.timebase import timebase #Common timebase of the readings
+from cfib.monitor import monitoraddress, packmessage, unpackmessage #Monitor stream
+
+####################################################################################################
+#Definitions
+####################################################################################################
+
+#Default rules file
+rulefile = os.path.join(configdir, 'interlock_rules.toml')
+
+#Settings of the daemon (and their defaults)
+defaults = {
+    'ics2': {
+        'enabled': True, # Poll the iCS2 status and send the shutdown to it
+        'poll_period': 0.5, # Time between status polls (s)
+        'timeout': 0.25, # Time to wait for a reply (s)
+    },
+    'action': {
+        'zero': True, # Set all voltages to zero
+        'power_off': True, # Switch all channels off
+        'retry_period': 1.0, # Time between attempts to send a shutdown which failed (s)
+    },
+    'log': {
+        'file': 'interlock_log.jsonl', # Trips, one JSON object per line (relative to the configuration directory)
+    },
+}
+
+#Keys of a rule (and their defaults; None means not set)
+rulekeys = {'name': None, 'channel': None, 'above': None, 'below': None, 'count': 1, 'stale': 0.0}
+
+#Every channel of the iCS2 ({'l': '*', 'a': '*', 'c': '*'})
+allchannels = {'l': '*', 'a': '*', 'c': '*'}
+
+#Address of the internal stream of the iCS2 status readings
+statusaddress = 'inproc://interlock_status'
+
+#Channels of the iCS2 status readings (only there when the iCS2 is polled)
+statuschannels = ('ics2_alive', 'ics2_temperature')
+
+####################################################################################################
+#Define functions
+####################################################################################################
+
+#Read a rules file, returning the rules and the settings merged with the defaults
+#Unknown sections or keys and rules without a channel or a limit raise a ValueError
+def loadrules(filename = rulefile):
+    try:
+        import tomllib #Python 3.11+
+    except ImportError:
+        import tomli as tomllib
+    with open(filename, 'rb') as f:
+        given = tomllib.load(f)
+    settings = copy.deepcopy(defaults)
+    rules = []
+    for section, values in given.items():
+        if section == 'rule':
+            rules = [makerule(r, filename) for r in values]
+            continue
+        if section not in settings or not isinstance(values, dict):
+            raise ValueError("Unknown section [{}] in {}".format(section, filename))
+        unknown = set(values) - set(settings[section])
+        if unknown:
+            raise ValueError("Unknown keys {} in section [{}] of {}".format(sorted(unknown), section, filename))
+        settings[section].update(values)
+    return rules, settings
+
+#Make a Rule from a [[rule]] table of a rules file
+def makerule(values, filename = None):
+    unknown = set(values) - set(rulekeys)
+    if unknown:
+        raise ValueError("Unknown keys {} in a rule of {}".format(sorted(unknown), filename))
+    values = dict(rulekeys, **values)
+    if values['channel'] is None:
+        raise ValueError("A rule of {} has no channel".format(filename))
+    if values['above'] is None and values['below'] is None and not values['stale']:
+        raise ValueError("Rule {} of {} has no limit (above, below or stale)".format(values['name'] or values['channel'], filename))
+    return Rule(values['name'] or values['channel'], values['channel'], above = values['above'], below = values['below'],
+                count = values['count'], stale = values['stale'])
+
+#Numeric value of an iCS2 item ('1', '23.5', 'true'...), None if it is not a number
+def itemvalue(value):
+    if isinstance(value, str) and value.lower() in ('true', 'false'):
+        return float(value.lower() == 'true')
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+#Summary of a list of latencies (s)
+def latencysummary(latencies):
+    if not latencies:
+        return 'none'
+    ms = 1e3*np.asarray(latencies)
+    return '{:.3f} ms median, {:.3f} ms max ({} trips)'.format(np.median(ms), ms.max(), ms.size)
+
+####################################################################################################
+#Define classes
+####################################################################################################
+
+####################################################################################################
+# Rule class: a limit on one channel of the monitor stream
+# Trips when the highest value of a reading is above 'above' (or the lowest below 'below') for count
+# readings in a row, or when there has been no reading for stale seconds (0: never stale).
+# A tripped rule is armed again once a reading is within the limits
+class Rule:
+    def __init__(self, name, channel, above = None, below = None, count = 1, stale = 0.0):
+        self.name = name #Name printed and logged on a trip
+        self.channel = channel #Channel watched
+        self.above = above #Upper limit (None: no upper limit)
+        self.below = below #Lower limit (None: no lower limit)
+        self.count = max(int(count), 1) #Readings in a row beyond the limit before the rule trips
+        self.stale = stale #Longest time without a reading (s)
+        self.over = 0 #Readings in a row beyond the limit
+        self.tripped = False #Has tripped and not been within the limits since
+        self.last = None #Time of the last reading (or of the start)
+
+    # Check a reading (values at time now), returning the reason if the rule has just tripped
+    def check(self, values, now):
+        self.last = now
+        values = np.atleast_1d(values)
+        if self.above is not None and values.max() > self.above:
+            reason = '{} = {:.4g} above {:.4g}'.format(self.channel, values.max(), self.above)
+        elif self.below is not None and values.min() < self.below:
+            reason = '{} = {:.4g} below {:.4g}'.format(self.channel, values.min(), self.below)
+        else:
+            if self.tripped:
+                print('Interlock rule {} is within its limits again'.format(self.name))
+            self.over = 0
+            self.tripped = False
+            return None
+        self.over += 1
+        if self.over < self.count or self.tripped:
+            return None
+        self.tripped = True
+        return reason if self.count == 1 else reason + ' for {} readings'.format(self.count)
+
+    # Check the time since the last reading, returning the reason if the rule has just gone stale
+    def checkstale(self, now):
+        if not self.stale or self.last is None or self.tripped or now - self.last <= self.stale:
+            return None
+        self.tripped = True
+        return 'no reading of {} for {:.1f} s'.format(self.channel, now - self.last)
+
+####################################################################################################
+# ICS2Link class: a websocket session with the iCS2 of its own, with the shutdown request built in advance
+class ICS2Link:
+    def __init__(self, timeout = 0.25, zero = True, power_off = True):
+        self.url = 'ws://'+ip+':'+wsport #Websocket address of the iCS2
+        self.timeout = timeout #Time to wait for a reply (s)
+        self.zero = zero #Shutdown zeroes the set voltages
+        self.power_off = power_off #Shutdown switches the channels off
+        self.passwd = None #Asked for once
+        self.ws = None #Websocket
+        self.sessionid = None #iCS2 session
+        self.shutdownpacket = None #JSON of the shutdown request (made at login)
+        self.lock = threading.Lock() #One request and its reply at a time
+
+    # Open the websocket and log in, then build the shutdown request for the session
+    def connect(self):
+        import websocket #Only needed to talk to the iCS2
+        from cfib.iseg import iCStasks #Names of the iCS2 items
+        if self.passwd is None:
+            self.passwd = os.environ.get('CFIB_ICS2_PASSWORD') or getpass.getpass("Password for iCS2 module:")
+        self.ws = websocket.create_connection(self.url, timeout = self.timeout)
+        self.ws.send(json.dumps({'i': '', 't': 'login', 'c': {'l': usr, 'p': self.passwd, 't': ''}, 'r': 'websocket'}))
+        self.sessionid = json.loads(self.ws.recv())['i']
+        #As in iCStasks.initialise, the websocket is purged by reconnecting (the session is kept)
+        self.ws.close()
+        self.ws = websocket.create_connection(self.url, timeout = self.timeout)
+        commands = []
+        if self.zero:
+            commands.append({'c': 'setItem', 'p': {'p': allchannels, 'i': iCStasks.VSET, 'v': 0, 'u': ''}})
+        if self.power_off:
+            commands.append({'c': 'setItem', 'p': {'p': allchannels, 'i': iCStasks.POWER, 'v': 0, 'u': ''}})
+        self.shutdownpacket = self.packet(commands)
+
+    # JSON of a request of the session
+    def packet(self, commands):
+        return json.dumps({'i': self.sessionid, 't': 'request', 'c': commands, 'r': 'websocket'})
+
+    # Another link with the same settings and password (a session of its own once connected)
+    def another(self):
+        link = type(self)(self.timeout, zero = self.zero, power_off = self.power_off)
+        link.passwd = self.passwd
+        return link
+
+    # Send the shutdown request. If the socket has gone, reconnect once and send it again
+    # (errors of the reconnect are raised)
+    def shutdown(self):
+        with self.lock:
+            try:
+                self.ws.send(self.shutdownpacket)
+            except Exception as error:
+                print('Websocket send failed ({}); reconnecting to the iCS2 to send the shutdown'.format(error))
+                self.connect()
+                self.ws.send(self.shutdownpacket)
+
+    # Read an item of every channel, returning a list of its numeric values (None if there is no reply)
+    def query(self, item):
+        request = self.packet([{'c': 'getItem', 'p': {'p': allchannels, 'i': item, 'v': '', 'u': ''}}])
+        with self.lock:
+            try:
+                self.ws.send(request)
+                for attempt in range(5):
+                    reply = json.loads(self.ws.recv())
+                    try:
+                        data = [x['d'] for x in reply[0]['c'] if x.get('d', {}).get('i') == item]
+                    except (KeyError, IndexError, TypeError):
+                        continue
+                    if data:
+                        values = [itemvalue(d.get('v')) for d in data]
+                        return [v for v in values if v is not None]
+            except Exception:
+                pass
+        return None
+
+    # Close the websocket (the session is left for the iCS2 to time out; logging out is not needed)
+    def close(self):
+        if self.ws is not None:
+            self.ws.close()
+
+####################################################################################################
+# ICS2Watch class: thread polling the iCS2 status and passing it to the daemon as monitor messages
+# The link is the thread's own (not the one the shutdown is sent on); it is reconnected after a poll
+# without a reply, so ics2_alive comes back when the iCS2 does
+class ICS2Watch(threading.Thread):
+    def __init__(self, link, ctx, period = 0.5):
+        threading.Thread.__init__(self, daemon = True)
+        self.link = link #ICS2Link to poll (used by this thread only)
+        self.ctx = ctx #ZMQ context shared with the daemon
+        self.period = period #Time between polls (s)
+        self.stopped = threading.Event()
+
+    def run(self):
+        from cfib.iseg import iCStasks #Names of the iCS2 items
+        push = self.ctx.socket(zmq.PUSH)
+        push.connect(statusaddress)
+        while not self.stopped.is_set():
+            t_poll = time.perf_counter()
+            alive = self.link.query(iCStasks.ALIVE)
+            t = timebase().now()
+            push.send_multipart(packmessage('ics2_alive', t, min(alive) if alive else 0.0))
+            temperatures = self.link.query(iCStasks.TMEAS)
+            if temperatures:
+                push.send_multipart(packmessage('ics2_temperature', timebase().now(), max(temperatures)))
+            if not alive:
+                try:
+                    with self.link.lock:
+                        self.link.close()
+                        self.link.connect()
+                except Exception:
+                    pass #Still no iCS2; tried again after the next poll
+            self.stopped.wait(max(self.period - (time.perf_counter() - t_poll), 0))
+        push.close()
+
+    def stop(self):
+        self.stopped.set()
+
+####################################################################################################
+# InterlockDaemon class: evaluate the rules on every reading and shut the HV down when one trips
+# link: ICS2Link (None: watch and report only, as with --dry-run)
+class InterlockDaemon:
+    def __init__(self, rules, link = None, poll_period = 0.5, logfile = None, address = monitoraddress, check_period = 0.05,
+                 retry_period = 1.0):
+        self.rules = list(rules) #Rules to evaluate
+        self.bychannel = {} #Channel -> rules watching it
+        for rule in self.rules:
+            self.bychannel.setdefault(rule.channel, []).append(rule)
+        self.link = link #iCS2 session the shutdown is sent on
+        self.poll_period = poll_period #Time between iCS2 status polls (s)
+        self.logfile = logfile #Trip log (None: print only)
+        self.check_period = check_period #Longest time between checks for stale channels (s)
+        self.retry_period = retry_period #Time between attempts to send a shutdown which failed (s)
+        self.unsent = None #(rule, reason) of a trip whose shutdown has not been sent yet
+        self.attempted = None #Time of the last attempt to send it (perf_counter)
+        self.detection = [] #Time from each tripping reading to its detection (s)
+        self.action = [] #Time from each detection to the shutdown being sent (s)
+        self.trips = 0 #Number of trips
+        self.ctx = zmq.Context() #Create a ZMQ Context
+        self.sub = self.ctx.socket(zmq.SUB) #Subscribe to the channels of the rules on the monitor stream
+        for channel in self.bychannel:
+            self.sub.setsockopt(zmq.SUBSCRIBE, channel.encode())
+        self.sub.connect(address)
+        self.pull = self.ctx.socket(zmq.PULL) #iCS2 status readings
+        self.pull.bind(statusaddress)
+        self.poller = zmq.Poller() #Create a poller
+        self.poller.register(self.sub, zmq.POLLIN)
+        self.poller.register(self.pull, zmq.POLLIN)
+        self.watch = None #Thread polling the iCS2 status
+
+    # Connect to the iCS2 and start polling its status
+    def start(self):
+        if self.link is not None:
+            self.link.connect()
+            watchlink = self.link.another()
+            watchlink.connect()
+            self.watch = ICS2Watch(watchlink, self.ctx, self.poll_period)
+            self.watch.start()
+        now = timebase().now()
+        for rule in self.rules:
+            rule.last = now
+
+    # Evaluate the rules of a channel on a reading
+    def evaluate(self, name, t, values):
+        now = timebase().now()
+        for rule in self.bychannel.get(name, ()):
+            reason = rule.check(values, now)
+            if reason is not None:
+                self.trip(rule, reason, t, now)
+
+    # Check every rule for stale channels
+    def checkstale(self):
+        now = timebase().now()
+        for rule in self.rules:
+            reason = rule.checkstale(now)
+            if reason is not None:
+                self.trip(rule, reason, None, now)
+
+    # Send the shutdown for a trip. Returns None if it was sent (or there is no link), otherwise the error;
+    # the shutdown is then tried again by retryshutdown until it is sent
+    def shutdown(self, rule, reason):
+        if self.link is None:
+            return None
+        self.attempted = time.perf_counter()
+        try:
+            self.link.shutdown()
+        except Exception as error:
+            self.unsent = (rule, reason)
+            return '{}: {}'.format(type(error).__name__, error)
+        self.unsent = None
+        return None
+
+    # Shut the HV down and report the trip: t is the time of the reading (None for a stale channel),
+    # detected the time it was evaluated
+    def trip(self, rule, reason, t, detected):
+        error = self.shutdown(rule, reason)
+        sent = timebase().now()
+        self.trips += 1
+        if error is None:
+            self.action.append(sent - detected)
+        if t is not None:
+            self.detection.append(detected - t)
+        if self.link is None:
+            action = 'no action (dry run)'
+        elif error is None:
+            action = 'HV shutdown sent'
+        else:
+            action = 'HV shutdown NOT SENT ({}; retrying every {} s), attempt failed'.format(error, self.retry_period)
+        print('INTERLOCK {}: {}. {} {:.3f} ms after detection{} ({})'.format(rule.name, reason, action, 1e3*(sent - detected),
+              '' if t is None else ', {:.3f} ms after the reading'.format(1e3*(sent - t)), timestampconvert(detected)))
+        self.log({'time': detected, 'rule': rule.name, 'reason': reason, 'reading_time': t,
+                  'detection_latency': None if t is None else detected - t, 'action_latency': sent - detected,
+                  'sent': self.link is not None and error is None, 'error': error})
+
+    # Try again to send a shutdown which failed, at most every retry_period
+    def retryshutdown(self):
+        if self.unsent is None or time.perf_counter() - self.attempted < self.retry_period:
+            return
+        rule, reason = self.unsent
+        error = self.shutdown(rule, reason)
+        now = timebase().now()
+        if error is None:
+            print('INTERLOCK {}: HV shutdown sent on a retry ({})'.format(rule.name, timestampconvert(now)))
+        else:
+            print('INTERLOCK {}: HV shutdown still NOT SENT ({})'.format(rule.name, error))
+        self.log({'time': now, 'rule': rule.name, 'reason': reason, 'retry': True, 'sent': error is None, 'error': error})
+
+    # Append an entry to the trip log
+    def log(self, entry):
+        if self.logfile is not None:
+            with open(self.logfile, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    # Evaluate the rules until interrupted
+    def run(self):
+        self.start()
+        print('Interlock is watching {} rules on {}{}'.format(len(self.rules), ', '.join(sorted(self.bychannel)),
+              '' if self.link is not None else ' (dry run: nothing is sent to the iCS2)'))
+        print('Press Ctrl-C to end. (Or Command + . on OSX)')
+        try:
+            while True:
+                events = dict(self.poller.poll(1000*self.check_period))
+                for socket in (self.sub, self.pull):
+                    if socket not in events:
+                        continue
+                    #Evaluate everything queued, so a burst does not delay the latest reading
+                    while True:
+                        try:
+                            frames = socket.recv_multipart(zmq.NOBLOCK)
+                        except zmq.Again:
+                            break
+                        self.evaluate(*unpackmessage(frames))
+                self.checkstale()
+                self.retryshutdown()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    # Stop polling and close the sockets
+    def close(self):
+        if self.watch is not None:
+            self.watch.stop()
+            self.watch.join()
+            self.watch.link.close()
+        if self.unsent is not None:
+            print('INTERLOCK: the HV shutdown for rule {} was never sent'.format(self.unsent[0].name))
+        if self.link is not None:
+            self.link.close()
+        self.sub.close()
+        self.pull.close()
+        print('Interlock stopped. {} trips; reading to detection {}; detection to action {}'.format(
+            self.trips, latencysummary(self.detection), latencysummary(self.action)))
+
+####################################################################################################
+#Make the daemon from a rules file. With dryrun, the iCS2 is neither polled nor sent the shutdown, and the
+#rules on its status channels (which would only go stale) are left out
+def makeinterlock(filename = rulefile, dryrun = False, address = monitoraddress):
+    rules, settings = loadrules(filename)
+    link = None
+    if settings['ics2']['enabled'] and not dryrun:
+        link = ICS2Link(settings['ics2']['timeout'], zero = settings['action']['zero'], power_off = settings['action']['power_off'])
+    else:
+        left = [r.name for r in rules if r.channel in statuschannels]
+        if left:
+            print('The iCS2 is not polled; leaving out the rules {}'.format(', '.join(left)))
+        rules = [r for r in rules if r.channel not in statuschannels]
+    logfile = os.path.join(configdir, settings['log']['file']) if settings['log']['file'] else None
+    return InterlockDaemon(rules, link, poll_period = settings['ics2']['poll_period'], logfile = logfile, address = address,
+                           retry_period = settings['action']['retry_period'])
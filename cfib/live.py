@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+"""
+Define buffers and threads for live acquisition and display in the CFIB control system
+
+The acquisition runs on its own thread and writes into a ring buffer; plots (or anything else)
+read a view of the buffer at their own pace. Neither side waits on the other.
+
+A SharedRingBuffer is the same buffer in shared memory (multiprocessing.shared_memory), so the
+acquisition can run in its own process (e.g. 'cfib monitor --shared', or a scan with
+output.shared_memory set) and notebooks map its history as a NumPy view without copying:
+
+    buffer = SharedRingBuffer.attach('cfib_cem_rate')
+    buffer.view()['values'] #History, oldest first
+    records, cursor, lost = buffer.read(cursor) #Everything written since the cursor
+"""
+
+####################################################################################################
+#Import modules
+####################################################################################################
+import os #Operating system interfacing
+import json #Data type of the shared buffers
+import threading #Runs acquisition alongside the GUI
+import time #Time access and conversions
+import numpy as np #For maths
+
+####################################################################################################
+#Definitions
+####################################################################################################
+
+#Shared ring buffer header: 8 uint64 words (magic, layout version, length, itemsize, written, length of
+#the data type description, writer process ID, spare), then the data type description as JSON
+sharedmagic = int.from_bytes(b'CFIBRING', 'little')
+sharedheader = 512 #Bytes before the data (keeps the data aligned)
+
+####################################################################################################
+#Define classes
+####################################################################################################
+
+####################################################################################################
+# RingBuffer class for a fixed-length history of samples
+class RingBuffer:
+    """
+    Single-writer ring buffer holding the last 'length' samples.
+
+    The storage is mirrored (every sample is written at i and i + length), so the history in
+    chronological order is always a contiguous slice and view() never copies. There is no lock:
+    the writer fills the data before advancing 'written'. A view held while the writer keeps
+    going may have its oldest few samples replaced by newer ones, which is harmless for display;
+    take a copy if an exact snapshot is needed.
+    """
+    # Initialise the buffer
+    def __init__(self, length, dtype = np.float64, fill = 0):
+        self.length = int(length) #Number of samples held
+        self.data = np.full(2*self.length, fill, dtype = dtype) #Mirrored storage
+        self.written = 0 #Total number of samples ever written (only the writer changes this)
+
+    # Append a single value or an array of values
+    def append(self, values):
+        values = np.atleast_1d(values)
+        n = values.size
+        #Only the newest 'length' samples can be held
+        if n > self.length:
+            values = values[-self.length:]
+        m = values.size
+        #Position of the first sample to keep (skipping any that were dropped)
+        i = (self.written + n - m) % self.length
+        #Write up to the end of the first half, then wrap to the start
+        first = min(m, self.length - i)
+        self.data[i:i + first] = values[:first]
+        self.data[i + self.length:i + self.length + first] = values[:first]
+        rest = m - first
+        if rest > 0:
+            self.data[:rest] = values[first:]
+            self.data[self.length:self.length + rest] = values[first:]
+        #Publish the new samples
+        self.written += n
+
+    # Return a (zero-copy) view of the history, oldest sample first
+    def view(self):
+        i = self.written % self.length
+        return self.data[i:i + self.length]
+
+    # Return the most recent value
+    def latest(self):
+        return self.data[(self.written - 1) % self.length]
+
+####################################################################################################
+# SharedRingBuffer class: a RingBuffer in shared memory, written by one process and read by any number
+class SharedRingBuffer(RingBuffer):
+    """
+    The writer makes the buffer (by name) and appends as to a RingBuffer; readers attach to it by name.
+    The count of samples written is in the header and is advanced after the data are written, so it
+    is the sequence number of the newest sample; read() uses it to return only new samples and to
+    detect samples overwritten before they were read. A view is zero-copy, as for RingBuffer.
+    Samples may have a structured data type, e.g. [('t', 'f8'), ('values', 'f8', (2,))].
+    """
+    # Make the buffer (replacing one of the same name left by a process which did not close it)
+    def __init__(self, name, length, dtype = np.float64, fill = 0):
+        from multiprocessing import shared_memory
+        dtype = np.dtype(dtype)
+        descr = json.dumps(np.lib.format.dtype_to_descr(dtype)).encode()
+        if len(descr) > sharedheader - 64:
+            raise ValueError("The data type of shared buffer {} is too complicated".format(name))
+        size = sharedheader + 2*int(length)*dtype.itemsize
+        try:
+            self.shm = shared_memory.SharedMemory(name = name, create = True, size = size)
+        except FileExistsError:
+            stale = shared_memory.SharedMemory(name = name)
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name = name, create = True, size = size)
+        self.name = name
+        self.owner = True #The writer unlinks the buffer when it closes
+        self.header = np.ndarray(8, np.uint64, self.shm.buf)
+        self.header[:] = [sharedmagic, 1, int(length), dtype.itemsize, 0, len(descr), os.getpid(), 0]
+        self.shm.buf[64:64 + len(descr)] = descr
+        self.length = int(length)
+        self.data = np.ndarray(2*self.length, dtype, self.shm.buf, sharedheader)
+        self.data[:] = fill
+
+    # Attach to a buffer made by another process
+    @classmethod
+    def attach(cls, name):
+        from multiprocessing import shared_memory
+        try:
+            shm = shared_memory.SharedMemory(name = name, track = False) #Python 3.13+
+            untrack = False
+        except TypeError:
+            shm = shared_memory.SharedMemory(name = name)
+            untrack = os.name == 'posix'
+        self = cls.__new__(cls)
+        self.shm = shm
+        self.name = name
+        self.owner = False
+        self.header = np.ndarray(8, np.uint64, shm.buf)
+        if int(self.header[0]) != sharedmagic:
+            self.header = None
+            shm.close()
+            raise ValueError("{} is not a shared ring buffer".format(name))
+        #Otherwise the resource tracker would remove the buffer when this process ends (unless it is the writer)
+        if untrack and int(self.header[6]) != os.getpid():
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        descr = json.loads(bytes(shm.buf[64:64 + int(self.header[5])]))
+        dtype = np.lib.format.descr_to_dtype([tuple(d) for d in descr] if isinstance(descr, list) else descr)
+        self.length = int(self.header[2])
+        self.data = np.ndarray(2*self.length, dtype, shm.buf, sharedheader)
+        return self
+
+    # Total number of samples ever written (the sequence number of the next sample), kept in shared memory
+    @property
+    def written(self):
+        return int(self.header[4])
+
+    @written.setter
+    def written(self, value):
+        self.header[4] = value
+
+    # Copy of the samples written since the cursor (a previous value of written; 0 for everything held).
+    # Returns (samples, new cursor, number of samples overwritten before they could be read)
+    def read(self, cursor = 0):
+        written = self.written
+        lost = max(written - self.length - cursor, 0)
+        start = cursor + lost
+        i = start % self.length
+        samples = self.data[i:i + written - start].copy()
+        #Samples the writer replaced while they were copied are dropped
+        overwritten = max(self.written - self.length - start, 0)
+        return samples[overwritten:], written, lost + overwritten
+
+    # Detach (the writer also removes the buffer). Views of the buffer must be deleted first
+    def close(self):
+        self.header = self.data = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+####################################################################################################
+# Decimator class to feed block averages of a stream into a (longer) ring buffer
+class Decimator:
+    # Initialise the decimator. Every 'factor' samples appended produce one sample in 'buffer'
+    def __init__(self, factor, buffer):
+        self.factor = int(factor) #Number of samples per output sample
+        self.buffer = buffer #The ring buffer receiving the decimated data
+        self.partial = np.zeros(self.factor) #Samples still waiting for a full block
+        self.fill = 0 #Number of samples in partial
+
+    # Append a single value or an array of values
+    def append(self, values):
+        values = np.atleast_1d(values).astype(np.float64, copy = False)
+        #Complete the partial block first
+        take = min(self.factor - self.fill, values.size)
+        self.partial[self.fill:self.fill + take] = values[:take]
+        self.fill += take
+        if self.fill < self.factor:
+            return
+        self.buffer.append(self.partial.mean())
+        self.fill = 0
+        #Average all the full blocks in one go and keep the remainder for next time
+        values = values[take:]
+        nblocks = values.size // self.factor
+        if nblocks > 0:
+            self.buffer.append(values[:nblocks*self.factor].reshape(nblocks, self.factor).mean(axis = 1))
+        rest = values[nblocks*self.factor:]
+        self.partial[:rest.size] = rest
+        self.fill = rest.size
+
+####################################################################################################
+# AcquisitionThread class to call a measurement at a fixed rate and store the result
+class AcquisitionThread(threading.Thread):
+    # Initialise the thread. 'read' is a callable returning a value (or array of values)
+    def __init__(self, read, sample_rate, buffers):
+        threading.Thread.__init__(self, daemon = True)
+        self.read = read #The measurement function
+        self.sample_rate = sample_rate #Rate at which read is called (Hz)
+        self.buffers = list(buffers) #Ring buffers (or decimators) fed by each measurement
+        self.overruns = 0 #Number of times a measurement started late
+        self.stopflag = threading.Event() #Set to end the acquisition
+
+    # Acquire until stopped. Deadlines are absolute so the sampling rate does not drift
+    def run(self):
+        period = 1/self.sample_rate
+        deadline = time.perf_counter()
+        while not self.stopflag.is_set():
+            deadline += period
+            delay = deadline - time.perf_counter()
+            if delay > 0:
+                #Waiting on the event (rather than sleeping) lets stop() return promptly
+                if self.stopflag.wait(delay):
+                    break
+            else:
+                #Running late: count it and start again from now instead of trying to catch up
+                self.overruns += 1
+                deadline = time.perf_counter()
+            value = self.read()
+            for buffer in self.buffers:
+                buffer.append(value)
+
+    # End the acquisition and wait for the thread to finish
+    def stop(self, timeout = 1.0):
+        self.stopflag.set()
+        self.join(timeout)
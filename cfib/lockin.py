@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+"""
+Define modulated (lock-in) detection: an AO channel is square wave or sine modulated while the counter
+counts in bins clocked by the AO samples, and the counts and AI channels are demodulated
+
+The AO, counter and AI tasks of a LockinAcquisition share the sample clock of the AO task, so bin k of
+the counts and sample k of the AI channels line up with sample k of the modulation: the counter latches
+its count on every AO sample clock edge, and the differences of the latched counts are the counts in
+each bin. The AO writes one sample more than the bins, the value the modulation is about, so the
+channel is left at that value and the last bin is closed by a clock edge.
+
+A point is a whole number of modulation periods, so the demodulation folds the bins into one period
+(summing over the periods) and projects the folded period on the references: a few vectorised
+operations per point whatever its length. With r the shape of the modulation (+-1 for a square wave,
+the sine for a sine) and q the same shape a quarter period later, the in-phase and quadrature signals
+of samples s are
+    I = mean(s r)/mean(r r),  Q = mean(s q)/mean(q q)
+so a signal s = a + b r gives I = b and Q = 0: I is the change of the count rate (Hz) or AI voltage
+with the modulation, and a response which lags the modulation moves into Q. Background which drifts
+slowly compared with the modulation period cancels in both.
+"""
+
+####################################################################################################
+#Import modules
+####################################################################################################
+import ctypes #Module required for creating C type ojects - required for some PyDAQmx operations
+import numpy as np #For maths
+
+#PyDAQmx is only needed to acquire; the demodulation can be used without it
+try:
+    from PyDAQmx import * #PyDAQmx module for working with the NI DAQ
+except (ImportError, NotImplementedError):
+    pass
+
+####################################################################################################
+#Definitions
+####################################################################################################
+
+#Shapes of the modulation
+waveforms = ('square', 'sine')
+
+####################################################################################################
+#Define functions
+####################################################################################################
+
+#Shape of one period of the modulation in bins samples (a multiple of 4) and the quadrature reference
+#(the shape a quarter period later). Returns (reference, quadrature)
+def references(waveform, bins):
+    if waveform not in waveforms:
+        raise ValueError("Unknown waveform {}; use one of {}".format(waveform, waveforms))
+    if bins < 4 or bins % 4 != 0:
+        raise ValueError("The bins per period must be a multiple of 4 (not {})".format(bins))
+    if waveform == 'square':
+        #+1 for the first half of the period; the half bin offset keeps the edges between bins
+        phase = 2*np.pi*(np.arange(bins) + 0.5)/bins
+        return np.sign(np.sin(phase)), np.sign(np.cos(phase))
+    phase = 2*np.pi*np.arange(bins)/bins
+    return np.sin(phase), np.cos(phase)
+
+#In-phase and quadrature signals of folded periods (..., bins): the mean of each phase bin over the periods
+#Returns (I, Q), each of the shape of folded without its last axis
+def demodulate(folded, reference, quadrature):
+    folded = np.asarray(folded, dtype = float)
+    return folded @ reference/(reference @ reference), folded @ quadrature/(quadrature @ quadrature)
+
+#Fold samples (..., periods*bins) into one period, returning the sum of each phase bin over the periods
+def fold(samples, bins):
+    samples = np.asarray(samples)
+    return samples.reshape(samples.shape[:-1] + (-1, bins)).sum(axis = -2)
+
+####################################################################################################
+#Define classes
+####################################################################################################
+
+####################################################################################################
+# LockinAcquisition class: modulates an AO channel for a number of periods while counting and sampling
+# the AI channels on its sample clock, then demodulates the counts and AI samples
+# ai_physchans may be empty (counts only); the AO, counter and AI channels must be on the same device
+class LockinAcquisition:
+    def __init__(self, ao_physchan, ctr_physchan, ai_physchans = (), waveform = 'square', frequency = 1000.0, amplitude = 0.01,
+                 bins_per_period = 20, periods = 1, ao_min = -10.0, ao_max = 10.0):
+        self.device = ao_physchan.split('/')[1] #Device of the AO (its sample clock is routed to the counter and AI)
+        self.bins = int(bins_per_period) #Bins per modulation period
+        self.periods = max(int(periods), 1) #Modulation periods per acquisition
+        self.nbins = self.bins*self.periods #Bins per acquisition
+        self.frequency = frequency #Modulation frequency (Hz)
+        self.amplitude = amplitude #Amplitude of the modulation (V)
+        self.ao_min, self.ao_max = ao_min, ao_max #Limits of the AO
+        self.rate = frequency*self.bins #AO samples (bins) per second
+        self.bin_time = 1/self.rate #Duration of a bin (s)
+        self.duration = self.nbins*self.bin_time #Duration of an acquisition (s)
+        self.reference, self.quadrature = references(waveform, self.bins)
+        self.modulation = np.tile(amplitude*self.reference, self.periods) #Modulation of every bin, about the offset
+        self.nai = len(ai_physchans) #Number of AI channels
+        samples = self.nbins + 1 #The last AO sample holds the offset and closes the last bin
+        self.timeout = self.duration + 10.0
+        #Buffers (made once, filled by every acquisition)
+        self.waveform = np.zeros(samples, dtype = np.float64)
+        self.raw = np.zeros(samples, dtype = np.uint32) #Counts latched on each AO sample clock edge
+        self.ai_data = np.zeros(samples*self.nai, dtype = np.float64)
+        self.read_samples = ctypes.c_int32()
+        clock = '/{}/ao/SampleClock'.format(self.device)
+        #Modulated AO, generating the sample clock
+        self.ao_task = Task()
+        self.ao_task.CreateAOVoltageChan(ao_physchan, '', ao_min, ao_max, DAQmx_Val_Volts, None)
+        self.ao_task.CfgSampClkTiming('', self.rate, DAQmx_Val_Rising, DAQmx_Val_FiniteSamps, samples)
+        #Counter latched on the AO sample clock
+        self.ctr_task = Task()
+        self.ctr_task.CreateCICountEdgesChan(ctr_physchan, '', DAQmx_Val_Rising, 0, DAQmx_Val_CountUp)
+        self.ctr_task.CfgSampClkTiming(clock, self.rate, DAQmx_Val_Rising, DAQmx_Val_FiniteSamps, samples)
+        #AI sampled on the AO sample clock
+        self.ai_task = None
+        if self.nai > 0:
+            self.ai_task = Task()
+            self.ai_task.CreateAIVoltageChan(','.join(ai_physchans), '', DAQmx_Val_Cfg_Default, -10.0, 10.0, DAQmx_Val_Volts, None)
+            self.ai_task.CfgSampClkTiming(clock, self.rate, DAQmx_Val_Rising, DAQmx_Val_FiniteSamps, samples)
+
+    # Write the modulation about offset (V) and start it (the counter and AI wait for its sample clock)
+    def start(self, offset = 0.0):
+        if offset - self.amplitude < self.ao_min or offset + self.amplitude > self.ao_max:
+            raise ValueError("The modulation {} +- {} V is outside the AO limits [{}, {}] V".format(offset, self.amplitude, self.ao_min, self.ao_max))
+        self.waveform[:-1] = self.modulation
+        self.waveform[:-1] += offset
+        self.waveform[-1] = offset
+        self.ao_task.WriteAnalogF64(self.waveform.size, 0, 10.0, DAQmx_Val_GroupByChannel, self.waveform, None, None)
+        self.ctr_task.StartTask()
+        if self.ai_task is not None:
+            self.ai_task.StartTask()
+        self.ao_task.StartTask()
+
+    # Wait for the modulation to end, read the counter and AI, and stop the tasks (the AO resources are released,
+    # so an on-demand task can use the channel between acquisitions)
+    def finish(self):
+        self.ao_task.WaitUntilTaskDone(self.timeout)
+        self.ctr_task.ReadCounterU32(self.raw.size, self.timeout, self.raw, self.raw.size, ctypes.byref(self.read_samples), None)
+        if self.ai_task is not None:
+            self.ai_task.ReadAnalogF64(self.raw.size, self.timeout, DAQmx_Val_GroupByChannel, self.ai_data, self.ai_data.size, ctypes.byref(self.read_samples), None)
+        for task in (self.ctr_task, self.ai_task, self.ao_task):
+            if task is not None:
+                task.StopTask()
+        self.ao_task.TaskControl(DAQmx_Val_Task_Unreserve)
+
+    # Counts in each bin of the last acquisition (the differences of the latched counts, across rollovers)
+    def bincounts(self):
+        return np.diff(self.raw.astype(np.int64)) % 2**32
+
+    # Demodulate the last acquisition. Returns (counts, profile, rate_iq, ai):
+    #   counts   total counts in the bins
+    #   profile  counts in each phase bin of the period, summed over the periods
+    #   rate_iq  (I, Q) of the count rate (Hz)
+    #   ai       (I, Q, mean) of each AI channel (V), shape (AI channels, 3)
+    def demodulate(self):
+        profile = fold(self.bincounts(), self.bins)
+        rate_iq = demodulate(profile/(self.periods*self.bin_time), self.reference, self.quadrature)
+        ai = np.zeros((self.nai, 3))
+        if self.nai > 0:
+            samples = self.ai_data.reshape(self.nai, -1)[:, :self.nbins]
+            folded = fold(samples, self.bins)/self.periods
+            ai[:, 0], ai[:, 1] = demodulate(folded, self.reference, self.quadrature)
+            ai[:, 2] = samples.mean(axis = 1)
+        return int(profile.sum()), profile, np.array(rate_iq), ai
+
+    # Stop and clear the tasks
+    def close(self):
+        for task in (self.ctr_task, self.ai_task, self.ao_task):
+            if task is not None:
+                task.StopTask()
+                task.ClearTask()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+"""
+logger.py: Long-term logging of slow-control channels (pressure, count rate, HV monitor, iCS2
+temperatures, ...) to a columnar HDF5 store.
+
+Each channel is a group holding the raw samples plus downsampled tiers (1 s and 1 min bins with
+min/mean/max). The tiers are updated as data is appended, so a month of history can be plotted from
+the 1 min tier (~43k rows) without touching the raw data.
+
+Log everything on the monitor stream (see monitor.py) with:    cfib log
+"""
+
+####################################################################################################
+#Import modules
+####################################################################################################
+import time #Time access and conversions
+import numpy as np #For maths
+import h5py #HDF5 storage
+
+####################################################################################################
+#Definitions
+####################################################################################################
+
+#Default file for the slow-control log
+logfile = 'slow_control_log.hdf'
+
+#Downsampling tiers as (name, bin width in seconds), finest first
+tiers = (('1s', 1.0), ('1min', 60.0))
+
+#Columns of the downsampled tiers. 't' is the start of the bin, 'n' the number of raw samples in it
+tiercolumns = ('t', 'min', 'mean', 'max', 'n')
+
+####################################################################################################
+#Define functions
+####################################################################################################
+
+#Return the index of the first element of a sorted 1D dataset which is >= value
+#(binary search with single-element reads, so the column is never loaded)
+def datasetbisect(dset, value):
+    lo, hi = 0, dset.shape[0]
+    while lo < hi:
+        mid = (lo + hi)//2
+        if dset[mid] < value:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+#Append an array to a resizable 1D dataset
+def appenddataset(dset, values):
+    n = dset.shape[0]
+    dset.resize((n + len(values),))
+    dset[n:] = values
+
+####################################################################################################
+#Define classes
+####################################################################################################
+
+####################################################################################################
+# TimeSeriesStore class: append-only store with raw data and downsampled tiers for each channel
+class TimeSeriesStore:
+    def __init__(self, filename = logfile, mode = 'a', chunks = 4096):
+        self.file = h5py.File(filename, mode) #The HDF5 file
+        self.chunks = chunks #Chunk length of every column
+        self.pendingraw = {} #Raw samples not yet written: {channel: ([t], [value])}
+        self.bins = {} #Partly filled bin for each tier: {(channel, tier): [bin, min, sum, max, n]}
+
+    # Return the group for a channel, creating its columns if required
+    def channelgroup(self, channel):
+        if channel in self.file:
+            return self.file[channel]
+        group = self.file.create_group(channel)
+        for column in ('t', 'v'):
+            group.create_dataset('raw/' + column, (0,), maxshape = (None,), dtype = 'float64',
+                                 chunks = (self.chunks,), compression = 'gzip', shuffle = True)
+        for name, width in tiers:
+            group.create_group(name).attrs['width'] = width
+            for column in tiercolumns:
+                group.create_dataset(name + '/' + column, (0,), maxshape = (None,), dtype = 'float64',
+                                     chunks = (self.chunks,), compression = 'gzip', shuffle = True)
+        return group
+
+    # Return a list of the logged channels
+    def channels(self):
+        return list(self.file.keys())
+
+    # Queue samples for a channel. t is a UNIX timestamp (or array of them); arrays of values are averaged
+    def append(self, channel, t, value):
+        if channel not in self.pendingraw:
+            self.pendingraw[channel] = ([], [])
+        ts, vs = self.pendingraw[channel]
+        ts.extend(np.atleast_1d(t).tolist())
+        if np.ndim(t) == 0:
+            vs.append(float(np.mean(value)))
+        else:
+            vs.extend(np.asarray(value, dtype = np.float64).tolist())
+
+    # Write the queued samples and update the tiers
+    def flush(self):
+        for channel, (ts, vs) in self.pendingraw.items():
+            if len(ts) == 0:
+                continue
+            group = self.channelgroup(channel)
+            t = np.asarray(ts)
+            v = np.asarray(vs)
+            order = np.argsort(t, kind = 'stable')
+            t, v = t[order], v[order]
+            appenddataset(group['raw/t'], t)
+            appenddataset(group['raw/v'], v)
+            for name, width in tiers:
+                self.updatetier(group, channel, name, width, t, v)
+            del ts[:], vs[:]
+        self.file.flush()
+
+    # Fold sorted samples into a tier. Complete bins are written; the last bin stays open
+    def updatetier(self, group, channel, name, width, t, v):
+        tier = group[name]
+        key = (channel, name)
+        #Reopen the last written bin if the new data continues it (e.g. after a restart of the logger)
+        if key not in self.bins and tier['t'].shape[0] > 0:
+            last = [tier[c][-1] for c in tiercolumns]
+            if np.floor(t[0]/width) == np.floor(last[0]/width):
+                self.bins[key] = [np.floor(last[0]/width), last[1], last[2]*last[4], last[3], last[4]]
+                for c in tiercolumns:
+                    tier[c].resize((tier[c].shape[0] - 1,))
+        #Group the samples by bin (t is sorted so each bin is contiguous)
+        binno = np.floor(t/width)
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(binno)) + 1))
+        counts = np.diff(np.concatenate((starts, [len(t)])))
+        bins = binno[starts]
+        mins = np.minimum.reduceat(v, starts)
+        sums = np.add.reduceat(v, starts)
+        maxs = np.maximum.reduceat(v, starts)
+        #Merge the first group with the open bin, or close the open bin
+        pending = self.bins.get(key)
+        if pending != None:
+            if pending[0] == bins[0]:
+                mins[0] = min(mins[0], pending[1])
+                sums[0] += pending[2]
+                maxs[0] = max(maxs[0], pending[3])
+                counts[0] += pending[4]
+            else:
+                bins = np.concatenate(([pending[0]], bins))
+                mins = np.concatenate(([pending[1]], mins))
+                sums = np.concatenate(([pending[2]], sums))
+                maxs = np.concatenate(([pending[3]], maxs))
+                counts = np.concatenate(([pending[4]], counts))
+        #Everything except the last bin is complete
+        if len(bins) > 1:
+            columns = {'t': bins[:-1]*width, 'min': mins[:-1], 'mean': sums[:-1]/counts[:-1], 'max': maxs[:-1], 'n': counts[:-1]}
+            for c in tiercolumns:
+                appenddataset(tier[c], columns[c])
+        self.bins[key] = [bins[-1], mins[-1], sums[-1], maxs[-1], counts[-1]]
+
+    # Write the open bins (they are reopened if logging resumes within the same bin)
+    def closebins(self):
+        for (channel, name), (b, mn, s, mx, n) in self.bins.items():
+            tier = self.file[channel][name]
+            row = {'t': b*tier.attrs['width'], 'min': mn, 'mean': s/n, 'max': mx, 'n': n}
+            for c in tiercolumns:
+                appenddataset(tier[c], [row[c]])
+        self.bins = {}
+
+    # Return the data for a channel between t0 and t1 (UNIX timestamps, None for open ended)
+    # The finest tier with no more than max_points in the range is used; tier = 'raw', '1s' or '1min' forces one
+    # Returns (tier name, dictionary of columns)
+    def query(self, channel, t0 = None, t1 = None, max_points = 5000, tier = None):
+        group = self.file[channel]
+        names = ['raw'] + [name for name, width in tiers]
+        if tier != None:
+            names = [tier]
+        for name in names:
+            tcol = group[name]['t']
+            i0 = 0 if t0 == None else datasetbisect(tcol, t0)
+            i1 = tcol.shape[0] if t1 == None else datasetbisect(tcol, t1)
+            if i1 - i0 <= max_points or name == names[-1]:
+                break
+        columns = ('t', 'v') if name == 'raw' else tiercolumns
+        return name, {c: group[name][c][i0:i1] for c in columns}
+
+    # Flush everything and close the file
+    def close(self):
+        self.flush()
+        self.closebins()
+        self.file.close()
+
+####################################################################################################
+#Plot the history of a channel (mean with a min/max band when a tier is used)
+def plotchannel(store, channel, t0 = None, t1 = None, max_points = 5000):
+    import matplotlib.pyplot as plt
+    name, data = store.query(channel, t0, t1, max_points)
+    fig, ax = plt.subplots(1, 1, tight_layout = True)
+    t = (data['t']*1000).astype('datetime64[ms]') #UTC
+    if name == 'raw':
+        ax.plot(t, data['v'])
+    else:
+        ax.fill_between(t, data['min'], data['max'], alpha = 0.3, step = 'post')
+        ax.step(t, data['mean'], where = 'post')
+    ax.set_xlabel('Time (UTC)')
+    ax.set_ylabel(channel)
+    ax.set_title('{} ({} data)'.format(channel, name))
+    ax.grid()
+    plt.show()
+
+#Log every channel on the monitor stream until interrupted
+def logmonitor(filename = logfile, flush_interval = 10, channels = None):
+    from cfib.monitor import MonitorClient
+    store = TimeSeriesStore(filename)
+    client = MonitorClient(channels)
+    print('Logging monitor channels to {}'.format(filename))
+    print('Press Ctrl-C to end. (Or Command + . on OSX)')
+    last_flush = time.time()
+    try:
+        while True:
+            message = client.receive(timeout = flush_interval)
+            if message != None:
+                name, t, values = message
+                store.append(name, t, values)
+            if time.time() - last_flush > flush_interval:
+                store.flush()
+                last_flush = time.time()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.close()
+        store.close()
+
+####################################################################################################
+####################################################################################################
+# Code starts here
+####################################################################################################
+####################################################################################################
+
+if __name__ == '__main__':
+    logmonitor()
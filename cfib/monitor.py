@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+"""
+monitor.py: A single process which owns the slow-control DAQ tasks and publishes their readings.
+The CEM count rate, the ion pump pressure, the cavity locking photodiode and the proportional CEM
+output are all acquired by one scheduler and published on one ZMQ stream. Any number of viewers and
+loggers can subscribe (MonitorClient) without making any extra hardware reads.
+
+With --shared, the daemon also keeps the history of every channel in a shared memory ring buffer
+(cfib.live.SharedRingBuffer) named cfib_<channel>, of (t, values) records, and the raw samples of
+each analogue input in cfib_<channel>_samples (the count written is the sample number since the
+start), so notebooks can map them as NumPy arrays instead of acquiring in the kernel.
+
+Run the daemon with:        cfib monitor [--shared]
+Print the stream with:      cfib monitor view [channels]
+"""
+
+####################################################################################################
+#Import modules
+####################################################################################################
+import sys #System-specific parameters
+import time #Time access and conversions
+import ctypes #Module required for creating C type ojects - required for some PyDAQmx operations
+import numpy as np #For maths
+import zmq #Used for ZeroMQ distributed messaging
+from cfib.functions import * #Function definitions
+from cfib.pressure import * #Pressure gauge calibrations
+from cfib.timebase import timebase #Common timebase for all readings
+from cfib.live import SharedRingBuffer #Shared memory history of the channels
+from cfib.counterstats import CountExtender, CounterStats #64 bit counts and rate statistics
+
+#PyDAQmx is only needed by the daemon; viewers and loggers can import this module without it
+try:
+    from PyDAQmx import * #PyDAQmx module for working with the NI DAQ
+except (ImportError, NotImplementedError):
+    pass
+
+####################################################################################################
+#Definitions
+####################################################################################################
+
+#Address of the monitor stream. Viewers connect to it, the daemon binds to it
+#(the wavemeter is on 5678 and the scan plotter on 5679)
+monitorport = '5680'
+monitoraddress = 'tcp://127.0.0.1:' + monitorport
+
+#Records kept in the shared memory buffer of each channel, and raw samples of each analogue input
+sharedrecords = 100000
+sharedsamples = 1000000
+
+####################################################################################################
+#Define functions
+####################################################################################################
+
+#Make a message for the monitor stream: [channel name, (timestamp, values...) as float64]
+def packmessage(name, t, values):
+    return [name.encode(), np.concatenate(([t], np.atleast_1d(values))).astype(np.float64).tobytes()]
+
+#Unpack a message from the monitor stream into (channel name, timestamp, values)
+def unpackmessage(frames):
+    packet = np.frombuffer(frames[1], dtype = np.float64)
+    return frames[0].decode(), packet[0], packet[1:]
+
+####################################################################################################
+#Define classes
+####################################################################################################
+
+####################################################################################################
+# CounterRate class: count rate (Hz) from an NI counter since the previous read
+# The rate is corrected for the detector deadtime (s), and the statistics of the rates are kept in stats
+class CounterRate:
+    def __init__(self, name, ctr_physchan, period = 0.1, deadtime = 0.0):
+        self.name = name #Channel name on the monitor stream
+        self.period = period #Time between reads (s)
+        self.task = Task() #Define the task as Task()
+        self.task.CreateCICountEdgesChan(ctr_physchan, '', DAQmx_Val_Rising, 0, DAQmx_Val_CountUp) #Set the counting task
+        self.cnt = (ctypes.c_ulong*1)() #Initialise the count - must be unsigned long!
+        self.extender = CountExtender() #Extends the 32 bit readings to 64 bits
+        self.stats = CounterStats(bin_time = period, deadtime = deadtime) #Statistics of the rates
+        self.count = 0 #The most recent count (64 bit)
+        self.time = None #Time of the most recent count
+
+    # Start counting
+    def start(self):
+        self.task.StartTask()
+        self.task.ReadCounterScalarU32(10.0, self.cnt, None)
+        self.count = self.extender.extend(self.cnt[0])
+        self.time = timebase().now()
+
+    # Return the timestamp and a dictionary of {channel name: values}
+    def read(self):
+        self.task.ReadCounterScalarU32(10.0, self.cnt, None)
+        t = timebase().now()
+        count = self.extender.extend(self.cnt[0])
+        rate = self.stats.addcount(count - self.count, t - self.time)
+        self.count = count
+        self.time = t
+        return t, {self.name: rate}
+
+    # Stop and clear the task
+    def close(self):
+        self.task.StopTask()
+        self.task.ClearTask()
+
+####################################################################################################
+# AIBlock class: several analogue inputs sampled continuously in one task (a device only runs one AI task)
+class AIBlock:
+    def __init__(self, names, ai_physchans, conversions = None, period = 0.1, sample_rate = 1000, buffer_size = 10000):
+        self.names = list(names) #Channel names on the monitor stream
+        self.ai_physchans = list(ai_physchans) #Physical addresses of the analogue input channels
+        if not self.ai_physchans:
+            raise ValueError("An AIBlock needs at least one analogue input channel")
+        #Optional function for each channel to convert volts to physical units (applied to the whole block)
+        self.conversions = conversions if conversions != None else [None] * len(self.names)
+        self.period = period #Time between reads (s)
+        self.task = Task() #Define the task as Task()
+        self.read_samples = ctypes.c_int32() #Number of samples per channel actually read
+        self.data = np.zeros(buffer_size*len(self.names), dtype = np.float64) #Large enough to hold the whole DAQ buffer
+        self.task.CreateAIVoltageChan(','.join(self.ai_physchans), '', DAQmx_Val_Cfg_Default, -10.0, 10.0, DAQmx_Val_Volts, None)
+        self.task.CfgSampClkTiming('', sample_rate, DAQmx_Val_Rising, DAQmx_Val_ContSamps, buffer_size)
+        #The sample clock, in samples since the start, is related to the reference time at every read
+        self.clock = timebase().clock('daq:' + self.ai_physchans[0], rate = sample_rate)
+        self.samples_read = 0 #Samples per channel read since the start
+        self.samplebuffers = None #Shared memory buffers of the (converted) samples of each channel
+
+    # Keep the raw samples of each channel in shared memory (cfib_<name>_samples)
+    def share(self, length = sharedsamples):
+        self.samplebuffers = [SharedRingBuffer('cfib_{}_samples'.format(name), length) for name in self.names]
+
+    # Start sampling
+    def start(self):
+        self.task.StartTask()
+
+    # Return the timestamp (middle of the samples, from the sample clock) and a dictionary of {channel name: mean value since the previous read}
+    def read(self):
+        #Read everything acquired since the last read (samples grouped by channel)
+        self.task.ReadAnalogF64(DAQmx_Val_Auto, 10.0, DAQmx_Val_GroupByChannel, self.data, self.data.size, ctypes.byref(self.read_samples), None)
+        t = timebase().now()
+        n = self.read_samples.value
+        self.samples_read += n
+        #The last sample read was acquired at most one sample period before the read returned
+        self.clock.add(t, self.samples_read)
+        readings = {}
+        if n > 0:
+            t = float(self.clock.toreference(self.samples_read - (n + 1)/2))
+            block = self.data[:n*len(self.names)].reshape(len(self.names), n)
+            #Convert every sample before averaging (the conversions need not be linear)
+            for i, (name, samples, conversion) in enumerate(zip(self.names, block, self.conversions)):
+                converted = conversion(samples) if conversion != None else samples
+                readings[name] = converted.mean()
+                if self.samplebuffers is not None:
+                    self.samplebuffers[i].append(converted)
+        return t, readings
+
+    # Stop and clear the task
+    def close(self):
+        self.task.StopTask()
+        self.task.ClearTask()
+        for buffer in self.samplebuffers or []:
+            buffer.close()
+
+####################################################################################################
+# ProportionalOutput class: drive an AO with a voltage proportional to a monitored count rate
+class ProportionalOutput:
+    def __init__(self, name, ao_physchan, follow, max_count_rate = 10000, oversamplelimit = 2):
+        self.name = name #Channel name on the monitor stream
+        self.follow = follow #Name of the channel the output follows
+        self.max_count_rate = max_count_rate #Count rate giving 10 V
+        self.oversamplelimit = oversamplelimit #Saturated reads before max_count_rate is doubled
+        self.overcount = 0 #Number of consecutive saturated reads
+        self.task = Task() #Define the task as Task()
+        self.task.CreateAOVoltageChan(ao_physchan, '', -10.0, 10.0, DAQmx_Val_Volts, None)
+
+    # Start at zero
+    def start(self):
+        self.task.WriteAnalogF64(1, 1, 10.0, DAQmx_Val_GroupByChannel, np.array(0.0), None, None)
+
+    # Update the output from the followed channel and return the voltage written
+    def update(self, count_rate):
+        output_voltage = count_rate/self.max_count_rate*10
+        if output_voltage > 10:
+            output_voltage = 10.0
+            self.overcount += 1
+        else:
+            self.overcount = 0
+        #Saturating for too long: increase the range
+        if self.overcount == self.oversamplelimit:
+            self.max_count_rate *= 2
+            self.overcount = 0
+        self.task.WriteAnalogF64(1, 1, 10.0, DAQmx_Val_GroupByChannel, np.array(float(output_voltage)), None, None)
+        return output_voltage
+
+    # Zero and clear the task
+    def close(self):
+        self.task.WriteAnalogF64(1, 1, 10.0, DAQmx_Val_GroupByChannel, np.array(0.0), None, None)
+        self.task.ClearTask()
+
+####################################################################################################
+# MonitorDaemon class: schedule all the sources and publish every reading on one stream
+class MonitorDaemon:
+    def __init__(self, sources, outputs = [], address = 'tcp://*:' + monitorport, shared = False):
+        self.sources = list(sources) #Objects with a period, start(), read() and close()
+        self.outputs = list(outputs) #Objects with a name, follow, start(), update() and close()
+        self.overruns = 0 #Number of reads which started late
+        self.shared = shared #Keep the channels (and raw samples of sources with share()) in shared memory
+        self.buffers = {} #Channel name -> SharedRingBuffer of (t, values) records (made on the first reading)
+        self.ctx = zmq.Context() #Create a ZMQ Context
+        self.pub = self.ctx.socket(zmq.PUB) #Publish the readings
+        self.pub.bind(address)
+
+    # Publish a reading and update any output following it
+    def publish(self, name, t, values):
+        self.pub.send_multipart(packmessage(name, t, values))
+        if self.shared:
+            values = np.atleast_1d(values)
+            buffer = self.buffers.get(name)
+            if buffer is None:
+                buffer = self.buffers[name] = SharedRingBuffer('cfib_' + name, sharedrecords, [('t', 'f8'), ('values', 'f8', (values.size,))])
+            record = np.zeros(1, buffer.data.dtype)
+            record['t'], record['values'] = t, values
+            buffer.append(record)
+        for output in self.outputs:
+            if output.follow == name:
+                self.publish(output.name, t, output.update(float(np.mean(values))))
+
+    # Acquire and publish until interrupted
+    def run(self):
+        for x in self.sources + self.outputs:
+            if self.shared and hasattr(x, 'share'):
+                x.share()
+            x.start()
+        print('Monitor is publishing on port {}{}'.format(monitorport, ' and in shared memory (cfib_<channel>)' if self.shared else ''))
+        print('Press Ctrl-C to end. (Or Command + . on OSX)')
+        #Time each source is next due (one scheduler for all of the tasks)
+        due = [time.perf_counter() + s.period for s in self.sources]
+        try:
+            while True:
+                i = int(np.argmin(due))
+                delay = due[i] - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                t, readings = self.sources[i].read()
+                for name, value in readings.items():
+                    self.publish(name, t, value)
+                #Schedule the next read. If we have fallen a whole period behind, don't try to catch up
+                due[i] += self.sources[i].period
+                now = time.perf_counter()
+                if due[i] < now:
+                    self.overruns += 1
+                    due[i] = now + self.sources[i].period
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    # Close all tasks and the socket
+    def close(self):
+        for x in self.sources + self.outputs:
+            x.close()
+        for buffer in self.buffers.values():
+            buffer.close()
+        self.pub.close()
+        print('Monitor stopped ({} late reads)'.format(self.overruns))
+
+####################################################################################################
+# MonitorClient class: subscribe to some (or all) channels on the monitor stream
+class MonitorClient:
+    def __init__(self, channels = None, address = monitoraddress):
+        self.channels = channels #Channel names to receive (None for all)
+        self.ctx = zmq.Context() #Create a ZMQ Context
+        self.sub = self.ctx.socket(zmq.SUB) #Set the ZMQ socket object
+        if channels == None:
+            self.sub.setsockopt(zmq.SUBSCRIBE, b'')
+        else:
+            for name in channels:
+                self.sub.setsockopt(zmq.SUBSCRIBE, name.encode())
+        self.sub.connect(address)
+        self.poller = zmq.Poller() #Create a poller
+        self.poller.register(self.sub, zmq.POLLIN)
+
+    # Return the next (channel name, timestamp, values), or None if nothing arrives within timeout (s)
+    def receive(self, timeout = None):
+        while True:
+            if not self.poller.poll(None if timeout == None else 1000*timeout):
+                return None
+            name, t, values = unpackmessage(self.sub.recv_multipart())
+            #Subscriptions match on prefix, so drop channels which only share the start of the name
+            if self.channels == None or name in self.channels:
+                return name, t, values
+
+    # Close the socket
+    def close(self):
+        self.sub.close()
+
+####################################################################################################
+#Make the default daemon: CEM counter, cavity photodiode, pressure gauges and the proportional CEM output
+#All analogue inputs go in one AIBlock as the device can only run one AI task
+def makedaemon(gaugefile = gaugefile, shared = False):
+    gauges = loadgauges(gaugefile)
+    if not gauges:
+        print("No pressure gauges are defined in {}; the monitor runs without them".format(gaugefile))
+    sources = [CounterRate('cem_rate', NI_hardware_addresses['Counter 1']),
+               AIBlock(['cavity_pd'] + [g.name for g in gauges],
+                       [NI_hardware_addresses['AI01']] + [NI_hardware_addresses[g.channel] for g in gauges],
+                       conversions = [None] + gauges)]
+    outputs = [ProportionalOutput('cem_ao', NI_hardware_addresses['AO01'], 'cem_rate')]
+    return MonitorDaemon(sources, outputs, shared = shared)
+
+#Print everything on the monitor stream
+def printmonitor(channels = None):
+    client = MonitorClient(channels)
+    try:
+        while True:
+            name, t, values = client.receive()
+            print('{} {}: {}'.format(timestampconvert(t), name, ', '.join('{:.4g}'.format(v) for v in values)))
+    except KeyboardInterrupt:
+        client.close()
+
+####################################################################################################
+####################################################################################################
+# Code starts here
+####################################################################################################
+####################################################################################################
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'view':
+        printmonitor(sys.argv[2:] or None)
+    else:
+        makedaemon().run()
@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+
+"""
+orchestrate.py: Run independent acquisitions on different DAQ devices at the same time
+
+Each job of a jobs file runs in its own process. Before it starts it locks every resource it uses
+(the DAQ devices of its channels, e.g. Dev6229, and 'ics2' for jobs which set electrode voltages),
+so jobs on different devices run together and jobs sharing a device run one after the other. The
+locks are files in the configuration directory held with an OS lock, so they are also respected by
+other orchestrators and are released if a process dies. Locks are taken in sorted order, so two
+jobs can never wait on each other.
+
+The jobs report their progress to the orchestrator, which prints a table of all of them. Each job
+writes its own HDF5 file; when all have finished they are merged into one output file with a group
+per job (the attributes of the group record the kind, resources, times and status of the job). A job
+whose group already exists in the output (from an earlier run) gets a new group, name_2, name_3, ...
+The files of failed jobs are not merged but kept in the <output>.parts directory (a scan job can be
+continued with 'cfib scan --resume' on its file).
+
+A jobs file (TOML) looks like
+
+    output = "session.hdf"
+
+    [[job]]
+    name = "stark"
+    kind = "scan"                       # a Stark scan (cfib.scan), spec given by 'spec'
+    spec = "Field mapping/stark_scan.toml"
+
+    [[job]]
+    name = "calibration"
+    kind = "ramp"                       # an AO ramp (executeAOramp) on one channel
+    channel = "/Dev1/ao0"
+    min = -1.0
+    max = 1.0
+    points = 100
+    dwell = 0.05
+
+    [[job]]
+    name = "reference"
+    kind = "count"                      # count rate of a counter for a time
+    channel = "/Dev2/ctr0"
+    duration = 60.0
+    sample_rate = 10.0
+
+Run with 'cfib run jobs.toml'.
+"""
+
+####################################################################################################
+#Import modules
+####################################################################################################
+import os #Operating system interfacing
+import sys #System-specific parameters
+import time #Time access and conversions
+import queue #Empty exception of the progress queue
+import traceback #For reporting failed jobs
+import multiprocessing #One process per job
+from cfib.registry import configdir #Directory of the configuration files
+
+#Locks are held with fcntl on Linux and msvcrt on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+####################################################################################################
+#Definitions
+####################################################################################################
+
+#Directory of the resource lock files (in the configuration directory)
+lockdir = os.path.join(configdir, 'locks')
+
+#Settings of each kind of job (and their defaults; None must be given)
+jobkinds = {
+    'scan': {'spec': None},
+    'ramp': {'channel': None, 'min': None, 'max': None, 'points': None, 'dwell': None, 'slew': 0.0, 'slewpoints': 5, 'wavereport': False},
+    'count': {'channel': None, 'duration': None, 'sample_rate': 10.0},
+}
+
+####################################################################################################
+#Define functions
+####################################################################################################
+
+#Physical channel of a channel given by name (e.g. 'Counter 1') or physical channel
+def physchan(channel):
+    if channel.startswith('/'):
+        return channel
+    from cfib.functions import registry
+    return registry.physchan(channel)
+
+#DAQ device of a physical channel (e.g. '/Dev6229/ctr0' -> 'Dev6229')
+def channeldevice(channel):
+    return physchan(channel).strip('/').split('/')[0]
+
+#Resources used by a job: its DAQ devices, and 'ics2' for scans
+def jobresources(job):
+    if job['kind'] == 'scan':
+        from cfib.scan import loadspec
+        spec = loadspec(job['spec'])
+        hw = spec['hardware']
+        channels = [hw['ao_wavelength'], hw['counter']] + list(hw['ai'])
+        if spec['timetag']['enabled']:
+            channels += [spec['timetag']['start_counter'], spec['timetag']['stop_counter']]
+        if spec['gate']['enabled']:
+            channels.append(spec['gate']['counter'])
+        return sorted(set(channeldevice(c) for c in channels)) + ['ics2']
+    return [channeldevice(job['channel'])]
+
+#Read a jobs file (TOML), returning the output file name and the jobs with their defaults filled in
+def loadjobs(filename):
+    try:
+        import tomllib #Python 3.11+
+    except ImportError:
+        import tomli as tomllib
+    with open(filename, 'rb') as f:
+        given = tomllib.load(f)
+    jobs = []
+    for job in given.get('job', []):
+        kind = job.get('kind')
+        if kind not in jobkinds:
+            raise ValueError("Unknown job kind {} in {}; use one of {}".format(kind, filename, sorted(jobkinds)))
+        settings = dict(jobkinds[kind])
+        unknown = set(job) - set(settings) - {'name', 'kind'}
+        if unknown:
+            raise ValueError("Unknown keys {} in {} job of {}".format(sorted(unknown), kind, filename))
+        settings.update(job)
+        missing = [key for key, value in settings.items() if value is None]
+        if missing:
+            raise ValueError("The {} job {} of {} needs {}".format(kind, job.get('name', len(jobs)), filename, missing))
+        settings.setdefault('name', '{}{}'.format(kind, len(jobs)))
+        jobs.append(settings)
+    names = [job['name'] for job in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError("Job names in {} must be unique".format(filename))
+    return given.get('output', 'session.hdf'), jobs
+
+####################################################################################################
+#Define classes
+####################################################################################################
+
+####################################################################################################
+# ResourceLock class: exclusive lock of a resource (DAQ device or instrument) between processes
+class ResourceLock:
+    def __init__(self, resource, directory = lockdir):
+        self.resource = resource #Name of the resource
+        self.filename = os.path.join(directory, resource + '.lock')
+        self.file = None #Open lock file while held
+
+    # Try to take the lock without waiting. Returns True if it is held
+    def tryacquire(self, holder = ''):
+        os.makedirs(os.path.dirname(self.filename), exist_ok = True)
+        f = open(self.filename, 'a+')
+        try:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            f.close()
+            return False
+        #Record the holder for anyone waiting
+        f.seek(0)
+        f.truncate()
+        f.write('{} {}\n'.format(os.getpid(), holder))
+        f.flush()
+        self.file = f
+        return True
+
+    # Wait for the lock (timeout None waits for ever). Returns True if it is held
+    def acquire(self, holder = '', timeout = None, poll = 0.2):
+        start = time.time()
+        while not self.tryacquire(holder):
+            if timeout is not None and time.time() - start > timeout:
+                return False
+            time.sleep(poll)
+        return True
+
+    # Process ID and name of the holder, as recorded in the lock file ('' if unknown)
+    def holder(self):
+        try:
+            with open(self.filename, 'r') as f:
+                return f.read().strip()
+        except OSError:
+            return ''
+
+    # Release the lock
+    def release(self):
+        if self.file is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        else:
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+####################################################################################################
+# Progress class: what a job reports to the orchestrator
+class Progress:
+    def __init__(self, name, progressqueue):
+        self.name = name #Name of the job
+        self.queue = progressqueue #Queue read by the orchestrator
+
+    # Report the state of the job, and how far it has got
+    def __call__(self, done = None, total = None, state = 'running', message = ''):
+        self.queue.put((self.name, state, done, total, message, time.time()))
+
+####################################################################################################
+#Jobs (each is run in its own process by runjob)
+####################################################################################################
+
+#Run a Stark scan into the job's file
+def scanjob(job, filename, progress):
+    from cfib.scan import Scan, loadspec
+    spec = loadspec(job['spec'])
+    spec['output']['filename'] = filename
+    scan = Scan(spec)
+    scan.progress = lambda done, total: progress(done, total)
+    scan.setup()
+    try:
+        scan.run()
+    finally:
+        scan.close()
+
+#Run an AO ramp, storing the ramp (and the wavelengths, if reported)
+def rampjob(job, filename, progress):
+    import numpy as np
+    import h5py
+    from cfib.daq import executeAOramp, makeramp
+    progress(0, 1, message = 'ramping {}'.format(job['channel']))
+    wavelengths = executeAOramp(physchan(job['channel']), job['min'], job['max'], job['points'], job['dwell'], slew = job['slew'],
+                                slewpoints = job['slewpoints'], showplot = False, wavereport = job['wavereport'])
+    with h5py.File(filename, 'a') as f:
+        f.create_dataset('ramp', data = makeramp(job['min'], job['max'], job['points']))
+        if wavelengths:
+            f.create_dataset('wavelengths', data = np.array(wavelengths, dtype = np.float64))
+            f['wavelengths'].attrs['data_layout'] = '(point, (voltage, wavelength))'
+    progress(1, 1)
+
+#Record the count rate of a counter for a time
+def countjob(job, filename, progress):
+    import numpy as np
+    import h5py
+    from cfib.daq import Counter
+    from cfib.timebase import timebase
+    counter = Counter(physchan(job['channel']))
+    counter.start()
+    counter.readcount()
+    period = 1/job['sample_rate']
+    total = int(job['duration']*job['sample_rate'])
+    data = np.zeros((total, 2))
+    deadline = time.time()
+    try:
+        for i in range(total):
+            deadline += period
+            time.sleep(max(deadline - time.time(), 0))
+            data[i] = timebase().now(), counter.readrate()
+            if i % max(int(job['sample_rate']), 1) == 0:
+                progress(i + 1, total, message = '{:.1f} Hz'.format(data[i, 1]))
+    finally:
+        counter.close()
+    with h5py.File(filename, 'a') as f:
+        f.create_dataset('rates', data = data)
+        f['rates'].attrs['data_layout'] = '(sample, (time, count rate))'
+    progress(total, total)
+
+#Functions running each kind of job
+jobfunctions = {'scan': scanjob, 'ramp': rampjob, 'count': countjob}
+
+#Run a job in this process: lock its resources (in sorted order, so jobs never wait on each other), run it, release
+def runjob(job, filename, progressqueue, directory = lockdir):
+    progress = Progress(job['name'], progressqueue)
+    locks = []
+    try:
+        for resource in sorted(jobresources(job)):
+            lock = ResourceLock(resource, directory)
+            if not lock.tryacquire(job['name']):
+                progress(state = 'waiting', message = '{} is held by {}'.format(resource, lock.holder() or 'another process'))
+                lock.acquire(job['name'])
+            locks.append(lock)
+        progress(state = 'running', message = 'locked ' + ', '.join(lock.resource for lock in locks))
+        start = time.time()
+        jobfunctions[job['kind']](job, filename, progress)
+        progress(state = 'done', message = 'finished in {:.0f} s'.format(time.time() - start))
+    except BaseException as e:
+        progress(state = 'failed', message = '{}: {}'.format(type(e).__name__, e))
+        traceback.print_exc()
+        sys.exit(1)
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+####################################################################################################
+# Orchestrator class: run the jobs in parallel, show their progress and merge their files
+class Orchestrator:
+    def __init__(self, jobs, output = 'session.hdf', refresh = 2.0, directory = lockdir):
+        self.jobs = jobs #Job settings (see loadjobs)
+        self.output = output #Merged HDF5 file
+        self.partsdir = output + '.parts' #Files written by the jobs
+        self.refresh = refresh #Seconds between progress tables
+        self.directory = directory #Directory of the lock files
+        self.status = {job['name']: {'state': 'starting', 'done': None, 'total': None, 'message': '', 'start': None, 'end': None} for job in jobs}
+
+    # File written by a job
+    def partfile(self, job):
+        return os.path.join(self.partsdir, job['name'] + '.hdf')
+
+    # Update the status of the jobs from the progress queue (waiting up to timeout for the first report)
+    def update(self, progressqueue, timeout):
+        try:
+            report = progressqueue.get(timeout = timeout)
+        except queue.Empty:
+            return
+        while True:
+            name, state, done, total, message, t = report
+            status = self.status[name]
+            if state == 'running' and status['start'] is None:
+                status['start'] = t
+            if state in ('done', 'failed'):
+                status['end'] = t
+            status['state'] = state
+            if done is not None:
+                status['done'], status['total'] = done, total
+            if message:
+                status['message'] = message
+            try:
+                report = progressqueue.get_nowait()
+            except queue.Empty:
+                return
+
+    # Print the progress of every job
+    def printstatus(self):
+        print('########################################################')
+        for name, status in self.status.items():
+            fraction = '{:5.1f}%'.format(100*status['done']/status['total']) if status['total'] else '     '
+            print('{:<16s} {:<9s} {} {}'.format(name, status['state'], fraction, status['message']))
+
+    # Run all the jobs and merge their files. Returns the names of the jobs which failed
+    def run(self):
+        os.makedirs(self.partsdir, exist_ok = True)
+        progressqueue = multiprocessing.Queue()
+        processes = {}
+        for job in self.jobs:
+            print('Job {} ({}) uses {}'.format(job['name'], job['kind'], ', '.join(jobresources(job))))
+            process = multiprocessing.Process(target = runjob, args = (job, self.partfile(job), progressqueue, self.directory), name = job['name'])
+            process.start()
+            processes[job['name']] = process
+        try:
+            while any(p.is_alive() for p in processes.values()):
+                self.update(progressqueue, self.refresh)
+                self.printstatus()
+            self.update(progressqueue, 0.1)
+        except KeyboardInterrupt:
+            print('Stopping the jobs...')
+            for p in processes.values():
+                p.terminate()
+        for name, p in processes.items():
+            p.join()
+            #A job which died without reporting (e.g. killed) has failed
+            if p.exitcode != 0 and self.status[name]['state'] != 'failed':
+                self.status[name]['state'] = 'failed'
+                self.status[name]['message'] = 'exit code {}'.format(p.exitcode)
+        self.printstatus()
+        self.merge()
+        return [name for name, status in self.status.items() if status['state'] != 'done']
+
+    # Copy the file of every job into a new group of the output file (the job name, or name_2, name_3, ... if the
+    # output already has a group of that name from an earlier run). The file of a job is only removed once it has
+    # been copied; the files of failed jobs are kept where they are (a scan can be resumed from its file)
+    def merge(self):
+        import h5py
+        with h5py.File(self.output, 'a') as out:
+            for job in self.jobs:
+                name, filename = job['name'], self.partfile(job)
+                status = self.status[name]
+                if status['state'] == 'failed':
+                    if os.path.exists(filename):
+                        print('Job {} failed; its data is left in {}'.format(name, filename))
+                    continue
+                groupname, n = name, 1
+                while groupname in out:
+                    n += 1
+                    groupname = '{}_{}'.format(name, n)
+                group = out.create_group(groupname)
+                if groupname != name:
+                    print('{} already has a group {}; job {} is merged into {}'.format(self.output, name, name, groupname))
+                group.attrs['kind'] = job['kind']
+                group.attrs['resources'] = ','.join(jobresources(job))
+                group.attrs['status'] = status['state']
+                group.attrs['start'] = status['start'] or 0.0
+                group.attrs['end'] = status['end'] or 0.0
+                if os.path.exists(filename):
+                    with h5py.File(filename, 'r') as part:
+                        for key in part:
+                            part.copy(key, group)
+                        copied = all(key in group for key in part)
+                    out.flush()
+                    if copied:
+                        os.remove(filename)
+                    else:
+                        print('Not all of {} was copied into {}; the file is kept'.format(filename, self.output))
+        if not os.listdir(self.partsdir):
+            os.rmdir(self.partsdir)
+        print('Job data merged into {}'.format(self.output))
+
+#Run the jobs of a jobs file
+def runjobs(filename, refresh = 2.0):
+    output, jobs = loadjobs(filename)
+    return Orchestrator(jobs, output, refresh).run()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+"""
+Define live plots for the CFIB control system (requires matplotlib and the NI DAQ)
+"""
+
+####################################################################################################
+# Import modules
+####################################################################################################
+
+import numpy as np #For maths
+import matplotlib.pyplot as plt #For plotting
+from cfib.functions import NI_hardware_addresses #Physical addresses of the NI channels
+from cfib.live import RingBuffer, Decimator, AcquisitionThread #Ring buffers and acquisition threads for live plotting
+from cfib.daq import Counter #NI DAQ counter
+
+####################################################################################################
+# Define functions
+####################################################################################################
+
+####################################################################################################
+#Create a dynamically updating plot
+#Acquisition runs on its own thread at sample_rate; the plot redraws at refresh_rate from a view of the ring buffer
+def makeplot(t_span = 1, sample_rate = 50, refresh_rate = 10, max_points = 2000):
+    # Initialise plot parameters
+    t_points = int(t_span*sample_rate) # Number of samples over the span
+    decimation = int(np.ceil(t_points/max_points)) # Long histories are averaged down to at most max_points
+    plot_points = int(np.ceil(t_points/decimation)) # Number of points drawn
+
+    # Make the figure
+    fig1, ax1 = plt.subplots(1, 1, tight_layout=True)
+    line, = ax1.plot(np.linspace(-t_span, 0, plot_points), np.zeros(plot_points))
+    ax1.set_xlabel('Time (s)')
+    ax1.set_ylabel('Count rate (Hz)')
+    ax1.set_ylim(-100, 2100)
+    ax1.set_xlim(-t_span, 0)
+    ax1.set_title('CEM count rate')
+    ax1.grid()
+
+    # Make the buffer the plot is drawn from
+    history = RingBuffer(plot_points)
+    if decimation > 1:
+        sink = Decimator(decimation, history)
+    else:
+        sink = history
+
+    # Initialise the counts
+    CEM_counts = Counter(NI_hardware_addresses['Counter 2'])
+    # Start the counter
+    CEM_counts.start()
+    # Start the acquisition thread
+    acquisition = AcquisitionThread(CEM_counts.readrate, sample_rate, [sink])
+    acquisition.start()
+
+    def update_data(update_number):
+        line.set_ydata(history.view())  # update the data (no copy, no waiting on the counter)
+        return line,
+
+    # Make the animation
+    import matplotlib.animation as animation
+    print('Plotting CEM count rate. Close figure to end.')
+    ani = animation.FuncAnimation(fig1, update_data, interval=int(1000/refresh_rate), blit=True)
+    # Stop the acquisition when the figure is closed
+    def stop_acquisition(event):
+        acquisition.stop()
+        CEM_counts.close()
+        if acquisition.overruns > 0:
+            print("{} samples were acquired late".format(acquisition.overruns))
+    fig1.canvas.mpl_connect('close_event', stop_acquisition)
+    plt.show()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""
+Define pressure gauge calibrations for the CFIB control system
+
+Calibrations are read from gauge_calibrations.txt (one section per gauge) and are turned into a
+lookup table of log10(pressure) against voltage. Converting a block of samples is then a single
+np.interp over the whole block, whatever the gauge model.
+"""
+
+####################################################################################################
+#Import modules
+####################################################################################################
+import os #Operating system interfacing
+import sys #System-specific parameters
+import time #Time access and conversions
+import configparser #Reads the calibration file
+import numpy as np #For maths
+from cfib.registry import configdir #Location of the configuration files
+
+####################################################################################################
+#Definitions
+####################################################################################################
+
+#Default calibration file
+gaugefile = os.path.join(configdir, 'gauge_calibrations.txt')
+
+####################################################################################################
+#Define classes
+####################################################################################################
+
+####################################################################################################
+# GaugeCalibration class: convert gauge voltages to pressure by interpolating a lookup table
+class GaugeCalibration:
+    # Initialise from a table of voltages and pressures (interpolated linearly in log10(pressure))
+    def __init__(self, name, channel, voltages, pressures, units = 'Torr'):
+        self.name = name #Gauge name (channel name on the monitor stream/log)
+        self.channel = channel #Name of the analogue input in NI_hardware_addresses
+        self.units = units #Pressure units
+        order = np.argsort(voltages)
+        self.voltages = np.asarray(voltages, dtype = np.float64)[order] #Lookup table voltages
+        self.logpressures = np.log10(np.asarray(pressures, dtype = np.float64)[order]) #Lookup table log10(pressure)
+
+    # Make a calibration for a gauge with a logarithmic output: pressure = factor * 10**((V - offset)/volts_per_decade)
+    # log10(pressure) is linear in V so the two-point table is exact over the AI range
+    @classmethod
+    def logarithmic(cls, name, channel, offset, volts_per_decade = 1.0, factor = 1.0, units = 'Torr', vrange = (-10.0, 10.0)):
+        voltages = np.array(vrange, dtype = np.float64)
+        return cls(name, channel, voltages, factor * 10 ** ((voltages - offset)/volts_per_decade), units)
+
+    # Make a calibration from a two-column (voltage, pressure) text file
+    @classmethod
+    def fromtable(cls, name, channel, filename, units = 'Torr'):
+        table = np.loadtxt(filename, delimiter = ',', comments = '#', ndmin = 2)
+        return cls(name, channel, table[:, 0], table[:, 1], units)
+
+    # Convert a voltage or an array of voltages (any shape) to pressure
+    def __call__(self, voltage):
+        return 10 ** np.interp(voltage, self.voltages, self.logpressures)
+
+####################################################################################################
+#Define functions
+####################################################################################################
+
+#Load the gauge calibrations from a file. Returns a list of GaugeCalibration objects in file order
+def loadgauges(filename = gaugefile):
+    config = configparser.ConfigParser(inline_comment_prefixes = ('#',))
+    if not config.read(filename):
+        print("File {} not found".format(filename))
+        return []
+    gauges = []
+    for name in config.sections():
+        section = config[name]
+        model = section.get('model', 'log')
+        units = section.get('units', 'Torr')
+        if model == 'log':
+            gauges.append(GaugeCalibration.logarithmic(name, section['channel'], section.getfloat('offset'),
+                                                       section.getfloat('volts_per_decade', 1.0),
+                                                       section.getfloat('factor', 1.0), units))
+        elif model == 'table':
+            #Tables are found relative to the calibration file
+            table = os.path.join(os.path.dirname(filename), section['table'])
+            gauges.append(GaugeCalibration.fromtable(name, section['channel'], table, units))
+        else:
+            print("Unknown model {} for gauge {}; it must be either log or table".format(model, name))
+    return gauges
+
+#Read all the gauges in one task, printing every 'period' seconds and optionally logging (see logger.py)
+#If the monitor daemon is running it already owns the AI task; use 'cfib monitor view pressure' instead
+def readpressure(period = 1.0, log = False, filename = gaugefile):
+    from cfib.functions import NI_hardware_addresses
+    from cfib.monitor import AIBlock
+
+    gauges = loadgauges(filename)
+    if not gauges:
+        sys.exit("No pressure gauges are defined in {}; add a section for each gauge".format(filename))
+    ai_physchans = [NI_hardware_addresses[g.channel] for g in gauges]
+
+    #One task for all gauges. The read buffer is sized by the number of channels
+    ai_block = AIBlock([g.name for g in gauges], ai_physchans, conversions = gauges, period = period, sample_rate = 100, buffer_size = 1000)
+
+    if log == True:
+        from cfib.logger import TimeSeriesStore
+        store = TimeSeriesStore()
+
+    print('ADC is now measuring...')
+    print('Press Ctrl-C to end. (Or Command + . on OSX)')
+
+    ai_block.start()
+
+    try:
+        while True:
+            time.sleep(period)
+            t, readings = ai_block.read()
+            for g in gauges:
+                if g.name in readings:
+                    print("The measured pressure ({}) is {:0.1e} {}".format(g.name, readings[g.name], g.units))
+                    if log == True:
+                        store.append(g.name, t, readings[g.name])
+            if log == True:
+                store.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ai_block.close()
+        if log == True:
+            store.close()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+"""
+Define a hardware-timed converter from CEM count rate to an analogue voltage
+
+The counter is sampled on the AO sample clock, so the counts and the output share one timebase and
+the loop period is set by the hardware (block/loop_rate) rather than by time.sleep. Each iteration
+reads a block of counter samples, converts them to rate, smooths and autoranges in NumPy and writes
+a block of AO samples. Loop period, processing time and output latency are kept in LoopStats objects.
+The count rate of every sample, corrected for the dead time of the CEM, goes into a CounterStats
+(cfib.counterstats), whose mean, spread and Allan deviation are printed with the rate.
+"""
+
+####################################################################################################
+#Import modules
+####################################################################################################
+import time #Time access and conversions
+import ctypes #Module required for creating C type ojects - required for some PyDAQmx operations
+import numpy as np #For maths
+from scipy.signal import lfilter #Block-wise exponential moving average
+from PyDAQmx import * #PyDAQmx module for working with the NI DAQ
+from cfib.counterstats import CounterStats #Statistics of the count rate
+
+####################################################################################################
+#Define classes
+####################################################################################################
+
+####################################################################################################
+# LoopStats class: running mean, standard deviation, minimum and maximum of a quantity
+class LoopStats:
+    def __init__(self):
+        self.reset()
+
+    # Forget all values
+    def reset(self):
+        self.n = 0 #Number of values
+        self.mean = 0.0 #Running mean
+        self.m2 = 0.0 #Running sum of squared deviations (Welford)
+        self.min = np.inf #Smallest value
+        self.max = -np.inf #Largest value
+
+    # Add a value
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta/self.n
+        self.m2 += delta*(x - self.mean)
+        self.min = min(self.min, x)
+        self.max = max(self.max, x)
+
+    # Standard deviation of the values
+    @property
+    def std(self):
+        return np.sqrt(self.m2/(self.n - 1)) if self.n > 1 else 0.0
+
+    # Summary in ms (the values are stored in seconds)
+    def summary(self):
+        return '{:.3f} +/- {:.3f} ms (min {:.3f}, max {:.3f})'.format(1e3*self.mean, 1e3*self.std, 1e3*self.min, 1e3*self.max)
+
+####################################################################################################
+# RateToAnalogue class: output a voltage proportional to the count rate, with a fixed loop period
+class RateToAnalogue:
+    def __init__(self, ctr_physchan, ao_physchan, loop_rate = 1000, block = 25, prefill = 2,
+                 max_count_rate = 10000, output_time_constant = 0.025, smoothing_time_constant = 1, oversamplelimit = 2, deadtime = 0.0):
+        self.ao_physchan = ao_physchan #Physical address of the analogue output channel
+        self.loop_rate = loop_rate #Sample clock rate shared by the counter and the AO (Hz)
+        self.block = block #Samples per loop iteration; the loop period is block/loop_rate
+        self.prefill = prefill #Blocks of AO written ahead. Output latency is about prefill*block/loop_rate
+        self.max_count_rate = max_count_rate #Count rate giving 10 V (doubled when saturating)
+        self.oversamplelimit = oversamplelimit #Saturated blocks in a row before max_count_rate is doubled
+        self.overcount = 0 #Number of saturated blocks in a row
+        #Exponential moving average coefficients for one sample period
+        self.output_alpha = 1 - np.exp(-1/(loop_rate*output_time_constant)) if output_time_constant > 0 else 1.0
+        self.smoothing_alpha = 1 - np.exp(-1/(loop_rate*smoothing_time_constant))
+        self.output_rate = 0.0 #Smoothed rate driving the output (last sample)
+        self.mooving_ave = 0.0 #Slowly smoothed rate for display (last sample)
+        self.last_count = None #Last raw counter value (32 bit)
+        self.stats = {'period': LoopStats(), 'compute': LoopStats(), 'latency': LoopStats()}
+        self.ratestats = CounterStats(bin_time = 1/loop_rate, deadtime = deadtime) #Statistics of the sample rates
+
+        #Preallocate the buffers used each iteration
+        self.counts = np.zeros(block, dtype = np.uint32)
+        self.output = np.zeros(block, dtype = np.float64)
+        self.read = ctypes.c_int32()
+        self.written = ctypes.c_int32()
+        self.generated = ctypes.c_uint64()
+
+        #AO task: continuous, hardware timed, never regenerates old data (an underflow is an error, not a repeat)
+        device = '/' + ao_physchan.strip('/').split('/')[0]
+        self.ao_task = Task()
+        self.ao_task.CreateAOVoltageChan(ao_physchan, '', -10.0, 10.0, DAQmx_Val_Volts, None)
+        self.ao_task.CfgSampClkTiming('', loop_rate, DAQmx_Val_Rising, DAQmx_Val_ContSamps, 10*block)
+        self.ao_task.SetWriteRegenMode(DAQmx_Val_DoNotAllowRegen)
+        #Counter task: buffered edge counting latched on the AO sample clock
+        self.ctr_task = Task()
+        self.ctr_task.CreateCICountEdgesChan(ctr_physchan, '', DAQmx_Val_Rising, 0, DAQmx_Val_CountUp)
+        self.ctr_task.CfgSampClkTiming(device + '/ao/SampleClock', loop_rate, DAQmx_Val_Rising, DAQmx_Val_ContSamps, 10*block)
+        self.total_written = 0 #AO samples written since the start
+
+    # Write a block of AO samples
+    def writeblock(self, data):
+        self.ao_task.WriteAnalogF64(self.block, 0, 10.0, DAQmx_Val_GroupByChannel, data, ctypes.byref(self.written), None)
+        self.total_written += self.written.value
+
+    # Arm the counter, prefill the AO buffer and start the clock
+    def start(self):
+        self.ctr_task.StartTask()
+        for i in range(self.prefill):
+            self.writeblock(np.zeros(self.block))
+        self.ao_task.StartTask()
+
+    # Convert a block of cumulative counts to rates, update the output and return the output block
+    def process(self, counts):
+        #Unsigned differences are correct across a 32 bit rollover
+        previous = counts[0] if self.last_count == None else self.last_count
+        dcounts = np.diff(counts, prepend = np.uint32(previous))
+        rates = self.ratestats.addcounts(dcounts, 1/self.loop_rate)
+        #Rates beyond the largest the CEM can measure are left uncorrected
+        np.copyto(rates, dcounts*float(self.loop_rate), where = np.isnan(rates))
+        self.last_count = counts[-1]
+        #Smooth the whole block at once
+        output_rates, zi = lfilter([self.output_alpha], [1, self.output_alpha - 1], rates, zi = [(1 - self.output_alpha)*self.output_rate])
+        self.output_rate = output_rates[-1]
+        smoothed, zi = lfilter([self.smoothing_alpha], [1, self.smoothing_alpha - 1], rates, zi = [(1 - self.smoothing_alpha)*self.mooving_ave])
+        self.mooving_ave = smoothed[-1]
+        #Autorange: if the output saturates for oversamplelimit blocks, double the range until the peak fits
+        peak = output_rates.max()
+        if peak > self.max_count_rate:
+            self.overcount += 1
+            if self.overcount >= self.oversamplelimit:
+                self.max_count_rate *= 2 ** np.ceil(np.log2(peak/self.max_count_rate))
+                self.overcount = 0
+        else:
+            self.overcount = 0
+        np.clip(output_rates/self.max_count_rate*10, 0, 10, out = self.output)
+        return self.output
+
+    # Run one iteration: read a block, process it and write a block. Blocks until the counter block is ready
+    def iterate(self):
+        self.ctr_task.ReadCounterU32(self.block, 10.0, self.counts, self.block, ctypes.byref(self.read), None)
+        t_read = time.perf_counter()
+        self.writeblock(self.process(self.counts))
+        t_done = time.perf_counter()
+        #Latency: AO samples queued ahead of the one just written
+        self.ao_task.GetWriteTotalSampPerChanGenerated(ctypes.byref(self.generated))
+        self.stats['compute'].add(t_done - t_read)
+        self.stats['latency'].add((self.total_written - self.generated.value)/self.loop_rate)
+        return t_read
+
+    # Run until interrupted, printing the rate and the loop statistics every print_period seconds
+    def run(self, print_period = 1.0):
+        self.start()
+        print('DAQ is armed and counting...')
+        print('Loop period is {:.1f} ms'.format(1e3*self.block/self.loop_rate))
+        print('Press Ctrl-C to end. (Or Command + . on OSX)')
+        t_old = self.iterate()
+        t_print = t_old
+        try:
+            while True:
+                t_new = self.iterate()
+                self.stats['period'].add(t_new - t_old)
+                t_old = t_new
+                if t_new - t_print > print_period:
+                    t_print = t_new
+                    print('Measured frequency:{:.1f}Hz. Moving ave:{:.0f}Hz. Range:{:.0f}Hz'.format(self.output_rate, self.mooving_ave, self.max_count_rate))
+                    print('  ' + self.ratestats.report())
+                    print('  period {}; compute {}; latency {}'.format(*[self.stats[k].summary() for k in ('period', 'compute', 'latency')]))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    # Zero the output and clear the tasks
+    def close(self):
+        self.ao_task.StopTask()
+        self.ao_task.ClearTask()
+        self.ctr_task.StopTask()
+        self.ctr_task.ClearTask()
+        #The hardware-timed task has gone; leave the output at zero with an on-demand write
+        zero_task = Task()
+        zero_task.CreateAOVoltageChan(self.ao_physchan, '', -10.0, 10.0, DAQmx_Val_Volts, None)
+        zero_task.WriteAnalogF64(1, 1, 10.0, DAQmx_Val_GroupByChannel, np.array(0.0), None, None)
+        zero_task.ClearTask()
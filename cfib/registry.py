@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+"""
+Define the hardware registry for the CFIB control system
+
+The registry loads the NI physical address file, the iCS2 channel table and electrode voltage files
+once, checks them, and keeps forward and reverse dictionaries so every lookup is O(1):
+    NI channel name <-> physical channel        e.g. 'AO01' <-> '/Dev6229/ao0'
+    electrode <-> iCS2 address tuple            e.g. 'e1' <-> ('0', '0', '0')
+    electrode <-> channel ID, limit
+Parsed files are cached (as JSON, keyed by modification time and size) in __cfibcache__ next to the
+file, so other processes reuse the parsed form until the file changes.
+"""
+
+####################################################################################################
+#Import modules
+####################################################################################################
+import os #Operating system interfacing
+import json #Cache file format
+
+####################################################################################################
+#Definitions
+####################################################################################################
+
+#Directory of the configuration files, independent of the current directory
+#(the repository root unless the CFIB_CONFIG environment variable points elsewhere)
+configdir = os.environ.get('CFIB_CONFIG', os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+#Name of the cache directory (made next to each parsed file)
+cachedirname = '__cfibcache__'
+
+#Address keys of an iCS2 channel (line, address, channel)
+addresskeys = ('l', 'a', 'c')
+
+####################################################################################################
+#Define functions
+####################################################################################################
+
+#Parse a two-column text file ("key, value #comment") into a list of [key, value, comment]
+def parsecolumns(filename):
+    rows = []
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            entry, _, comment = line.partition('#')
+            key, _, value = entry.partition(',')
+            rows.append([key.strip(), value.strip(), comment.strip()])
+    return rows
+
+#Return the parsed form of a file, from the cache if the file has not changed since it was cached
+def cachedparse(filename, parser = parsecolumns):
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    stamp = [stat.st_mtime_ns, stat.st_size]
+    cachefile = os.path.join(os.path.dirname(filename), cachedirname, os.path.basename(filename) + '.json')
+    #Use the cache if it matches the file
+    try:
+        with open(cachefile, 'r') as f:
+            cached = json.load(f)
+        if cached['stamp'] == stamp:
+            return cached['data']
+    except (OSError, ValueError, KeyError):
+        pass
+    #Otherwise parse the file and refresh the cache (a read-only directory just means no cache)
+    data = parser(filename)
+    try:
+        os.makedirs(os.path.dirname(cachefile), exist_ok = True)
+        with open(cachefile, 'w') as f:
+            json.dump({'stamp': stamp, 'data': data}, f)
+    except OSError:
+        pass
+    return data
+
+#Convert an iCS2 address ({'l': .., 'a': .., 'c': ..} or a sequence) to a tuple of strings
+def addresstuple(address):
+    if isinstance(address, dict):
+        return tuple(str(address[k]) for k in addresskeys)
+    return tuple(str(x) for x in address)
+
+####################################################################################################
+#Define classes
+####################################################################################################
+
+####################################################################################################
+# Registry class: validated, indexed view of the NI and iCS2 hardware
+class Registry:
+    def __init__(self, chids, chlist, limits, elabels, ni_file = 'NI_physical_addresses.txt'):
+        #NI hardware
+        self.ni_file = os.path.join(configdir, ni_file) #Path of the NI address file
+        self.nichannels = {} #Channel name -> physical channel
+        self.nicomments = {} #Channel name -> comment in the address file
+        self.ninames = {} #Physical channel -> channel name
+        if os.path.exists(self.ni_file):
+            for name, physchan, comment in cachedparse(self.ni_file):
+                self.nichannels[name] = physchan
+                self.nicomments[name] = comment
+                self.ninames[physchan] = name
+        else:
+            print("File {} not found".format(self.ni_file))
+
+        #iCS2 electrodes
+        self.elabels = list(elabels) #Electrode labels in channel order
+        self.chids = dict(zip(elabels, chids)) #Electrode -> channel ID
+        self.limits = dict(zip(elabels, limits)) #Electrode -> voltage limit (the sign is the polarity)
+        self.addresses = dict(zip(elabels, [addresstuple(a) for a in chlist])) #Electrode -> address tuple
+        self.byaddress = {a: e for e, a in self.addresses.items()} #Address tuple -> electrode
+        self.bychid = {c: e for e, c in self.chids.items()} #Channel ID -> electrode
+        self.index = {e: i for i, e in enumerate(self.elabels)} #Electrode -> channel number
+
+        self.problems = self.validate()
+        for problem in self.problems:
+            print("Registry: {}".format(problem))
+
+    # Check the tables for duplicates and inconsistencies. Returns a list of problems (empty if all is well)
+    def validate(self):
+        problems = []
+        if len(self.ninames) != len(self.nichannels):
+            problems.append('a physical channel is listed under more than one name in {}'.format(self.ni_file))
+        for table, name in ((self.chids, 'channel IDs'), (self.limits, 'limits'), (self.addresses, 'addresses')):
+            if len(table) != len(self.elabels):
+                problems.append('there are {} {} for {} electrodes'.format(len(table), name, len(self.elabels)))
+        if len(self.byaddress) != len(self.addresses):
+            problems.append('two electrodes share an iCS2 address')
+        if len(self.bychid) != len(self.chids):
+            problems.append('two electrodes share a channel ID')
+        return problems
+
+    # Physical channel of an NI channel name
+    def physchan(self, name):
+        return self.nichannels[name]
+
+    # NI channel name of a physical channel (None if it is not in the address file)
+    def channelname(self, physchan):
+        return self.ninames.get(physchan)
+
+    # Electrode at an iCS2 address (dict or sequence); None for addresses which are not electrodes
+    def electrode(self, address):
+        try:
+            return self.byaddress.get(addresstuple(address))
+        except KeyError:
+            return None
+
+    # iCS2 address of an electrode as a dict, as used in websocket requests
+    def address(self, electrode):
+        return dict(zip(addresskeys, self.addresses[electrode]))
+
+    # True if the voltage can be set on the electrode (within the limit and of the right polarity)
+    def withinlimit(self, electrode, voltage):
+        limit = self.limits[electrode]
+        return voltage == 0 or (abs(voltage) <= abs(limit) and (voltage > 0) == (limit > 0))
+
+    # Load an electrode voltage file ("e1, 100" per line). Returns {electrode: voltage}; entries which
+    # are not electrodes or are outside the channel limit are reported and left out
+    def loadvoltages(self, filename):
+        voltages = {}
+        for electrode, value, comment in cachedparse(filename):
+            if not electrode.startswith('e'):
+                continue
+            if electrode not in self.index:
+                print("{} in {} is not an electrode".format(electrode, filename))
+                continue
+            voltage = float(value)
+            if self.withinlimit(electrode, voltage):
+                voltages[electrode] = voltage
+            else:
+                print('The set voltage {} for channel {} is outside the channel limit; it must be less than {} V'.format(voltage, self.chids[electrode], self.limits[electrode]))
+        return voltages
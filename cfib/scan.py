@@ -0,0 +1,849 @@
+#!/usr/bin/env python
+
+'''
+scan.py: Stark map scans (wavelength ramp at each of a set of electrode voltages), configured by a TOML spec.
+A. J. McCulloch, October 2019
+
+####################################################################################################
+
+Ported from Field mapping/Stark-mapping_v0.py. The hard coded parameters of that program are the
+defaults below; a spec file only needs to give the values that differ, e.g.
+
+    [hv]
+    min = 1000.0
+    max = 1100.0
+    numpoints = 2
+
+See Field mapping/stark_scan.toml for every setting. Run with 'cfib scan spec.toml'. The iCS2
+password is taken from the CFIB_ICS2_PASSWORD environment variable if set, otherwise it is requested.
+Each slab records the electrode voltage set last loaded on the iCS2 (cfib.voltagesets). With
+[timetag] enabled, the edges are time tagged (cfib.timetag) and a delay histogram is stored per point.
+With [gate] enabled, counts are only accumulated while the gate line is active (e.g. the experiment
+cycle), and the number of gates in each dwell is stored in <slab>_gates.
+With [fieldmap] name set, the field at the interaction region (fieldmap.point, mm) is calculated
+from the field map (cfib.fieldmap) for the recorded voltage set with the scanned electrode at each
+HV value, and stored for every point in <slab>_field (Ex, Ey, Ez in V/cm).
+With [field] enabled, the scan axis is the field strength instead of one electrode voltage: at each
+field (field.min to field.max, V/cm, along field.direction) the voltages of field.electrodes are
+solved (cfib.fieldmap.FieldSolver, within the channel limits) to give that field at points along
+field.line_start to field.line_end, the other electrodes keeping the recorded voltage set. The
+solved voltages of every field are stored in <slab>_voltages before the scan starts.
+With [lockin] enabled, each point is measured with modulated detection (cfib.lockin): lockin.ao is
+square wave or sine modulated at lockin.frequency for the whole periods that fit in the dwell (about
+the wavelength of the point when it is the wavelength AO, otherwise about lockin.offset), the counter
+counts in bins clocked by the AO samples and the AI channels are sampled on the same clock. The
+in-phase and quadrature signals of the count rate (Hz) and of each AI channel (V), and the AI means,
+are stored in <slab>_lockin, and the counts in each phase bin of the period in <slab>_lockin_profile;
+the slab holds the total counts and the modulated time.
+The counter readings are extended to 64 bits (cfib.counterstats), so the counts of a point are right
+across a rollover of the 32 bit counter. The statistics of the count rate of the points (corrected
+for counter.deadtime: mean, spread, Allan deviation and histogram) are written to the group
+<slab>_counterstats at every checkpoint; the counts in the slab are not corrected.
+
+Scans are checkpointed: <slab>_done marks the points measured, and the slab attributes hold the
+spec, the ramps and the checkpoint (status, last point, last AO and HV values), written with a
+flush of the file every output.checkpoint_period seconds, after each electrode voltage and on
+close. 'cfib scan spec.toml --resume [slab]' continues the given slab (by default the latest one
+that is not complete) from its first incomplete point, ramping the wavelength AO from its last
+recorded value.
+
+With output.data_server set (the default), the data file is claimed from the data server
+(cfib.dataserver) while the scan writes it, and the server's clients are answered from the scan's
+open file, so the data can be read (and the scan followed) while it runs.
+
+With output.shared_memory set to a name, every point is also appended to a shared memory ring buffer
+(cfib.live.SharedRingBuffer) of scan_record_dtype records, which notebooks attach to by that name.
+
+Every phase of a point (AO write, settle, counter read, wavemeter wait, AI read, HDF5 write,
+publish, iCS2 request) is timed with cfib.trace, and a table of the spans is printed at the end of
+the scan. With output.trace_file (or 'cfib scan --trace file.json') the spans are also written as a
+Chrome trace.
+'''
+
+####################################################################################################
+# Import modules
+####################################################################################################
+
+from PyDAQmx import * #PyDAQmx module for working with the NI DAQ
+import ctypes #Module required for creating C type ojects - required for some PyDAQmx operations
+import copy #For copying the default spec
+import datetime #For naming the data slabs
+import getpass #Hides inputs when entering passwords
+import os #Operating system interfacing
+import json #Spec and checkpoint attributes
+import time #Time access and conversions
+import numpy as np #For maths
+import h5py #HDF5 file storage
+import requests #For API requests
+import zmq #Used for ZeroMQ distributed messaging (wavemeter and plotter)
+from cfib.voltagesets import defaultstore #Versioned electrode voltage sets
+from cfib.timebase import timebase #Common timebase for the point times
+from cfib.timetag import EdgeTagger, DelayHistogram, timebaserates #Time tagged counting
+from cfib.daq import gatecounter, gatecountertask #Gated counting
+from cfib.trace import tracer, span #Timing of the phases of each point
+from cfib.fieldmap import FieldMap, FieldSolver, linepoints #Field at the interaction region
+from cfib.dataserver import claimfile, releasefile #Serving the data file while it is written
+from cfib.live import SharedRingBuffer #Points in shared memory
+from cfib.counterstats import CountExtender, CounterStats, deadtimemodels #64 bit counts and rate statistics
+from cfib.lockin import LockinAcquisition, waveforms #Modulated detection
+
+####################################################################################################
+# Scan settings
+####################################################################################################
+
+#Default scan spec: one table per section, as in the TOML file
+defaults = {
+    #Input/output physical connections
+    'hardware': {
+        'ao_wavelength': '/Dev6229/ao1',
+        'counter': '/Dev6229/ctr0',
+        'ai': ['/Dev6229/ai2', '/Dev6229/ai3'],
+        'ai_description': ['hv_monitor', 'blue_power_monitor'],
+        'wavemeter_address': 'tcp://192.168.68.43:5678',
+        'plotter_port': '5679',
+    },
+    #Control of the ISEG power supplies
+    'ics2': {
+        'ip': '10.100.12.27', # This is on the UoM network, not atom
+        'user': 'admin',
+        'channel': '/0/3/1/', # The electrode being scanned
+    },
+    #Timing of each point
+    'timing': {
+        'dwell_time': 0.075, # Time spent at a given wavelength
+        'wavelength_stabilisation_time': 0.01, # Time between ramp and data recording
+        'wavelength_max_voltage_jump': 1E-3, # Largest step of the AO when moving between wavelengths
+        'wavelength_jump_period': 0.001, # Controls the sharpness of the transition between wavelength values
+        'hv_settle_time': 1.0, # Time to allow the electrode voltage to change
+    },
+    #Electrode voltages at which scans will be conducted
+    'hv': {
+        'min': 1000.0,
+        'max': 1100.0,
+        'numpoints': 2,
+    },
+    #Wavelength is scanned by putting additional voltage onto the stack; this voltage must be between -1.5 and 1.5 V
+    'wavelength': {
+        'min': -1.5,
+        'max': 1.5,
+        'numpoints': 100,
+        'default': 0.0, # Value to reset the wavelength ramping AO
+    },
+    #Analogue input sampling
+    'ai': {
+        'samples': 100,
+        'sample_rate': 10000,
+        'buffer_size': 10000,
+    },
+    #Time tagged counting: the counts are the stop edges, and a histogram of stop - start delays is stored for every point
+    #(replaces the counter task; the stop counter is usually hardware.counter)
+    'timetag': {
+        'enabled': False,
+        'start_counter': '/Dev6229/ctr1',
+        'start_terminal': '/Dev6229/PFI3', # Default source pin of ctr1
+        'stop_counter': '/Dev6229/ctr0',
+        'stop_terminal': '/Dev6229/PFI8', # Default source pin of ctr0
+        'arm_source': '', # Terminal whose edge starts both taggers together (empty: start in software)
+        'timebase': '80MHzTimebase',
+        'mode': 'previous', # 'previous' (time of flight from the last start) or 'all' (every pair: coincidences)
+        'bin_width': 1e-7, # Seconds
+        'range_min': 0.0,
+        'range_max': 2e-5,
+        'buffer_size': 1000000,
+    },
+    #Gated counting: the counter only counts while the gate terminal is active, and the gates are counted on a second counter
+    #(cannot be used with time tagging, which needs both counters)
+    'gate': {
+        'enabled': False,
+        'terminal': '/Dev6229/PFI0',
+        'active': 'high', # Level of the gate terminal during which edges are counted ('high' or 'low')
+        'counter': '/Dev6229/ctr1', # Counts the gates
+    },
+    #Field at the interaction region from a field map of the electrodes (cfib.fieldmap)
+    'fieldmap': {
+        'name': '', # Field map in field_maps of the configuration directory (empty: do not record the field)
+        'point': [0.0, 0.0, 0.0], # Position of the interaction region in the map (mm)
+    },
+    #Field scans: the scan axis is the field strength, set by solving for the electrode voltages (needs [fieldmap])
+    'field': {
+        'enabled': False,
+        'min': 0.0, # V/cm
+        'max': 500.0,
+        'numpoints': 11,
+        'direction': [0.0, 0.0, 1.0], # Direction of the field
+        'line_start': [0.0, 0.0, -2.0], # The field is set at line_points points from line_start to line_end (mm)
+        'line_end': [0.0, 0.0, 2.0],
+        'line_points': 5,
+        'electrodes': [], # Electrodes varied (empty: every electrode of the field map)
+        'regularisation': 1e-6, # Penalty on the voltages, relative to the squared unit fields
+    },
+    #Modulated (lock-in) detection: an AO channel is modulated during the dwell while the counter counts in bins clocked by the AO,
+    #and the counts and AI channels are demodulated (replaces the counter and AI tasks; cannot be used with time tagging or gating)
+    'lockin': {
+        'enabled': False,
+        'ao': '/Dev6229/ao0', # AO channel modulated (with hardware.ao_wavelength, the detuning is modulated about each wavelength)
+        'ao_min': -1.5, # Limits of the modulated AO (V)
+        'ao_max': 1.5,
+        'offset': 0.0, # Value the modulation is about (V; not used with the wavelength AO)
+        'waveform': 'square', # 'square' or 'sine'
+        'frequency': 1000.0, # Modulation frequency (Hz)
+        'amplitude': 0.01, # Amplitude of the modulation (V)
+        'bins_per_period': 20, # Counter bins per modulation period (a multiple of 4)
+    },
+    #Statistics of the count rate of the points (<slab>_counterstats)
+    'counter': {
+        'deadtime': 0.0, # Dead time of the CEM and discriminator (s) the rates are corrected for
+        'deadtime_model': 'nonparalysable', # 'nonparalysable' or 'paralysable'
+    },
+    'output': {
+        'filename': 'Stark_data.hdf',
+        'checkpoint_period': 30.0, # Seconds between checkpoints (flushes of the file)
+        'trace_file': '', # Chrome trace of the phases of each point (empty: print the summary only)
+        'data_server': 'tcp://127.0.0.1:5681', # Data server to serve the file through while it is written (empty: none)
+        'shared_memory': '', # Name of a shared memory ring buffer receiving every point (empty: none)
+        'shared_length': 100000, # Points kept in the shared memory buffer
+    },
+}
+
+#Layout of the last axis of the data slab
+data_layout = '(voltage, wavelength, (act_voltage, act_wavelength, counts, time_for_counts, hv_monitor, measured_blue_power_input))'
+#Layout of the times of each point (<slab>_times), on the cfib.timebase reference timebase
+time_layout = '(voltage, wavelength, (counts_start, wavelength_received, counts_end))'
+#Record of a point in the shared memory buffer (point as data_layout, times as time_layout, field in V/cm)
+scan_record_dtype = [('hv_idx', 'i4'), ('wavelength_idx', 'i4'), ('point', 'f8', (6,)), ('times', 'f8', (3,)), ('field', 'f8', (3,))]
+
+####################################################################################################
+# Define functions
+####################################################################################################
+
+#Read a TOML scan spec and merge it with the defaults. Unknown sections or keys raise a ValueError
+def loadspec(filename = None):
+    spec = copy.deepcopy(defaults)
+    if filename is None:
+        return spec
+    try:
+        import tomllib #Python 3.11+
+    except ImportError:
+        import tomli as tomllib
+    with open(filename, 'rb') as f:
+        given = tomllib.load(f)
+    for section, values in given.items():
+        if section not in spec or not isinstance(values, dict):
+            raise ValueError("Unknown section [{}] in {}".format(section, filename))
+        unknown = set(values) - set(spec[section])
+        if unknown:
+            raise ValueError("Unknown keys {} in section [{}] of {}".format(sorted(unknown), section, filename))
+        spec[section].update(values)
+    if spec['gate']['enabled'] and spec['timetag']['enabled']:
+        raise ValueError("Gated counting and time tagging cannot both be enabled in {}".format(filename))
+    if spec['field']['enabled'] and not spec['fieldmap']['name']:
+        raise ValueError("A field scan needs a field map ([fieldmap] name) in {}".format(filename))
+    li = spec['lockin']
+    if li['enabled'] and (spec['gate']['enabled'] or spec['timetag']['enabled']):
+        raise ValueError("Modulated detection cannot be used with gated counting or time tagging in {}".format(filename))
+    if li['waveform'] not in waveforms:
+        raise ValueError("Unknown modulation waveform {!r} in {} (use one of {})".format(li['waveform'], filename, waveforms))
+    if li['bins_per_period'] < 4 or li['bins_per_period'] % 4 != 0:
+        raise ValueError("lockin.bins_per_period must be a multiple of 4 in {}".format(filename))
+    #The modulation is about each wavelength on the wavelength AO, otherwise about the offset
+    low, high = (spec['wavelength']['min'], spec['wavelength']['max']) if li['ao'] == spec['hardware']['ao_wavelength'] else (li['offset'], li['offset'])
+    if li['enabled'] and (low - li['amplitude'] < li['ao_min'] or high + li['amplitude'] > li['ao_max']):
+        raise ValueError("The modulation ({} to {} +- {} V) goes outside lockin.ao_min and ao_max in {}".format(low, high, li['amplitude'], filename))
+    if spec['counter']['deadtime_model'] not in deadtimemodels:
+        raise ValueError("Unknown dead time model {!r} in {} (use one of {})".format(spec['counter']['deadtime_model'], filename, deadtimemodels))
+    return spec
+
+#Find a slab to resume in a data file: the given slab, or the latest one that is not complete
+#Returns the spec the slab was started with (merged with the defaults) and the name of the slab
+def resumespec(data_filename, slab = None):
+    with h5py.File(data_filename, 'r') as f:
+        if slab is None:
+            slabs = [name for name in f if 'checkpoint' in f[name].attrs and json.loads(f[name].attrs['checkpoint'])['status'] != 'complete']
+            if not slabs:
+                raise ValueError("No incomplete scan in {}".format(data_filename))
+            slab = max(slabs) # The names sort by start time
+        elif slab not in f or 'checkpoint' not in f[slab].attrs:
+            raise ValueError("No checkpointed scan {} in {}".format(slab, data_filename))
+        given = json.loads(f[slab].attrs['scan_spec'])
+    spec = copy.deepcopy(defaults)
+    for section, values in given.items():
+        spec[section].update(values)
+    return spec, slab
+
+#Format a duration in seconds as hrs/mins/secs
+def formatduration(seconds):
+    return '{}hrs {}mins {}secs'.format(int(seconds//3600), int((seconds % 3600)//60), int(seconds % 60))
+
+####################################################################################################
+# Define classes
+####################################################################################################
+
+####################################################################################################
+# Scan class: set up the hardware, run the scan and store the data in an HDF5 slab
+# slab: name of a checkpointed slab to resume (None for a new scan)
+class Scan:
+    def __init__(self, spec, slab = None):
+        self.spec = spec
+        self.hv_ramp = np.linspace(spec['hv']['min'], spec['hv']['max'], spec['hv']['numpoints']) # Make a list of voltages
+        if spec['field']['enabled']:
+            self.hv_ramp = np.linspace(spec['field']['min'], spec['field']['max'], spec['field']['numpoints']) # Or of fields (V/cm)
+        self.wavelength_ramp = np.linspace(spec['wavelength']['min'], spec['wavelength']['max'], spec['wavelength']['numpoints']) # Make a list of wavelengths
+        self.last_ao_wavelength_val = spec['wavelength']['default']
+        self.last_hv_val = None # Last electrode voltage set
+        self.sessionid = None
+        self.resuming = slab is not None
+        self.dataset_name = slab
+        self.last_point = None # (hv_idx, wavelength_idx) of the last point measured
+        self.status = 'running' # Status recorded in the checkpoint: running, interrupted or complete
+        self.progress = None # Called with (points done, total points) after each point (e.g. by cfib.orchestrate)
+        self.fieldmap = None # Field map of the electrodes (if fieldmap.name is set)
+        self.hv_field = np.full(3, np.nan) # Field at the interaction region at the last electrode voltage (V/cm)
+        self.fieldsolver = None # Solver for the electrode voltages of a field (field scans)
+        self.dataservice = None # Serves the data file to the data server's clients while it is written
+        self.sharedbuffer = None # Shared memory ring buffer of the points (if output.shared_memory is set)
+        self.counterstats = None # Statistics of the count rate of the points
+        self.lockin = None # Modulated acquisition (if lockin.enabled is set)
+        if spec['output']['trace_file']:
+            tracer().record_events = True
+
+    # Get an API key to be used for the rest of session
+    def login(self):
+        ics2 = self.spec['ics2']
+        passwd = os.environ.get('CFIB_ICS2_PASSWORD') or getpass.getpass("Password for iCS2 module:")
+        r = requests.get('http://'+ics2['ip']+'/api/login/'+ics2['user']+'/'+passwd)
+        self.sessionid = r.json()['i']
+        self.apiget = 'http://'+ics2['ip']+'/api/getItem/'+self.sessionid+ics2['channel'] # Shorthand for the scanned channel
+        self.apiset = 'http://'+ics2['ip']+'/api/setItem/'+self.sessionid+ics2['channel']
+
+    # Initialise the data file, tasks and communications
+    def setup(self):
+        hw, ai = self.spec['hardware'], self.spec['ai']
+        self.login()
+
+        # Initialise data file
+        if not self.resuming:
+            timestamp = datetime.datetime.fromtimestamp(time.time())
+            self.dataset_name = 'data_slab_{:d}{:0>2d}{:0>2d}:{:0>2d}:{:0>2d}:{:0>2d}'.format(timestamp.year, timestamp.month, timestamp.day, timestamp.hour, timestamp.minute, timestamp.second)
+        if self.spec['output']['data_server']:
+            self.dataservice = claimfile(self.spec['output']['filename'], self.spec['output']['data_server'])
+            if self.dataservice is None:
+                print('No data server at {}; the data file will not be served during the scan'.format(self.spec['output']['data_server']))
+        self.data_file = h5py.File(self.spec['output']['filename'], 'a')
+        self.dset = self.data_file.require_dataset(self.dataset_name, (len(self.hv_ramp), len(self.wavelength_ramp), 6), 'float64')
+        self.dset.attrs['data_layout'] = data_layout
+        self.tset = self.data_file.require_dataset(self.dataset_name + '_times', (len(self.hv_ramp), len(self.wavelength_ramp), 3), 'float64')
+        self.tset.attrs['data_layout'] = time_layout
+        self.doneset = self.data_file.require_dataset(self.dataset_name + '_done', (len(self.hv_ramp), len(self.wavelength_ramp)), 'bool')
+        self.doneset.attrs['data_layout'] = '(voltage, wavelength) True once measured'
+        self.recordvoltageset()
+        if self.spec['fieldmap']['name']:
+            self.setupfield()
+        self.timetag = self.spec['timetag']['enabled']
+        self.gated = self.spec['gate']['enabled']
+        self.point_gates = 0 # Number of gates in the dwell of the last point
+        self.setupcounterstats()
+        if self.resuming:
+            self.loadcheckpoint()
+        else:
+            self.dset.attrs['scan_spec'] = json.dumps(self.spec)
+            self.dset.attrs['hv_ramp'] = self.hv_ramp
+            self.dset.attrs['wavelength_ramp'] = self.wavelength_ramp
+        self.checkpoint('running')
+        if self.dataservice is not None:
+            self.dataservice.serve(self.data_file)
+        if self.spec['output']['shared_memory']:
+            self.sharedbuffer = SharedRingBuffer(self.spec['output']['shared_memory'], self.spec['output']['shared_length'], scan_record_dtype)
+            self.sharedrecord = np.zeros(1, scan_record_dtype)
+
+        # Initialise HV to the first value still to be measured
+        self.sethv(self.hv_ramp[self.firstincomplete()[0]], settle = False)
+
+        # Initialise wavelength ao (at its last value when resuming, from where it is ramped to the next point)
+        self.ao_wavelength_task = Task()
+        self.ao_wavelength_task.CreateAOVoltageChan(hw['ao_wavelength'], "", self.spec['wavelength']['min'], self.spec['wavelength']['max'], DAQmx_Val_Volts, None)
+        self.writewavelength(self.last_ao_wavelength_val)
+
+        # Initialise Counter (or the time taggers, or the modulated acquisition which also samples the AI)
+        if self.spec['lockin']['enabled']:
+            self.setuplockin()
+        elif self.timetag:
+            self.setuptimetag()
+        else:
+            self.ctrin_mcp_val = (ctypes.c_ulong*1)()
+            self.countextender = CountExtender()
+            self.ctrin_mcp_task = Task()
+            self.ctrin_mcp_task.CreateCICountEdgesChan(hw['counter'], "", DAQmx_Val_Rising, 0, DAQmx_Val_CountUp)
+            if self.gated:
+                self.setupgate()
+
+        # Initialise ai (analogue in)
+        self.samps_per_chan = ai['samples']
+        self.ai_data = np.zeros(self.samps_per_chan*len(hw['ai']), dtype=np.float64)
+        self.ai_read = ctypes.c_int32()
+        self.ai_task = None
+        if self.lockin is None:
+            self.ai_task = Task()
+            self.ai_task.CreateAIVoltageChan(','.join(hw['ai']), '', DAQmx_Val_Cfg_Default, -10.0, 10.0, DAQmx_Val_Volts, None)
+            self.ai_task.CfgSampClkTiming('', ai['sample_rate'], DAQmx_Val_Rising, DAQmx_Val_ContSamps, ai['buffer_size'])
+            self.ai_task.SetReadRelativeTo(DAQmx_Val_MostRecentSamp)
+            self.ai_task.StartTask()
+
+        # Initialise wavemeter communications
+        self.ctx = zmq.Context()
+        self.wavemeter_soc = self.ctx.socket(zmq.SUB)
+        self.wavemeter_soc.setsockopt(zmq.SUBSCRIBE, b'L1')
+        self.wavemeter_soc.connect(hw['wavemeter_address'])
+        self.poller = zmq.Poller()
+        self.poller.register(self.wavemeter_soc, zmq.POLLIN)
+
+        # Test wavemeter communications
+        print('Checking communication with wavemeter...')
+        wavelength = float(self.wavemeter_soc.recv_multipart()[1])
+        if wavelength > 0:
+            print('Communication OK. Wavelength ={:10.6f}nm'.format(wavelength))
+        else:
+            print('Communication OK, but invalid wavelength recieved. Check exposure level.')
+
+        # Initialise plotter server
+        self.plotter_soc = self.ctx.socket(zmq.PUB)
+        self.plotter_soc.hwm = 1
+        self.plotter_soc.bind('tcp://*:' + hw['plotter_port'])
+        time.sleep(1) # Gives subscribers time to bind
+
+        if self.timetag:
+            self.start_tagger.start()
+            self.stop_tagger.start()
+        elif self.lockin is None:
+            if self.gated:
+                self.gate_task.StartTask() # Before the counter, so its first gate is counted
+            self.ctrin_mcp_task.StartTask()
+
+    # Make the start and stop taggers, the delay histogram and the <slab>_histograms dataset
+    def setuptimetag(self):
+        tt = self.spec['timetag']
+        arm_source = tt['arm_source'] or None
+        self.start_tagger = EdgeTagger('start', tt['start_counter'], tt['start_terminal'], tt['timebase'], tt['buffer_size'], arm_source = arm_source)
+        self.stop_tagger = EdgeTagger('stop', tt['stop_counter'], tt['stop_terminal'], tt['timebase'], tt['buffer_size'], arm_source = arm_source)
+        #Bin edges in ticks of the timebase
+        rate = timebaserates[tt['timebase']]
+        width = max(int(round(tt['bin_width']*rate)), 1)
+        edges = np.arange(int(round(tt['range_min']*rate)), int(round(tt['range_max']*rate)) + width, width)
+        self.histogram = DelayHistogram(edges, tt['mode'])
+        self.hset = self.data_file.require_dataset(self.dataset_name + '_histograms', (len(self.hv_ramp), len(self.wavelength_ramp), edges.size - 1), 'int64')
+        self.hset.attrs['data_layout'] = '(voltage, wavelength, delay bin)'
+        self.hset.attrs['edges'] = edges/rate
+        self.hset.attrs['mode'] = tt['mode']
+
+    # Make the modulated acquisition (whole modulation periods filling the dwell) and the <slab>_lockin and
+    # <slab>_lockin_profile datasets
+    def setuplockin(self):
+        hw, li = self.spec['hardware'], self.spec['lockin']
+        periods = max(int(round(self.spec['timing']['dwell_time']*li['frequency'])), 1)
+        self.lockin = LockinAcquisition(li['ao'], hw['counter'], hw['ai'], li['waveform'], li['frequency'], li['amplitude'],
+                                        li['bins_per_period'], periods, li['ao_min'], li['ao_max'])
+        #Modulating the wavelength AO: the on-demand task sets each wavelength, and the modulation is about it
+        self.lockin_wavelength = li['ao'] == hw['ao_wavelength']
+        self.lset = self.data_file.require_dataset(self.dataset_name + '_lockin', (len(self.hv_ramp), len(self.wavelength_ramp), 2 + 3*len(hw['ai'])), 'float64')
+        self.lset.attrs['data_layout'] = '(voltage, wavelength, (counts_I, counts_Q{})) in Hz and V'.format(
+            ''.join(', {0}_I, {0}_Q, {0}_mean'.format(name) for name in hw['ai_description']))
+        self.lset.attrs['waveform'] = li['waveform']
+        self.lset.attrs['frequency'] = li['frequency']
+        self.lset.attrs['amplitude'] = li['amplitude']
+        self.lset.attrs['periods'] = periods
+        self.pset = self.data_file.require_dataset(self.dataset_name + '_lockin_profile', (len(self.hv_ramp), len(self.wavelength_ramp), self.lockin.bins), 'int64')
+        self.pset.attrs['data_layout'] = '(voltage, wavelength, phase bin) counts summed over the periods'
+        self.pset.attrs['reference'] = self.lockin.reference
+        self.pset.attrs['bin_time'] = self.lockin.bin_time
+
+    # Gate the counter, and make the gate counting task and the <slab>_gates dataset
+    def setupgate(self):
+        gate = self.spec['gate']
+        gatecounter(self.ctrin_mcp_task, gate['terminal'], gate['active'])
+        self.gate_task = gatecountertask(gate['counter'], gate['terminal'], gate['active'])
+        self.gate_val = (ctypes.c_ulong*1)()
+        self.gset = self.data_file.require_dataset(self.dataset_name + '_gates', (len(self.hv_ramp), len(self.wavelength_ramp)), 'int64')
+        self.gset.attrs['data_layout'] = '(voltage, wavelength)'
+        self.gset.attrs['terminal'] = gate['terminal']
+        self.gset.attrs['active'] = gate['active']
+
+    # Load the field map, and make the <slab>_field dataset. The field is the sum for the recorded voltage
+    # set with the scanned electrode (the iCS2 channel) at the HV value
+    def setupfield(self):
+        from cfib.functions import registry
+        fm = self.spec['fieldmap']
+        self.fieldmap = FieldMap(fm['name'])
+        if self.spec['field']['enabled']:
+            self.setupfieldscan(registry)
+            return
+        self.field_electrode = registry.electrode([x for x in self.spec['ics2']['channel'].split('/') if x])
+        if self.field_electrode is None:
+            raise ValueError("The scanned iCS2 channel {} is not an electrode".format(self.spec['ics2']['channel']))
+        if self.voltage_set is None:
+            print('WARNING: without a voltage set, the field is calculated with only the scanned electrode')
+        self.field_voltages = {} if self.voltage_set is None else defaultstore().get(self.voltage_set)
+        self.fset = self.data_file.require_dataset(self.dataset_name + '_field', (len(self.hv_ramp), len(self.wavelength_ramp), 3), 'float64')
+        self.fset.attrs['data_layout'] = '(voltage, wavelength, (Ex, Ey, Ez)) in V/cm'
+        self.fset.attrs['fieldmap'] = fm['name']
+        self.fset.attrs['point'] = fm['point']
+        self.fset.attrs['electrode'] = self.field_electrode
+
+    # Solve for the electrode voltages of every field of the ramp (so an unreachable field stops the scan before
+    # it starts), and make the <slab>_field and <slab>_voltages datasets
+    def setupfieldscan(self, registry):
+        fs, fm = self.spec['field'], self.spec['fieldmap']
+        voltages = {} if self.voltage_set is None else defaultstore().get(self.voltage_set)
+        varied = fs['electrodes'] or self.fieldmap.electrodes
+        fixed = {e: v for e, v in voltages.items() if e not in varied}
+        self.fieldsolver = FieldSolver(self.fieldmap, linepoints(fs['line_start'], fs['line_end'], fs['line_points']),
+                                       electrodes = varied, fixed = fixed, regularisation = fs['regularisation'])
+        self.field_addresses = {e: '/'+'/'.join(registry.addresses[e])+'/' for e in self.fieldsolver.electrodes}
+        self.set_voltages = {} # Voltages set on the iCS2 by the field scan
+        self.field_direction = np.asarray(fs['direction'], float)/np.linalg.norm(fs['direction']) # Unit vector
+        self.field_solutions = {} # Field -> voltages
+        solved = np.zeros((len(self.hv_ramp), len(self.fieldsolver.electrodes)))
+        errors = np.zeros(len(self.hv_ramp))
+        for i, value in enumerate(self.hv_ramp):
+            self.field_solutions[float(value)] = self.fieldsolver.solve(value*self.field_direction)
+            solved[i] = [self.field_solutions[float(value)][e] for e in self.fieldsolver.electrodes]
+            errors[i] = self.fieldsolver.error()
+        print('Solved the electrode voltages of {} fields; largest deviation from the target {:.3g} V/cm'.format(len(self.hv_ramp), errors.max()))
+        self.vset = self.data_file.require_dataset(self.dataset_name + '_voltages', solved.shape, 'float64')
+        self.vset[...] = solved
+        self.vset.attrs['data_layout'] = '(field, electrode) in V'
+        self.vset.attrs['electrodes'] = self.fieldsolver.electrodes
+        self.vset.attrs['fixed'] = json.dumps(fixed)
+        self.vset.attrs['deviation'] = errors
+        self.fset = self.data_file.require_dataset(self.dataset_name + '_field', (len(self.hv_ramp), len(self.wavelength_ramp), 3), 'float64')
+        self.fset.attrs['data_layout'] = '(field, wavelength, (Ex, Ey, Ez)) in V/cm'
+        self.fset.attrs['fieldmap'] = fm['name']
+        self.fset.attrs['point'] = fm['point']
+
+    # Set the electrode voltages of a field (V/cm) of a field scan; only the voltages that change are sent
+    def setfield(self, value):
+        voltages = self.field_solutions.get(float(value))
+        if voltages is None:
+            voltages = self.fieldsolver.solve(value*self.field_direction)
+        for e in self.fieldsolver.electrodes:
+            if self.set_voltages.get(e) != voltages[e]:
+                with span('ics2 request'):
+                    requests.get('http://'+self.spec['ics2']['ip']+'/api/setItem/'+self.sessionid+self.field_addresses[e]+'Control.voltageSet/'+str(voltages[e])+'/V')
+                self.set_voltages[e] = voltages[e]
+        self.hv_field = self.fieldmap.fieldat(voltages, self.spec['fieldmap']['point'])
+
+    # Record the electrode voltage set on the iCS2 (the last one loaded, see cfib.voltagesets) in the slab
+    def recordvoltageset(self):
+        store = defaultstore()
+        self.voltage_set = store.applied()
+        if self.voltage_set is None:
+            print('No electrode voltage set has been loaded; the slab will not record one')
+            return
+        recorded = self.dset.attrs.get('voltage_set_hash')
+        if self.resuming and recorded is not None:
+            if recorded != self.voltage_set:
+                print('WARNING: the electrode voltage set has changed since the scan started; the slab keeps the original one')
+            return
+        store.attach(self.dset, self.voltage_set)
+        store.recordrun(self.dataset_name, self.voltage_set)
+
+    # Start the statistics of the count rate of the points, continuing those of the slab when resuming
+    def setupcounterstats(self):
+        ctr = self.spec['counter']
+        self.counterstats = CounterStats(bin_time = self.spec['timing']['dwell_time'], deadtime = ctr['deadtime'], model = ctr['deadtime_model'])
+        name = self.dataset_name + '_counterstats'
+        if self.resuming and name in self.data_file:
+            self.counterstats.load(self.data_file[name])
+
+    # Write the checkpoint to the slab attributes and flush the file, so the data and the done mask on disk agree
+    def checkpoint(self, status = None):
+        self.status = status or self.status
+        hv_idx, wavelength_idx = self.last_point if self.last_point is not None else (None, None)
+        self.dset.attrs['checkpoint'] = json.dumps({
+            'status': self.status,
+            'hv_idx': hv_idx,
+            'wavelength_idx': wavelength_idx,
+            'points_done': int(np.count_nonzero(self.doneset[...])),
+            'last_ao_wavelength_val': float(self.last_ao_wavelength_val),
+            'last_hv_val': None if self.last_hv_val is None else float(self.last_hv_val),
+            'time': time.time(),
+        })
+        self.counterstats.save(self.data_file, self.dataset_name + '_counterstats')
+        self.data_file.flush()
+        self.last_checkpoint = time.time()
+
+    # Read the checkpoint of the slab being resumed, checking it was made with the same ramps
+    def loadcheckpoint(self):
+        for name, ramp in (('hv_ramp', self.hv_ramp), ('wavelength_ramp', self.wavelength_ramp)):
+            if not np.array_equal(self.dset.attrs[name], ramp):
+                raise ValueError("The {} of slab {} does not match its spec".format(name, self.dataset_name))
+        state = json.loads(self.dset.attrs['checkpoint'])
+        self.last_ao_wavelength_val = state['last_ao_wavelength_val']
+        self.last_hv_val = state['last_hv_val']
+        if state['hv_idx'] is not None:
+            self.last_point = (state['hv_idx'], state['wavelength_idx'])
+        print('Resuming {}: {} of {} points done, status {}'.format(self.dataset_name, state['points_done'], self.doneset.size, state['status']))
+
+    # Indices (hv_idx, wavelength_idx) of the first point not measured ((0, 0) if all are done)
+    def firstincomplete(self):
+        todo = np.argwhere(~self.doneset[...])
+        return tuple(todo[0]) if len(todo) > 0 else (0, 0)
+
+    # Write a value to the wavelength AO
+    def writewavelength(self, value):
+        self.ao_wavelength_task.WriteAnalogF64(1, 1, 10.0, DAQmx_Val_GroupByChannel, np.array(float(value)), None, None)
+
+    # Ramp to the desired wavelength with small steps, then set the actual value
+    def setwavelength(self, value):
+        timing = self.spec['timing']
+        step = np.sign(value - self.last_ao_wavelength_val)*timing['wavelength_max_voltage_jump']
+        with span('ao write'):
+            if step != 0:
+                for safety_val in np.arange(self.last_ao_wavelength_val, value, step):
+                    self.writewavelength(safety_val)
+                    time.sleep(timing['wavelength_jump_period'])
+            self.writewavelength(value)
+        self.last_ao_wavelength_val = value
+
+    # Set the electrode voltage (or the field, for field scans) and wait for it to change
+    def sethv(self, value, settle = True):
+        if self.fieldsolver is not None:
+            self.setfield(value)
+        else:
+            with span('ics2 request'):
+                requests.get(self.apiset+'Control.voltageSet/'+str(value)+'/V')
+        self.last_hv_val = value
+        if self.fieldmap is not None and self.fieldsolver is None:
+            self.field_voltages[self.field_electrode] = value
+            self.hv_field = self.fieldmap.fieldat(self.field_voltages, self.spec['fieldmap']['point'])
+        if settle:
+            with span('hv settle'):
+                time.sleep(self.spec['timing']['hv_settle_time'])
+
+    # Read the wavelength once the queue has been emptied
+    def readwavelength(self):
+        while True:
+            poll_dict = dict(self.poller.poll(0))
+            if self.wavemeter_soc in poll_dict and poll_dict[self.wavemeter_soc] == zmq.POLLIN:
+                # recieve message straight away just to remove it from the queue
+                self.wavemeter_soc.recv_multipart()
+            else:
+                # when queue is empty, wait for the next message to come through, and use that one
+                return float(self.wavemeter_soc.recv_multipart()[1])
+
+    # Read the counter. When time tagging, read the taggers into the histogram and return the number of stop edges
+    def readcounter(self):
+        if self.timetag:
+            self.histogram.add(self.start_tagger.read(), self.stop_tagger.read())
+            return float(self.stop_tagger.events)
+        self.ctrin_mcp_task.ReadCounterScalarU32(10.0, self.ctrin_mcp_val, None)
+        return float(self.countextender.extend(self.ctrin_mcp_val[0]))
+
+    # Read the number of gates since the start (0 when not gating)
+    def readgates(self):
+        if not self.gated:
+            return 0
+        self.gate_task.ReadCounterScalarU32(10.0, self.gate_val, None)
+        return int(self.gate_val[0])
+
+    # Read analogue voltages, returning the mean of each channel in a dictionary
+    def readai(self):
+        self.ai_task.ReadAnalogF64(self.samps_per_chan, 10.0, DAQmx_Val_GroupByChannel, self.ai_data, len(self.ai_data), ctypes.byref(self.ai_read), None)
+        means = self.ai_data.reshape(-1, self.samps_per_chan).mean(axis = 1)
+        return dict(zip(self.spec['hardware']['ai_description'], means))
+
+    # Measure a single point of the scan (wavelength already set): counts over the dwell, wavelength and ai halfway through
+    # Returns the data and the times (counts start, wavelength received, counts end) on the common timebase;
+    # when gating, the number of gates in the dwell is left in point_gates
+    def measurepoint(self, ao_hv_val):
+        dwell_time = self.spec['timing']['dwell_time']
+        now = timebase().now
+        with span('settle'):
+            time.sleep(self.spec['timing']['wavelength_stabilisation_time'])
+        # Read initial counts
+        t0 = now()
+        with span('counter read'):
+            ctrin_mcp_val0 = self.readcounter()
+            gates0 = self.readgates()
+        if self.timetag:
+            self.histogram.reset() # Only edges during the dwell go in the point's histogram
+        with span('dwell'):
+            time.sleep(dwell_time/2) # to attempt to read wavelength in the middle of the aquisition period
+        with span('wavemeter wait'):
+            wavelength = self.readwavelength()
+        t_wavelength = now()
+        with span('ai read'):
+            ai_means = self.readai()
+        time_remaining_in_dwell = dwell_time - (now() - t0)
+        if time_remaining_in_dwell > 0:
+            with span('dwell'):
+                time.sleep(time_remaining_in_dwell)
+        # Read final counts
+        t1 = now()
+        with span('counter read'):
+            ctrin_mcp_val1 = self.readcounter()
+            self.point_gates = self.readgates() - gates0
+        measured_hv_input = ao_hv_val
+        point = np.array((ao_hv_val, wavelength, ctrin_mcp_val1 - ctrin_mcp_val0, t1 - t0, measured_hv_input, ai_means.get('blue_power_monitor', np.nan)))
+        return point, np.array((t0, t_wavelength, t1))
+
+    # Measure a single point with modulated detection (wavelength already set): the modulation runs for the whole periods
+    # filling the dwell, and the wavelength is read halfway through. Returns the data (the counts are the total in the bins,
+    # the time the modulated time) and the times as measurepoint; the demodulated signals are left in point_lockin and the
+    # counts per phase bin in point_profile
+    def measurelockinpoint(self, ao_hv_val):
+        now = timebase().now
+        with span('settle'):
+            time.sleep(self.spec['timing']['wavelength_stabilisation_time'])
+        if self.lockin_wavelength:
+            # The on-demand wavelength task gives the channel to the modulation until the next wavelength
+            self.ao_wavelength_task.TaskControl(DAQmx_Val_Task_Unreserve)
+            offset = self.last_ao_wavelength_val
+        else:
+            offset = self.spec['lockin']['offset']
+        t0 = now()
+        with span('ao write'):
+            self.lockin.start(offset)
+        with span('dwell'):
+            time.sleep(self.lockin.duration/2)
+        with span('wavemeter wait'):
+            wavelength = self.readwavelength()
+        t_wavelength = now()
+        with span('counter read'):
+            self.lockin.finish()
+        t1 = now()
+        with span('demodulate'):
+            counts, self.point_profile, rate_iq, ai = self.lockin.demodulate()
+        self.point_lockin = np.concatenate((rate_iq, ai.ravel()))
+        ai_means = dict(zip(self.spec['hardware']['ai_description'], ai[:, 2]))
+        point = np.array((ao_hv_val, wavelength, counts, self.lockin.duration, ao_hv_val, ai_means.get('blue_power_monitor', np.nan)))
+        return point, np.array((t0, t_wavelength, t1))
+
+    # Run the scan over all electrode voltages and wavelengths
+    # Points already done (when resuming) are skipped
+    def run(self):
+        print('Generating ramps and receiving counts....')
+        start_time = time.time()
+        done = self.doneset[...]
+        points_todo = np.count_nonzero(~done)
+        points_measured = 0
+        for hv_idx, ao_hv_val in enumerate(self.hv_ramp):
+            if done[hv_idx].all():
+                continue
+            print('Electrode control voltage ={:.4f}, Ramp value {:d} of {:d}'.format(ao_hv_val, hv_idx + 1, len(self.hv_ramp)))
+            online_plotter_refresh = 1
+            self.sethv(ao_hv_val)
+            for wavelength_idx, ao_wavelength_val in enumerate(self.wavelength_ramp):
+                if done[hv_idx, wavelength_idx]:
+                    continue
+                point_start = tracer().clock()
+                self.setwavelength(ao_wavelength_val)
+                point, times = self.measurepoint(ao_hv_val) if self.lockin is None else self.measurelockinpoint(ao_hv_val)
+                self.counterstats.addcount(point[2], point[3])
+                # Save data locally for later, and send it to a plotter for immeadiate visulation
+                with span('hdf5 write'):
+                    self.dset[hv_idx, wavelength_idx, :] = point
+                    self.tset[hv_idx, wavelength_idx, :] = times
+                    if self.timetag:
+                        self.hset[hv_idx, wavelength_idx, :] = self.histogram.flush()
+                    if self.gated:
+                        self.gset[hv_idx, wavelength_idx] = self.point_gates
+                    if self.fieldmap is not None:
+                        self.fset[hv_idx, wavelength_idx, :] = self.hv_field
+                    if self.lockin is not None:
+                        self.lset[hv_idx, wavelength_idx, :] = self.point_lockin
+                        self.pset[hv_idx, wavelength_idx, :] = self.point_profile
+                    self.doneset[hv_idx, wavelength_idx] = True
+                if self.sharedbuffer is not None:
+                    self.sharedrecord[0] = (hv_idx, wavelength_idx, point, times, self.hv_field)
+                    self.sharedbuffer.append(self.sharedrecord)
+                self.last_point = (hv_idx, wavelength_idx)
+                points_measured += 1
+                if time.time() - self.last_checkpoint > self.spec['output']['checkpoint_period']:
+                    with span('checkpoint'):
+                        self.checkpoint()
+                _, wavelength, dcounts, dt, measured_hv_input, measured_blue_power_input = point
+                with span('publish'):
+                    self.plotter_soc.send_multipart([str(x).encode() for x in ('data', measured_hv_input, wavelength, dcounts, dt, online_plotter_refresh, measured_blue_power_input)])
+                online_plotter_refresh = 0
+                tracer().record('point', point_start)
+                if self.progress is not None:
+                    self.progress(done.size - points_todo + points_measured, done.size)
+            with span('checkpoint'):
+                self.checkpoint()
+            # Print update to the terminal every so often
+            time_so_far = time.time() - start_time
+            est_time_remaining = time_so_far/(points_measured/points_todo) - time_so_far
+            print('########################################################')
+            print(self.counterstats.report())
+            print('Est. time remaining = ' + formatduration(est_time_remaining))
+        self.checkpoint('complete')
+        print('Experiment complete.')
+        print('Total time taken = ' + formatduration(time.time() - start_time))
+
+    # Print the time spent in each phase, and write the trace if one was requested
+    def reporttiming(self):
+        tracer().report()
+        if self.spec['output']['trace_file']:
+            tracer().exportchrome(self.spec['output']['trace_file'])
+
+    # Return the wavelength and electrode voltage to default values, close the file and clear the tasks
+    # (the timing of the phases is reported here, so it is also reported for interrupted scans)
+    def close(self):
+        if self.lockin is not None:
+            self.lockin.close() # First, so the wavelength AO is free to ramp back
+        print('Ramping back to default wavelength and electrode voltage')
+        self.setwavelength(self.spec['wavelength']['default'])
+        self.sethv(self.hv_ramp[0], settle = False)
+        self.checkpoint('complete' if self.status == 'complete' else 'interrupted')
+        if self.dataservice is not None:
+            self.dataservice.detach()
+        self.data_file.close()
+        if self.dataservice is not None:
+            releasefile(self.spec['output']['filename'], self.spec['output']['data_server'])
+            self.dataservice.stop()
+        for task in (self.ao_wavelength_task, self.ai_task):
+            if task is not None:
+                task.StopTask()
+                task.ClearTask()
+        if self.timetag:
+            self.start_tagger.close()
+            self.stop_tagger.close()
+        elif self.lockin is None:
+            self.ctrin_mcp_task.StopTask()
+            self.ctrin_mcp_task.ClearTask()
+            if self.gated:
+                self.gate_task.StopTask()
+                self.gate_task.ClearTask()
+        self.plotter_soc.close()
+        self.wavemeter_soc.close()
+        if self.sharedbuffer is not None:
+            self.sharedbuffer.close()
+        self.reporttiming()
+
+#Run a scan from a spec file. resume = '' continues the latest incomplete slab in the data file, or the slab of that name
+#trace_file overrides output.trace_file of the spec
+def runscan(filename = None, resume = None, trace_file = None):
+    spec, slab = loadspec(filename), None
+    if resume is not None:
+        data_filename = spec['output']['filename']
+        spec, slab = resumespec(data_filename, resume or None)
+        spec['output']['filename'] = data_filename
+    if trace_file is not None:
+        spec['output']['trace_file'] = trace_file
+    scan = Scan(spec, slab)
+    scan.setup()
+    try:
+        scan.run()
+    finally:
+        scan.close()
+    return scan.dataset_name
+
+####################################################################################################
+####################################################################################################
+# Code starts here
+####################################################################################################
+####################################################################################################
+
+# Execute the scans
+if __name__ == '__main__':
+    import sys
+    runscan(sys.argv[1] if len(sys.argv) > 1 else None)
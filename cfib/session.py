@@ -0,0 +1,609 @@
+#!/usr/bin/env python
+
+"""
+session.py: Record the hardware traffic of a session and replay it later without the hardware
+
+record(filename) replaces the hardware modules in sys.modules with recording wrappers around them:
+    PyDAQmx     every call of every Task, with the contents of its array and ctypes arguments after
+                the call (the samples read, the values written)
+    websocket   every frame sent to and received from the iCS2
+    requests    every HTTP API request to the iCS2 and its reply
+    zmq         every message received on a SUB socket (the wavemeter and the monitor stream) and
+                every poll of a SUB socket
+Each event is stamped with the time since the start of the session and appended to a compact binary
+log. Passwords are not recorded (the login frames and URLs are redacted).
+
+replay(filename, speed) installs modules which play the log back instead: a Task made in the same
+order as in the recording gets the same results for the same calls, with the recorded samples
+copied into the caller's buffers; websocket, HTTP and SUB socket reads return the recorded replies.
+With speed 1 each result is returned no earlier than it was in the recording (the waits for the
+hardware are kept); at other speeds the recorded times and the sleeps of the code (dwell times,
+settling times) are scaled, and with speed None every result is returned at once and nothing sleeps,
+so a session runs as fast as the code allows. Times the code measures itself (e.g. the dwell time of
+each scan point) are those of the replay; everything read from the hardware is as recorded. Only the
+sleeps of the cfib modules are scaled, and time.sleep is restored when the replay is closed. A replay
+that asks for something else than the recording did (the code or the spec has changed) raises a
+ReplayError. Neither PyDAQmx nor websocket needs to be installed to replay.
+
+Both must be called before the cfib modules which use the hardware are imported. From the command
+line (cfib.cli imports them lazily):
+
+    cfib record session.cfiblog scan spec.toml
+    cfib replay [--speed max] session.cfiblog scan spec.toml
+    cfib replay session.cfiblog                     (prints the streams of the log)
+
+Sessions are recorded in one process (the jobs of cfib run are separate processes and are not).
+
+Log format: an 8 byte magic and a uint32 version, then records of (time since the start float64,
+stream uint16, kind uint8, payload length uint32) and the payload. Stream 0 is the session itself; a
+NEW record introduces every other stream (a task, websocket, HTTP session or socket). Payloads are a
+JSON header followed by raw buffers.
+"""
+
+####################################################################################################
+#Import modules
+####################################################################################################
+import os #Operating system interfacing
+import re #Redaction of passwords in URLs
+import sys #System-specific parameters
+import json #Payload headers
+import time #Time access and conversions
+import types #For making the replacement modules
+import ctypes #Buffers of the DAQmx calls
+import struct #Record headers
+import atexit #The log is closed when the process ends
+import threading #The log is written from several threads
+import collections #Queues of the events of each stream
+import numpy as np #For maths
+import zmq #ZMQ messaging
+
+####################################################################################################
+#Definitions
+####################################################################################################
+
+#Start of a session log and its version
+logmagic = b'CFIBSESS'
+logversion = 1
+
+#Header of each record: time since the start (s), stream, kind, payload length
+recordhead = struct.Struct('<dHBI')
+
+#Kinds of record
+NEW, CALL, SEND, RECV, POLL, META = range(6)
+kindnames = {NEW: 'new', CALL: 'call', SEND: 'send', RECV: 'recv', POLL: 'poll', META: 'meta'}
+
+#Modules which import the hardware modules (they must be imported after record or replay)
+hardwaremodules = ('cfib.daq', 'cfib.iseg', 'cfib.scan', 'cfib.lockin', 'cfib.wavemeter', 'cfib.monitor', 'cfib.rateoutput',
+                   'cfib.timetag', 'cfib.dataserver', 'cfib.interlock', 'cfib.plotting')
+
+#The session being recorded or replayed (None when the hardware is used directly)
+_session = None
+
+####################################################################################################
+#Define functions
+####################################################################################################
+
+#Pack a JSON header and a list of buffers into a payload
+def packpayload(header, buffers = ()):
+    head = json.dumps(header).encode()
+    parts = [struct.pack('<II', len(head), len(buffers)), head]
+    for b in buffers:
+        b = bytes(b)
+        parts += [struct.pack('<I', len(b)), b]
+    return b''.join(parts)
+
+#Unpack a payload into its header and list of buffers
+def unpackpayload(payload):
+    nhead, nbuffers = struct.unpack_from('<II', payload)
+    offset = 8 + nhead
+    header = json.loads(payload[8:offset])
+    buffers = []
+    for i in range(nbuffers):
+        n, = struct.unpack_from('<I', payload, offset)
+        buffers.append(payload[offset + 4:offset + 4 + n])
+        offset += 4 + n
+    return header, buffers
+
+#Read a session log: yields (time, stream, kind, payload)
+def readlog(filename):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if data[:len(logmagic)] != logmagic:
+        raise ValueError("{} is not a session log".format(filename))
+    offset = len(logmagic) + 4
+    while offset < len(data):
+        t, stream, kind, n = recordhead.unpack_from(data, offset)
+        offset += recordhead.size
+        yield t, stream, kind, data[offset:offset + n]
+        offset += n
+
+#The buffer of a DAQmx call argument: NumPy arrays, ctypes arrays and values, and byref() of them (None otherwise)
+def argbuffer(arg):
+    if isinstance(arg, (np.ndarray, ctypes.Array, ctypes._SimpleCData)):
+        return arg
+    obj = getattr(arg, '_obj', None) #ctypes.byref
+    if isinstance(obj, (ctypes.Array, ctypes._SimpleCData)):
+        return obj
+    return None
+
+#Copy recorded bytes into a buffer from argbuffer
+def copyinto(buffer, data):
+    if isinstance(buffer, np.ndarray):
+        np.copyto(buffer, np.frombuffer(data, dtype = buffer.dtype).reshape(buffer.shape))
+    else:
+        ctypes.memmove(ctypes.addressof(buffer), data, min(len(data), ctypes.sizeof(buffer)))
+
+#Remove the password from an iCS2 websocket login frame
+def redactframe(packet):
+    if isinstance(packet, str) and '"login"' in packet:
+        try:
+            message = json.loads(packet)
+        except ValueError:
+            return packet
+        if message.get('t') == 'login' and isinstance(message.get('c'), dict):
+            message['c'] = dict(message['c'], p = '')
+            return json.dumps(message)
+    return packet
+
+#Remove the password from an iCS2 HTTP API login URL
+def redacturl(url):
+    return re.sub(r'(/api/login/[^/]+/)[^/?]*', r'\1', url)
+
+#Check no module using the hardware has been imported yet
+def checknotimported():
+    for name in hardwaremodules:
+        if name in sys.modules:
+            raise RuntimeError("{} was imported before the session was installed".format(name))
+
+#Record the hardware traffic of this process to filename
+def record(filename):
+    global _session
+    checknotimported()
+    modules = {}
+    for name in ('PyDAQmx', 'websocket', 'requests'):
+        try:
+            modules[name] = __import__(name)
+        except (ImportError, NotImplementedError):
+            pass #Not used by this process
+    _session = Recorder(filename)
+    daqmx = modules.get('PyDAQmx')
+    _session.write(0, META, packpayload({'time': time.time(), 'argv': sys.argv,
+                   'daqmx': {k: v for k, v in vars(daqmx).items() if k.startswith('DAQmx_') and isinstance(v, int)} if daqmx else {}}))
+    if daqmx is not None:
+        sys.modules['PyDAQmx'] = recordingdaqmx(daqmx)
+    if 'websocket' in modules:
+        sys.modules['websocket'] = recordingwebsocket(modules['websocket'])
+    if 'requests' in modules:
+        sys.modules['requests'] = recordingrequests(modules['requests'])
+    sys.modules['zmq'] = sessionzmq(zmq, RecordingSocket, RecordingPoller)
+    atexit.register(_session.close)
+    return _session
+
+#Replay the session log filename in this process. speed: 1 for the recorded timing, None for as fast as possible
+def replay(filename, speed = 1.0):
+    global _session
+    checknotimported()
+    _session = Replayer(filename, speed)
+    sys.modules['PyDAQmx'] = replaydaqmx(_session.meta.get('daqmx', {}))
+    sys.modules['websocket'] = replaywebsocket()
+    sys.modules['requests'] = replayrequests()
+    sys.modules['zmq'] = sessionzmq(zmq, ReplaySocket, ReplayPoller)
+    #The password is not in the log, and the replayed iCS2 does not check it
+    os.environ.setdefault('CFIB_ICS2_PASSWORD', 'replay')
+    if speed != 1:
+        _session.scalesleeps()
+    atexit.register(_session.close)
+    return _session
+
+#Make a time.sleep which scales the sleeps of the cfib modules (except this one, whose waits are already
+#scaled) by the replay speed (speed None: they only yield to other threads); other sleeps are left alone
+def scaledsleep(sleep, speed):
+    def scaled(seconds):
+        caller = sys._getframe(1).f_globals.get('__name__', '')
+        if caller.startswith('cfib.') and caller != __name__:
+            seconds = seconds/speed if speed else 0
+        sleep(seconds)
+    return scaled
+
+#Print the streams of a session log and the number of events of each
+def printlog(filename):
+    streams = {0: 'session'}
+    counts = collections.Counter()
+    last = 0.0
+    for t, stream, kind, payload in readlog(filename):
+        last = max(last, t)
+        if kind == NEW:
+            header, _ = unpackpayload(payload)
+            streams[stream] = '{} {}'.format(header['type'], header.get('info') or '')
+        elif kind == META:
+            meta, _ = unpackpayload(payload)
+            print('Recorded {} ({})'.format(timestampconvert(meta['time']), ' '.join(meta['argv'])))
+        else:
+            counts[stream, kind] += 1
+    print('{:.1f} s, {} streams'.format(last, len(streams) - 1))
+    for stream, name in sorted(streams.items()):
+        events = ', '.join('{} {}'.format(n, kindnames[kind]) for (s, kind), n in sorted(counts.items()) if s == stream)
+        if events:
+            print('{:>4d} {:<40s} {}'.format(stream, name, events))
+
+#UTC time string of a UNIX time (as cfib.functions.timestampconvert, without importing the registry)
+def timestampconvert(unixts):
+    return time.strftime('%Y-%m-%d %H:%M:%S (UTC)', time.gmtime(unixts))
+
+####################################################################################################
+#Define classes
+####################################################################################################
+
+#Error of a replay which no longer follows its recording
+class ReplayError(RuntimeError):
+    pass
+
+#Error raised in a replay where the recorded call raised one
+class ReplayedError(RuntimeError):
+    pass
+
+####################################################################################################
+# Recorder class: writes the events of the session to the log
+class Recorder:
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'wb')
+        self.file.write(logmagic + struct.pack('<I', logversion))
+        self.start = time.perf_counter() #Times are relative to the start of the session
+        self.streams = 0 #Streams made so far
+        self.lock = threading.Lock()
+        self.replaying = False
+
+    # Start a new stream of the given type, returning its number
+    def newstream(self, streamtype, info = None):
+        with self.lock:
+            self.streams += 1
+            stream = self.streams
+        self.write(stream, NEW, packpayload({'type': streamtype, 'info': info}))
+        return stream
+
+    # Append an event to the log
+    def write(self, stream, kind, payload):
+        t = time.perf_counter() - self.start
+        with self.lock:
+            if self.file is not None:
+                self.file.write(recordhead.pack(t, stream, kind, len(payload)) + payload)
+
+    # Close the log
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+####################################################################################################
+# Replayer class: hands out the recorded events of each stream in order, at the recorded times
+class Replayer:
+    def __init__(self, filename, speed = 1.0):
+        self.filename = filename
+        self.speed = speed #Replay speed (None: as fast as possible)
+        self.events = collections.defaultdict(collections.deque) #Stream -> (time, kind, payload)
+        self.types = {} #Stream -> type
+        self.meta = {}
+        for t, stream, kind, payload in readlog(filename):
+            if kind == NEW:
+                self.types[stream] = unpackpayload(payload)[0]['type']
+            elif kind == META:
+                self.meta = unpackpayload(payload)[0]
+            else:
+                self.events[stream].append((t, kind, payload))
+        self.streams = 0 #Streams made so far
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.replaying = True
+        self.sleep = None #The time.sleep replaced by scalesleeps (None when it is not replaced)
+
+    # Start a new stream, which must be of the type recorded for it
+    def newstream(self, streamtype, info = None):
+        with self.lock:
+            self.streams += 1
+            stream = self.streams
+        if self.types.get(stream) != streamtype:
+            raise ReplayError("Stream {} ({}) was a {} in the recording".format(stream, streamtype, self.types.get(stream)))
+        return stream
+
+    # Next event of a stream, which must be of the given kind; waits until its recorded time at the replay speed
+    # Returns the payload unpacked
+    def next(self, stream, kind, what = ''):
+        try:
+            t, recorded, payload = self.events[stream].popleft()
+        except IndexError:
+            raise ReplayError("The recording of stream {} ({}) has ended ({})".format(stream, self.types.get(stream), what))
+        if recorded != kind:
+            raise ReplayError("Stream {} ({}) recorded a {} where the replay asks for a {} ({})".format(
+                stream, self.types.get(stream), kindnames[recorded], kindnames[kind], what))
+        if self.speed:
+            delay = self.start + t/self.speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        return unpackpayload(payload)
+
+    # Kind of the next event of a stream (None at the end)
+    def peek(self, stream):
+        events = self.events[stream]
+        return events[0][1] if events else None
+
+    # Scale the sleeps of the cfib modules by the replay speed until the replay is closed
+    def scalesleeps(self):
+        if self.sleep is None:
+            self.sleep = time.sleep
+            time.sleep = scaledsleep(self.sleep, self.speed)
+
+    # Restore time.sleep
+    def close(self):
+        if self.sleep is not None:
+            time.sleep, self.sleep = self.sleep, None
+
+####################################################################################################
+# RecordingTask class: a PyDAQmx Task recording every call with its buffers
+class RecordingTask:
+    module = None #The PyDAQmx module
+
+    def __init__(self, *args):
+        self._task = self.module.Task(*args)
+        self._stream = _session.newstream('task')
+
+    def __getattr__(self, name):
+        method = getattr(self._task, name)
+        if not callable(method):
+            return method
+        def call(*args):
+            buffers = [(i, b) for i, b in enumerate(map(argbuffer, args)) if b is not None]
+            header = {'m': name, 'b': [i for i, b in buffers]}
+            try:
+                result = method(*args)
+            except Exception as error:
+                header.update(e = str(error), x = type(error).__name__)
+                _session.write(self._stream, CALL, packpayload(header, [bytes(memoryview(b)) for i, b in buffers]))
+                raise
+            header['r'] = result if isinstance(result, (int, float, str, type(None))) else None
+            _session.write(self._stream, CALL, packpayload(header, [bytes(memoryview(b)) for i, b in buffers]))
+            return result
+        return call
+
+####################################################################################################
+# ReplayTask class: a Task returning the recorded results, copying the recorded samples into the buffers read
+class ReplayTask:
+    def __init__(self, *args):
+        self._stream = _session.newstream('task')
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        def call(*args):
+            header, data = _session.next(self._stream, CALL, name)
+            if header['m'] != name:
+                raise ReplayError("Task stream {} recorded {} where the replay calls {}".format(self._stream, header['m'], name))
+            #Only reads fill the caller's buffers; what was written is not copied back
+            if name.startswith(('Read', 'Get')):
+                for i, b in zip(header['b'], data):
+                    buffer = argbuffer(args[i]) if i < len(args) else None
+                    if buffer is not None:
+                        copyinto(buffer, b)
+            if 'e' in header:
+                raise ReplayedError('{}: {}'.format(header['x'], header['e']))
+            return header.get('r')
+        return call
+
+#Make the recording PyDAQmx module
+def recordingdaqmx(daqmx):
+    module = types.ModuleType('PyDAQmx')
+    names = [k for k in vars(daqmx) if not k.startswith('_')]
+    for k in names:
+        setattr(module, k, getattr(daqmx, k))
+    RecordingTask.module = daqmx
+    module.Task = RecordingTask
+    module.__all__ = names if 'Task' in names else names + ['Task']
+    return module
+
+#Make the replaying PyDAQmx module (the DAQmx constants are the recorded ones)
+def replaydaqmx(constants):
+    module = types.ModuleType('PyDAQmx')
+    for k, v in constants.items():
+        setattr(module, k, v)
+    module.Task = ReplayTask
+    module.DAQError = ReplayedError
+    module.__all__ = ['Task', 'DAQError'] + sorted(constants)
+    return module
+
+####################################################################################################
+# RecordingConnection class: a websocket connection recording the frames sent and received
+class RecordingConnection:
+    def __init__(self, ws, url):
+        self._ws = ws
+        self._stream = _session.newstream('websocket', url)
+
+    def send(self, packet, *args, **kwargs):
+        _session.write(self._stream, SEND, packpayload({'f': redactframe(packet) if isinstance(packet, str) else None},
+                                                      [] if isinstance(packet, str) else [packet]))
+        return self._ws.send(packet, *args, **kwargs)
+
+    def recv(self):
+        try:
+            frame = self._ws.recv()
+        except Exception as error:
+            _session.write(self._stream, RECV, packpayload({'e': str(error), 'x': type(error).__name__}))
+            raise
+        _session.write(self._stream, RECV, packpayload({'f': frame if isinstance(frame, str) else None},
+                                                       [] if isinstance(frame, str) else [frame]))
+        return frame
+
+    def __getattr__(self, name):
+        return getattr(self._ws, name)
+
+####################################################################################################
+# ReplayConnection class: a websocket connection returning the recorded frames
+class ReplayConnection:
+    module = None #The replaying websocket module (for its exceptions)
+
+    def __init__(self, url):
+        self._stream = _session.newstream('websocket', url)
+        self.connected = True
+
+    def send(self, packet, *args, **kwargs):
+        _session.next(self._stream, SEND, 'websocket send')
+
+    def recv(self):
+        header, data = _session.next(self._stream, RECV, 'websocket recv')
+        if 'e' in header:
+            raise getattr(self.module, header['x'], ReplayedError)(header['e'])
+        return header['f'] if header['f'] is not None else data[0]
+
+    def settimeout(self, timeout):
+        pass
+
+    def connect(self, url, *args, **kwargs):
+        self.connected = True
+
+    def close(self, *args, **kwargs):
+        self.connected = False
+
+#Make the recording websocket module
+def recordingwebsocket(websocket):
+    module = types.ModuleType('websocket')
+    module.__dict__.update({k: v for k, v in vars(websocket).items() if not k.startswith('__')})
+    module.create_connection = lambda url, *args, **kwargs: RecordingConnection(websocket.create_connection(url, *args, **kwargs), url)
+    return module
+
+#Make the replaying websocket module
+def replaywebsocket():
+    module = types.ModuleType('websocket')
+    for name in ('WebSocketException', 'WebSocketConnectionClosedException', 'WebSocketTimeoutException'):
+        setattr(module, name, type(name, (ReplayedError,), {}))
+    ReplayConnection.module = module
+    module.create_connection = lambda url, *args, **kwargs: ReplayConnection(url)
+    return module
+
+####################################################################################################
+# ReplayResponse class: the recorded reply of an HTTP request
+class ReplayResponse:
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+        self.text = content.decode(errors = 'replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+#Make the recording requests module (HTTP gets share one stream)
+def recordingrequests(requests):
+    module = types.ModuleType('requests')
+    module.__dict__.update({k: v for k, v in vars(requests).items() if not k.startswith('__')})
+    stream = []
+    def get(url, *args, **kwargs):
+        if not stream:
+            stream.append(_session.newstream('http'))
+        try:
+            r = requests.get(url, *args, **kwargs)
+        except Exception as error:
+            _session.write(stream[0], RECV, packpayload({'url': redacturl(url), 'e': str(error), 'x': type(error).__name__}))
+            raise
+        _session.write(stream[0], RECV, packpayload({'url': redacturl(url), 'status': r.status_code}, [r.content]))
+        return r
+    module.get = get
+    return module
+
+#Make the replaying requests module
+def replayrequests():
+    module = types.ModuleType('requests')
+    stream = []
+    def get(url, *args, **kwargs):
+        if not stream:
+            stream.append(_session.newstream('http'))
+        header, data = _session.next(stream[0], RECV, redacturl(url))
+        if 'e' in header:
+            raise ReplayedError('{}: {}'.format(header['x'], header['e']))
+        return ReplayResponse(header['status'], data[0])
+    module.get = get
+    module.RequestException = ReplayedError
+    return module
+
+####################################################################################################
+#ZMQ: SUB sockets (and the pollers of them) are recorded and replayed, every other socket is left alone
+####################################################################################################
+
+#Make the zmq module of a session, whose contexts make socketclass sockets and whose pollers are pollerclass
+def sessionzmq(zmq, socketclass, pollerclass):
+    module = types.ModuleType('zmq')
+    module.__dict__.update({k: v for k, v in vars(zmq).items() if not k.startswith('__')})
+    class Context(zmq.Context):
+        _socket_class = socketclass
+        def socket(self, socket_type, **kwargs):
+            socket = zmq.Context.socket(self, socket_type, **kwargs)
+            if socket_type == zmq.SUB:
+                socket.stream = _session.newstream('socket', 'SUB')
+            return socket
+    module.Context = Context
+    module.Poller = pollerclass
+    return module
+
+# Mixin with the stream of a socket (pyzmq sockets only take attributes declared on the class)
+class SessionSocket:
+    stream = None #Stream of a SUB socket (None for other sockets)
+
+# RecordingSocket class: records the messages received on SUB sockets
+class RecordingSocket(SessionSocket, zmq.Socket):
+    def recv_multipart(self, flags = 0, copy = True, track = False):
+        if self.stream is None:
+            return zmq.Socket.recv_multipart(self, flags, copy = copy, track = track)
+        #The frames are read with the base recv so that they are not also recorded one by one
+        frames = [zmq.Socket.recv(self, flags)]
+        while self.getsockopt(zmq.RCVMORE):
+            frames.append(zmq.Socket.recv(self, flags))
+        _session.write(self.stream, RECV, packpayload({}, frames))
+        return frames
+
+    def recv(self, flags = 0, copy = True, track = False):
+        if self.stream is None:
+            return zmq.Socket.recv(self, flags, copy = copy, track = track)
+        frame = zmq.Socket.recv(self, flags)
+        _session.write(self.stream, RECV, packpayload({}, [frame]))
+        return frame
+
+    def poll(self, timeout = None, flags = zmq.POLLIN):
+        event = zmq.Socket.poll(self, timeout, flags)
+        if self.stream is not None:
+            _session.write(self.stream, POLL, packpayload({'e': [[self.stream, event]] if event else []}))
+        return event
+
+# ReplaySocket class: SUB sockets return the recorded messages
+class ReplaySocket(SessionSocket, zmq.Socket):
+    def recv_multipart(self, flags = 0, copy = True, track = False):
+        if self.stream is None:
+            return zmq.Socket.recv_multipart(self, flags, copy = copy, track = track)
+        return _session.next(self.stream, RECV, 'zmq recv')[1]
+
+    def recv(self, flags = 0, copy = True, track = False):
+        if self.stream is None:
+            return zmq.Socket.recv(self, flags, copy = copy, track = track)
+        return _session.next(self.stream, RECV, 'zmq recv')[1][0]
+
+    def poll(self, timeout = None, flags = zmq.POLLIN):
+        if self.stream is None:
+            return zmq.Socket.poll(self, timeout, flags)
+        return sum(e for s, e in _session.next(self.stream, POLL, 'zmq poll')[0]['e'])
+
+# RecordingPoller class: records the events of polls which include SUB sockets
+# (the poll is recorded on the stream of the first SUB socket registered)
+class RecordingPoller(zmq.Poller):
+    def poll(self, timeout = None):
+        events = zmq.Poller.poll(self, timeout)
+        streams = [s.stream for s, flags in self.sockets if getattr(s, 'stream', None) is not None]
+        if streams:
+            recorded = [[s.stream, e] for s, e in events if getattr(s, 'stream', None) is not None]
+            _session.write(streams[0], POLL, packpayload({'e': recorded}))
+        return events
+
+# ReplayPoller class: returns the recorded events of polls which include SUB sockets
+class ReplayPoller(zmq.Poller):
+    def poll(self, timeout = None):
+        bystream = {s.stream: s for s, flags in self.sockets if getattr(s, 'stream', None) is not None}
+        if not bystream:
+            return zmq.Poller.poll(self, timeout)
+        header = _session.next(min(bystream), POLL, 'zmq poll')[0]
+        return [(bystream[s], e) for s, e in header['e'] if s in bystream]
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+"""
+stark.py: Calculated Rydberg Stark maps, to interpret the measured maps (Stark_data.hdf)
+
+The Stark Hamiltonian H = H0 + F z is built in a basis of |n, l, m> states (fixed m, n within dn
+of the target state, fine structure neglected):
+    H0   diagonal, the zero-field energies -R/(n - delta(n, l))**2 from the quantum defects
+    z    <n l m|z|n' l+-1 m> = angular factor x radial integral
+The radial integrals use wavefunctions from a Numerov integration of the Coulomb potential at the
+quantum defect energies (the Coulomb approximation), in the scaled coordinate x = sqrt(r). They are
+kept in an on-disk cache (__cfibcache__/<species>_radial.npz in the configuration directory), so
+each is only calculated once.
+
+The Hamiltonian is diagonalised at every field with a shift-invert sparse eigensolver (only the
+neigs levels closest to the target state are found), split over a process pool. The result is a
+StarkMap: energies (GHz, detuning from the zero-field target level) and the target state character
+of each level, for fields in V/cm. Measured wavelengths are put in the same units with detuning().
+
+    from cfib.stark import StarkCalculator
+    calc = StarkCalculator('Rb85', 50, 0, m = 0, dn = 3)
+    starkmap = calc.starkmap(np.linspace(0, 5, 200))
+    starkmap.save('Stark_theory.hdf')
+"""
+
+####################################################################################################
+#Import modules
+####################################################################################################
+import os #Operating system interfacing
+import json #Attributes of the saved maps
+import numpy as np #For maths
+from concurrent.futures import ProcessPoolExecutor #Process pool for the diagonalisation
+from cfib.registry import configdir, cachedirname #Directory of the dipole cache
+
+####################################################################################################
+#Definitions
+####################################################################################################
+
+#Speed of light (m/s)
+c = 299792458.0
+
+#Energy of a dipole of one e a0 in a field of 1 V/cm (GHz)
+fieldunit = 1.602176634e-19*5.29177210903e-11*100/6.62607015e-34/1e9
+
+#Atomic data: Rydberg constant (GHz, reduced mass), core polarisability (a.u.) and the quantum defects
+#[delta0, delta2] for each l (averaged over the fine structure with 2j+1 weights). Higher l have the
+#core polarisation defect. Rb: Li et al. PRA 67, 052502 (2003); Han et al. PRA 74, 054502 (2006)
+species = {
+    'Rb85': {'rydberg': 109736.605*c*1e-7, 'polarisability': 9.0760,
+             'defects': [[3.1311804, 0.1784], [2.6460774, 0.2933], [1.3471161, -0.5987], [0.0165387, -0.0856], [0.00405, 0.0]]},
+    'Rb87': {'rydberg': 109736.627*c*1e-7, 'polarisability': 9.0760,
+             'defects': [[3.1311804, 0.1784], [2.6460774, 0.2933], [1.3471161, -0.5987], [0.0165387, -0.0856], [0.00405, 0.0]]},
+    'H': {'rydberg': 109677.583*c*1e-7, 'polarisability': 0.0, 'defects': []},
+}
+
+#Step of the Numerov integration in x = sqrt(r) (a.u.)
+numerovstep = 0.01
+
+####################################################################################################
+#Define functions
+####################################################################################################
+
+#Quantum defect of the (n, l) states of a species
+def quantumdefect(atom, n, l):
+    data = species[atom]
+    if l < len(data['defects']):
+        delta0, delta2 = data['defects'][l]
+        return delta0 + delta2/(n - delta0)**2
+    #Core polarisation (none for hydrogen)
+    if data['polarisability'] == 0:
+        return 0.0
+    return 0.75*data['polarisability']/((l - 0.5)*l*(l + 0.5)*(l + 1)*(l + 1.5))
+
+#Zero-field energy (GHz, below the ionisation limit) of the (n, l) states of a species
+def levelenergy(atom, n, l):
+    return -species[atom]['rydberg']/(n - quantumdefect(atom, n, l))**2
+
+#Radial wavefunction of an (n, l) state as X(x) = x**1.5 R(r) on the grid x = k*step, integrated inwards
+#with Numerov from well outside the outer turning point. Returns the index of the first grid point and X
+def radialwavefunction(atom, n, l, step = numerovstep):
+    nstar = n - quantumdefect(atom, n, l)
+    energy = -0.5/nstar**2 #Atomic units
+    rcore = max(species[atom]['polarisability']**(1/3), step**2)
+    rturn = nstar**2 - nstar*np.sqrt(max(nstar**2 - l*(l + 1), 0)) #Inner classical turning point
+    kout = int(np.sqrt(2*nstar*(nstar + 15))/step)
+    kin = max(int(np.sqrt(rcore)/step), 1)
+    #X'' = g X with g = 8 x**2 (V - E) + (2l + 1/2)(2l + 3/2)/x**2 and V = -1/r
+    x = step*np.arange(kout + 1)
+    x[0] = step
+    g = -8 - 8*energy*x**2 + (2*l + 0.5)*(2*l + 1.5)/x**2
+    f = 1 - step**2*g/12
+    X = np.zeros(kout + 1)
+    X[kout] = 1e-10
+    X[kout - 1] = 1e-10*np.exp(step*np.sqrt(max(g[kout], 0)))
+    first = kin
+    for k in range(kout - 1, kin, -1):
+        X[k - 1] = ((12 - 10*f[k])*X[k] - f[k + 1]*X[k + 1])/f[k - 1]
+        #Inside the centrifugal barrier the wavefunction decays inwards; stop where the irregular solution takes over
+        if x[k - 1]**2 < rturn and abs(X[k - 1]) > abs(X[k]):
+            first = k
+            break
+    X = X[first:]
+    X /= np.sqrt(2*step*np.sum(X**2*x[first:]**2))
+    return first, X
+
+#Radial integral <1|r|2> (a.u.) of two wavefunctions from radialwavefunction
+def radialintegral(wf1, wf2, step = numerovstep):
+    (k1, X1), (k2, X2) = wf1, wf2
+    k = max(k1, k2)
+    length = min(k1 + X1.size, k2 + X2.size) - k
+    x = step*np.arange(k, k + length)
+    return 2*step*np.sum(X1[k - k1:k - k1 + length]*X2[k - k2:k - k2 + length]*x**4)
+
+#Angular factor of <l m|cos(theta)|l2 m> (zero unless l2 = l +- 1)
+def angularfactor(l, l2, m):
+    if l2 == l + 1:
+        return np.sqrt(((l + 1)**2 - m**2)/((2*l + 1)*(2*l + 3)))
+    if l2 == l - 1:
+        return np.sqrt((l**2 - m**2)/((2*l + 1)*(2*l - 1)))
+    return 0.0
+
+#Detuning (GHz) of measured wavelengths (nm, vacuum) from a reference wavelength, times the number of
+#photons (or the harmonic) of the excitation: the units of StarkMap.energies
+def detuning(wavelength, reference, multiplier = 1):
+    return multiplier*c*(1/np.asarray(wavelength, dtype = np.float64) - 1/reference)
+
+#Diagonalise the Hamiltonian at a set of fields (run in the process pool)
+#Returns the neigs energies closest to sigma at each field and the weight of the target state in each
+def diagonalisefields(energies0, z, fields, sigma, neigs, target, sparse = True):
+    import scipy.sparse
+    import scipy.sparse.linalg
+    size = energies0.size
+    energies = np.zeros((len(fields), neigs))
+    character = np.zeros((len(fields), neigs))
+    H0 = scipy.sparse.diags(energies0)
+    for i, field in enumerate(fields):
+        H = (H0 + (field*fieldunit)*z).tocsc()
+        if sparse and neigs < size - 1:
+            values, vectors = scipy.sparse.linalg.eigsh(H, k = neigs, sigma = sigma, which = 'LM')
+        else:
+            values, vectors = np.linalg.eigh(H.toarray())
+            closest = np.sort(np.argsort(np.abs(values - sigma))[:neigs])
+            values, vectors = values[closest], vectors[:, closest]
+        order = np.argsort(values)
+        energies[i] = values[order]
+        character[i] = vectors[target, order]**2
+    return energies, character
+
+####################################################################################################
+#Define classes
+####################################################################################################
+
+####################################################################################################
+# DipoleCache class: radial integrals of a species, kept on disk
+class DipoleCache:
+    def __init__(self, atom, directory = os.path.join(configdir, cachedirname)):
+        self.atom = atom #Species
+        self.filename = os.path.join(directory, '{}_radial.npz'.format(atom))
+        self.values = {} #(n1, l1, n2, l2) -> radial integral (a.u.), with (n1, l1) <= (n2, l2)
+        self.wavefunctions = {} #(n, l) -> wavefunction (in memory only)
+        self.added = 0 #Integrals calculated since the cache was read
+        if os.path.exists(self.filename):
+            with np.load(self.filename) as data:
+                self.values = dict(zip(map(tuple, data['keys'].tolist()), data['values'].tolist()))
+
+    # Radial integral <n1 l1|r|n2 l2>, calculated if it is not in the cache
+    def radial(self, n1, l1, n2, l2):
+        key = (n1, l1, n2, l2) if (n1, l1) <= (n2, l2) else (n2, l2, n1, l1)
+        value = self.values.get(key)
+        if value is None:
+            for state in (key[:2], key[2:]):
+                if state not in self.wavefunctions:
+                    self.wavefunctions[state] = radialwavefunction(self.atom, *state)
+            value = self.values[key] = radialintegral(self.wavefunctions[key[:2]], self.wavefunctions[key[2:]])
+            self.added += 1
+        return value
+
+    # Write the cache (if anything was added)
+    def save(self):
+        if self.added == 0:
+            return
+        os.makedirs(os.path.dirname(self.filename), exist_ok = True)
+        tmpfile = self.filename + '.tmp.npz'
+        np.savez(tmpfile, keys = np.array(list(self.values.keys()), dtype = np.int32).reshape(-1, 4), values = np.array(list(self.values.values())))
+        os.replace(tmpfile, self.filename)
+        self.added = 0
+
+####################################################################################################
+# StarkCalculator class: basis, zero-field energies and dipole matrix around a target state
+class StarkCalculator:
+    def __init__(self, atom, n, l, m = 0, dn = 3, lmax = None, cache = None):
+        import scipy.sparse
+        if atom not in species:
+            raise ValueError("Unknown species {}; use one of {}".format(atom, sorted(species)))
+        if abs(m) > l:
+            raise ValueError("|m| = {} is larger than l = {}".format(abs(m), l))
+        self.atom, self.n, self.l, self.m = atom, n, l, m
+        self.cache = DipoleCache(atom) if cache is None else cache
+        #Basis: every (n, l) with |n - n0| <= dn, |m| <= l <= lmax
+        self.basis = [(nb, lb) for nb in range(max(n - dn, 1), n + dn + 1) for lb in range(abs(m), nb if lmax is None else min(nb, lmax + 1))]
+        self.index = {state: i for i, state in enumerate(self.basis)}
+        self.target = self.index[(n, l)]
+        self.energies0 = np.array([levelenergy(atom, nb, lb) for nb, lb in self.basis])
+        self.reference = self.energies0[self.target] #Zero-field energy of the target state (GHz)
+        #Dipole matrix (z, a.u.): couplings between l and l + 1
+        rows, cols, values = [], [], []
+        for i, (nb, lb) in enumerate(self.basis):
+            for n2 in range(max(n - dn, 1), n + dn + 1):
+                j = self.index.get((n2, lb + 1))
+                if j is not None:
+                    element = angularfactor(lb, lb + 1, m)*self.cache.radial(nb, lb, n2, lb + 1)
+                    rows += [i, j]
+                    cols += [j, i]
+                    values += [element, element]
+        self.cache.save()
+        self.z = scipy.sparse.csr_matrix((values, (rows, cols)), shape = (len(self.basis), len(self.basis)))
+
+    # Calculate the Stark map at fields (V/cm): the neigs levels closest to the target state, over workers processes
+    def starkmap(self, fields, neigs = 40, workers = None, sparse = True):
+        fields = np.asarray(fields, dtype = np.float64)
+        neigs = min(neigs, len(self.basis))
+        workers = workers or os.cpu_count() or 1
+        chunks = [chunk for chunk in np.array_split(fields, workers*4) if chunk.size > 0]
+        #The shift of the eigensolver is just off the target level, so it is never exactly an eigenvalue
+        args = (self.energies0, self.z, self.reference + 1e-3, neigs, self.target, sparse)
+        if workers == 1 or len(chunks) == 1:
+            results = [diagonalisefields(self.energies0, self.z, chunk, *args[2:]) for chunk in chunks]
+        else:
+            with ProcessPoolExecutor(max_workers = workers) as pool:
+                results = list(pool.map(diagonalisefields, *zip(*[(self.energies0, self.z, chunk) + args[2:] for chunk in chunks])))
+        energies = np.concatenate([r[0] for r in results]) - self.reference
+        character = np.concatenate([r[1] for r in results])
+        attrs = {'species': self.atom, 'n': self.n, 'l': self.l, 'm': self.m, 'basis_size': len(self.basis),
+                 'reference_GHz': self.reference, 'basis': json.dumps(self.basis)}
+        return StarkMap(fields, energies, character, attrs)
+
+####################################################################################################
+# StarkMap class: calculated energies (GHz detuning from the zero-field target level) against field (V/cm)
+class StarkMap:
+    def __init__(self, fields, energies, character, attrs = None):
+        self.fields = fields #Fields (V/cm)
+        self.energies = energies #(field, level) detuning from the zero-field target level (GHz)
+        self.character = character #(field, level) weight of the target state (excitation strength)
+        self.attrs = attrs or {} #Species, target state and basis
+
+    # Levels within a detuning window (GHz) as flat arrays of (field, energy, character), e.g. for a scatter overlay
+    def points(self, lo = -np.inf, hi = np.inf, min_character = 0.0):
+        fields = np.broadcast_to(self.fields[:, None], self.energies.shape)
+        keep = (self.energies >= lo) & (self.energies <= hi) & (self.character >= min_character)
+        return fields[keep], self.energies[keep], self.character[keep]
+
+    # Save to a group of an HDF5 file (e.g. next to the measured slabs)
+    def save(self, filename, name = None):
+        import h5py
+        name = name or 'stark_map_{}_{}{}_m{}'.format(self.attrs.get('species', ''), self.attrs.get('n', ''), 'spdfg'[self.attrs['l']] if self.attrs.get('l', 9) < 5 else self.attrs.get('l', ''), self.attrs.get('m', ''))
+        with h5py.File(filename, 'a') as f:
+            if name in f:
+                del f[name]
+            group = f.create_group(name)
+            group['fields'] = self.fields
+            group['energies'] = self.energies
+            group['character'] = self.character
+            group['fields'].attrs['units'] = 'V/cm'
+            group['energies'].attrs['units'] = 'GHz detuning from the zero-field target level'
+            for key, value in self.attrs.items():
+                group.attrs[key] = value
+        return name
+
+    # Read a map saved with save
+    @classmethod
+    def load(cls, filename, name):
+        import h5py
+        with h5py.File(filename, 'r') as f:
+            group = f[name]
+            return cls(group['fields'][...], group['energies'][...], group['character'][...], dict(group.attrs))
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+"""
+Define the common timebase of the CFIB control system
+
+All data are stamped on one reference timebase: the host monotonic clock shifted to UNIX time when
+the process started (Timebase.now). It is in seconds like time.time(), so it can be logged and
+printed as before, but it never steps when the system clock is adjusted.
+
+Other clocks are related to the reference by a ClockModel, a linear fit (offset and rate) of pairs
+of (reference time, clock reading) with exponential forgetting, so offsets and drifts are tracked
+continuously:
+    'daq:<channel>'  NI sample clock, in samples since the task started (nominal rate = sample rate)
+    'ics2'           iCS2 server time from the 't' field of responses, paired at each round trip
+    'wall'           the host system clock (time.time()), which NTP may step or slew
+The wavemeter messages carry no time, so they are stamped with the reference time on receipt.
+Conversions work on whole arrays, so streams can be joined after the fact with align().
+"""
+
+####################################################################################################
+#Import modules
+####################################################################################################
+import time #Time access and conversions
+import numpy as np #For maths
+
+####################################################################################################
+#Define classes
+####################################################################################################
+
+####################################################################################################
+# ClockModel class: clock = offset + rate*(reference - start), fitted to (reference, clock) pairs
+class ClockModel:
+    def __init__(self, name, rate = 1.0, memory = 600.0, min_roundtrip = 1e-3):
+        self.name = name #Name of the clock
+        self.nominal_rate = float(rate) #Clock units per second, used until there is enough data to fit
+        self.memory = memory #Time constant (s) over which old pairs are forgotten
+        self.min_roundtrip = min_roundtrip #Round trips are weighted by 1/max(roundtrip, min_roundtrip)**2
+        self.samples = 0 #Number of pairs added
+        self.x0 = None #Reference time of the first pair (the fit is made relative to the first pair)
+        self.y0 = None #Clock reading of the first pair
+        self.last = None #Reference time of the last pair
+        self.sums = np.zeros(5) #Weighted sums of 1, x, y, x*x, x*y
+        self.rate = self.nominal_rate #Fitted rate
+        self.xmean = 0.0 #Weighted mean of the reference times (relative to x0)
+        self.ymean = 0.0 #Weighted mean of the clock readings (relative to y0)
+
+    # Add a pair of (reference time, clock reading) with an optional weight
+    def add(self, reference, reading, weight = 1.0):
+        if self.x0 is None:
+            self.x0, self.y0, self.last = float(reference), float(reading), float(reference)
+        #Forget old pairs
+        self.sums *= np.exp(-max(reference - self.last, 0)/self.memory)
+        self.last = max(self.last, float(reference))
+        x, y = reference - self.x0, reading - self.y0
+        self.sums += weight*np.array((1.0, x, y, x*x, x*y))
+        self.samples += 1
+        self.update()
+
+    # Add a reading taken during a request: sent and received are reference times around the request
+    def addroundtrip(self, sent, reading, received):
+        roundtrip = max(received - sent, self.min_roundtrip)
+        self.add((sent + received)/2, reading, 1/roundtrip**2)
+
+    # Refit the offset and rate from the weighted sums
+    def update(self):
+        w, sx, sy, sxx, sxy = self.sums
+        self.xmean, self.ymean = sx/w, sy/w
+        variance = sxx/w - self.xmean**2
+        #The rate is only fitted once the pairs span long enough to define it (a spread of about a second)
+        if self.samples > 2 and variance > 1.0:
+            self.rate = (sxy/w - self.xmean*self.ymean)/variance
+        else:
+            self.rate = self.nominal_rate
+
+    # True once at least one pair has been added
+    def ready(self):
+        return self.samples > 0
+
+    # Convert clock readings (scalar or array) to reference time
+    def toreference(self, readings):
+        if not self.ready():
+            raise ValueError("No readings of clock {} have been added".format(self.name))
+        return self.x0 + self.xmean + (np.asarray(readings, dtype = np.float64) - self.y0 - self.ymean)/self.rate
+
+    # Convert reference times (scalar or array) to clock readings
+    def fromreference(self, references):
+        if not self.ready():
+            raise ValueError("No readings of clock {} have been added".format(self.name))
+        return self.y0 + self.ymean + (np.asarray(references, dtype = np.float64) - self.x0 - self.xmean)*self.rate
+
+    # Offset of the clock from the reference at a reference time (seconds; clock minus reference)
+    def offset(self, reference = None):
+        reference = Timebase.now() if reference is None else reference
+        return self.fromreference(reference)/self.nominal_rate - reference
+
+####################################################################################################
+# Timebase class: the reference time and the models of the other clocks
+class Timebase:
+    #UNIX time at which the monotonic clock read zero, fixed when the module is imported
+    epoch = time.time() - time.monotonic()
+
+    def __init__(self):
+        self.clocks = {} #Clock name -> ClockModel
+
+    # The reference time now
+    @staticmethod
+    def now():
+        return time.monotonic() + Timebase.epoch
+
+    # The model of a clock (made on first use)
+    def clock(self, name, rate = 1.0, memory = 600.0):
+        if name not in self.clocks:
+            self.clocks[name] = ClockModel(name, rate, memory)
+        return self.clocks[name]
+
+    # Add a pair of the system clock and the reference, tracking adjustments of the system clock
+    def checkwall(self):
+        before = self.now()
+        wall = time.time()
+        self.clock('wall').addroundtrip(before, wall, self.now())
+
+    # Convert times (scalar or array) from one clock to another; None is the reference
+    def convert(self, times, source = None, target = None):
+        reference = times if source is None else self.clocks[source].toreference(times)
+        return np.asarray(reference, dtype = np.float64) if target is None else self.clocks[target].fromreference(reference)
+
+####################################################################################################
+#Define functions
+####################################################################################################
+
+#The timebase of this process (made on first use)
+_timebase = None
+def timebase():
+    global _timebase
+    if _timebase is None:
+        _timebase = Timebase()
+    return _timebase
+
+#Values of a stream (times ts, values) at the times t; all arrays on the same timebase
+#how = 'linear' (interpolate, NaN outside the stream), 'previous' (last value at or before t, NaN
+#before the stream) or 'nearest'
+def align(t, ts, values, how = 'linear'):
+    t, ts, values = np.asarray(t, dtype = np.float64), np.asarray(ts, dtype = np.float64), np.asarray(values, dtype = np.float64)
+    if how == 'linear':
+        return np.interp(t, ts, values, left = np.nan, right = np.nan)
+    #Index of the last stream time at or before each t (-1 if there is none)
+    i = np.searchsorted(ts, t, side = 'right') - 1
+    valid = i >= 0
+    if how == 'nearest':
+        #Move to the following stream time where it is closer
+        following = np.minimum(i + 1, len(ts) - 1)
+        closer = (i < 0) | (np.abs(ts[following] - t) < np.abs(t - ts[np.maximum(i, 0)]))
+        i = np.where(closer, following, i)
+        valid = np.ones(t.shape, dtype = bool)
+    elif how != 'previous':
+        raise ValueError("Unknown alignment {}; use linear, previous or nearest".format(how))
+    return np.where(valid, values[np.maximum(i, 0)], np.nan)
+
+#Convert reference (or UNIX) times to datetime64 (UTC), e.g. for plotting or printing whole arrays
+def todatetime64(times):
+    return (np.asarray(times, dtype = np.float64)*1e6).astype('datetime64[us]')
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""
+Define time tagging of detector edges and coincidence / time-of-flight histograms
+
+An EdgeTagger uses a counter to count a fast internal timebase (80 MHz by default) and latches the
+count on every edge of the detector signal (the edge is the sample clock of the counter task), so
+each sample read from the buffer is the time of an edge in timebase ticks. The 32 bit counts are
+unwrapped to 64 bits. Taggers on ctr0 and ctr1 count the same timebase, so their ticks can be
+compared directly; with an arm_source both start on the same edge, otherwise the start times differ
+by the few microseconds between the two StartTask calls (a constant offset).
+
+The histograms work on whole sorted arrays of ticks with searchsorted, so millions of events cost a
+few vectorised passes. DelayHistogram accumulates across reads, holding back the events near the
+end of each read whose partners may not have been read yet.
+"""
+
+####################################################################################################
+#Import modules
+####################################################################################################
+import ctypes #Module required for creating C type ojects - required for some PyDAQmx operations
+import numpy as np #For maths
+from cfib.timebase import timebase #Common timebase (the start of tagging is related to it)
+
+#PyDAQmx is only needed to acquire; the histograms can be used without it
+try:
+    from PyDAQmx import * #PyDAQmx module for working with the NI DAQ
+except (ImportError, NotImplementedError):
+    pass
+
+####################################################################################################
+#Definitions
+####################################################################################################
+
+#Internal timebases of the M series devices (ticks per second)
+timebaserates = {'80MHzTimebase': 80e6, '20MHzTimebase': 20e6, '100kHzTimebase': 1e5}
+
+####################################################################################################
+#Define functions
+####################################################################################################
+
+#Unwrap 32 bit counter samples to 64 bit, continuing from the last unwrapped value (None at the start)
+def unwrapticks(raw, last = None):
+    raw = np.asarray(raw, dtype = np.int64)
+    if raw.size == 0:
+        return raw
+    base = raw[0] if last is None else last
+    #Steps between samples modulo 2**32 take care of the rollovers
+    steps = np.diff(raw, prepend = base % 2**32) % 2**32
+    return base + np.cumsum(steps)
+
+#All delays (stop - start) within [lo, hi) between two sorted arrays of times
+#Returns the delays and the index of the start of each
+def pairdelays(starts, stops, lo, hi):
+    first = np.searchsorted(stops, starts + lo, side = 'left')
+    last = np.searchsorted(stops, starts + hi, side = 'left')
+    counts = last - first
+    total = int(counts.sum())
+    startindex = np.repeat(np.arange(starts.size), counts)
+    #Position of each pair within its start's run of stops
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    delays = stops[np.repeat(first, counts) + offsets] - starts[startindex]
+    return delays, startindex
+
+#Delay of each stop after the most recent start (time of flight). Stops before the first start are left out
+def previousdelays(starts, stops):
+    i = np.searchsorted(starts, stops, side = 'right') - 1
+    valid = i >= 0
+    return stops[valid] - starts[i[valid]]
+
+#Number of starts with at least one stop within +-window
+def coincidencecount(starts, stops, window):
+    first = np.searchsorted(stops, starts - window, side = 'left')
+    last = np.searchsorted(stops, starts + window, side = 'right')
+    return int(np.count_nonzero(last > first))
+
+####################################################################################################
+#Define classes
+####################################################################################################
+
+####################################################################################################
+# EdgeTagger class: times of the edges on a PFI line, from a counter counting an internal timebase
+class EdgeTagger:
+    def __init__(self, name, ctr_physchan, edge_terminal, timebase_name = '80MHzTimebase', buffer_size = 1000000, max_rate = 1e6, arm_source = None):
+        self.name = name #Name of the channel (e.g. 'start' or 'stop')
+        self.ctr_physchan = ctr_physchan #Counter used for tagging
+        self.device = ctr_physchan.split('/')[1] #Device of the counter (timebase and terminals are on the same device)
+        self.rate = timebaserates[timebase_name] #Ticks per second
+        self.last = None #Last unwrapped tick read
+        self.events = 0 #Number of edges tagged since the start
+        self.task = Task() #Define the task as Task()
+        self.read_samples = ctypes.c_int32() #Number of samples actually read
+        self.data = np.zeros(buffer_size, dtype = np.uint32) #Large enough to hold the whole DAQ buffer
+        #Count the timebase, latching the count on each detector edge
+        self.task.CreateCICountEdgesChan(ctr_physchan, '', DAQmx_Val_Rising, 0, DAQmx_Val_CountUp)
+        self.task.SetCICountEdgesTerm(ctr_physchan, '/{}/{}'.format(self.device, timebase_name))
+        self.task.CfgSampClkTiming(edge_terminal, max_rate, DAQmx_Val_Rising, DAQmx_Val_ContSamps, buffer_size)
+        #Optionally start counting on a shared edge, so the taggers have a common zero
+        if arm_source is not None:
+            self.task.SetArmStartTrigType(DAQmx_Val_DigEdge)
+            self.task.SetDigEdgeArmStartTrigSrc(arm_source)
+            self.task.SetDigEdgeArmStartTrigEdge(DAQmx_Val_Rising)
+        #Tick 0 is related to the common timebase when the task starts
+        self.clock = timebase().clock('daq:' + ctr_physchan, rate = self.rate)
+
+    # Start tagging
+    def start(self):
+        self.task.StartTask()
+        self.clock.add(timebase().now(), 0)
+
+    # Return the ticks (int64, unwrapped) of the edges since the previous read
+    def read(self):
+        self.task.ReadCounterU32(DAQmx_Val_Auto, 10.0, self.data, self.data.size, ctypes.byref(self.read_samples), None)
+        n = self.read_samples.value
+        ticks = unwrapticks(self.data[:n], self.last)
+        if n > 0:
+            self.last = int(ticks[-1])
+            self.events += n
+        return ticks
+
+    # Convert ticks to seconds since the start of tagging
+    def seconds(self, ticks):
+        return np.asarray(ticks)/self.rate
+
+    # Stop and clear the task
+    def close(self):
+        self.task.StopTask()
+        self.task.ClearTask()
+
+####################################################################################################
+# DelayHistogram class: histogram of stop - start delays, accumulated over any number of reads
+# mode = 'all' (every pair within the range: coincidence / cross-correlation histogram) or
+#        'previous' (each stop against the most recent start: time of flight)
+class DelayHistogram:
+    def __init__(self, edges, mode = 'all'):
+        if mode not in ('all', 'previous'):
+            raise ValueError("Unknown mode {}; use all or previous".format(mode))
+        self.edges = np.asarray(edges, dtype = np.int64) #Bin edges in ticks
+        self.mode = mode
+        self.counts = np.zeros(self.edges.size - 1, dtype = np.int64) #Histogram
+        #Equal bins are filled with bincount, which is much faster than searching the edges
+        widths = np.diff(self.edges)
+        self.width = int(widths[0]) if (widths == widths[0]).all() else None
+        self.starts = np.zeros(0, dtype = np.int64) #Events held back for the next read
+        self.stops = np.zeros(0, dtype = np.int64)
+
+    # Histogram the delays of the given starts and stops (ticks)
+    def histogram(self, starts, stops):
+        if self.mode == 'all':
+            delays, index = pairdelays(starts, stops, self.edges[0], self.edges[-1])
+        else:
+            delays = previousdelays(starts, stops)
+        if self.width is None:
+            return np.histogram(delays, self.edges)[0]
+        delays = delays[(delays >= self.edges[0]) & (delays < self.edges[-1])]
+        return np.bincount((delays - self.edges[0])//self.width, minlength = self.counts.size)
+
+    # Add the events of a read (sorted ticks on a common timebase)
+    def add(self, starts, stops):
+        starts = np.concatenate((self.starts, starts))
+        stops = np.concatenate((self.stops, stops))
+        if starts.size == 0 or stops.size == 0:
+            self.starts, self.stops = starts, stops
+            return
+        if self.mode == 'all':
+            #A start is complete once stops have been read up to start + range; keep the others, and the stops they may pair with
+            #(later starts can only be at or after the last start read)
+            done = starts + self.edges[-1] <= stops[-1]
+            keep_from = (starts[~done][0] if not done.all() else starts[-1]) + self.edges[0]
+        else:
+            #A stop is complete once a later start has been read; keep the others and the start before them
+            last_start = starts[-1]
+            done = stops <= last_start
+            keep_from = last_start
+        if self.mode == 'all':
+            self.counts += self.histogram(starts[done], stops)
+            self.starts, self.stops = starts[~done], stops[stops >= keep_from]
+        else:
+            self.counts += self.histogram(starts, stops[done])
+            self.starts, self.stops = starts[starts >= keep_from], stops[~done]
+
+    # Histogram the events held back (at the end of acquisition) and return the histogram
+    def flush(self):
+        if self.starts.size > 0 and self.stops.size > 0:
+            self.counts += self.histogram(self.starts, self.stops)
+        self.starts, self.stops = self.starts[:0], self.stops[:0]
+        return self.counts
+
+    # Clear the histogram and the held back events
+    def reset(self):
+        self.counts[:] = 0
+        self.starts, self.stops = self.starts[:0], self.stops[:0]
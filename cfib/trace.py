@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+"""
+Define timing instrumentation of the hot paths of the CFIB control system
+
+Phases of the code are timed as named spans:
+
+    with span('counter read'):
+        value = readcounter()
+
+or, where a context does not fit the code, start = tracer().clock(); ...; tracer().record('name', start).
+Each span adds its duration to a histogram of its name (log spaced bins, 10 per decade from 1 us
+to 1000 s), so the count, total, mean, min, max and percentiles of every phase are kept in memory
+whatever the length of the run. With record_events the spans are also kept as events and can be
+written as a Chrome trace (exportchrome), which opens in chrome://tracing or ui.perfetto.dev.
+
+When the tracer is disabled, span returns a shared object that does nothing.
+"""
+
+####################################################################################################
+#Import modules
+####################################################################################################
+import os #Operating system interfacing (process ID of the trace)
+import math #For the histogram bins
+import json #Trace file format
+import time #Time access and conversions
+import threading #Thread of each event
+import numpy as np #For the percentiles
+
+####################################################################################################
+#Definitions
+####################################################################################################
+
+#Histogram bins: 10 per decade from 1 us (bin 0 holds anything shorter) to 1000 s
+bins_per_decade = 10
+min_decade = -6
+numbins = 9*bins_per_decade + 1
+binedges = 10**(min_decade + np.arange(numbins + 1)/bins_per_decade) #Upper edge of bin i is binedges[i+1]
+
+####################################################################################################
+#Define classes
+####################################################################################################
+
+####################################################################################################
+# SpanStats class: histogram and totals of the durations of one span name
+class SpanStats:
+    __slots__ = ('count', 'total', 'min', 'max', 'bins')
+
+    def __init__(self):
+        self.count = 0 #Number of spans
+        self.total = 0.0 #Total duration (s)
+        self.min = math.inf #Shortest span (s)
+        self.max = 0.0 #Longest span (s)
+        self.bins = [0]*numbins #Histogram of the durations
+
+    # Add a duration (s)
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if duration < self.min:
+            self.min = duration
+        if duration > self.max:
+            self.max = duration
+        i = int((math.log10(duration) - min_decade)*bins_per_decade) if duration > 0 else 0
+        self.bins[min(max(i, 0), numbins - 1)] += 1
+
+    # Duration below which a fraction q of the spans fall (upper edge of the bin containing it)
+    def percentile(self, q):
+        if self.count == 0:
+            return np.nan
+        i = int(np.searchsorted(np.cumsum(self.bins), q*self.count))
+        return min(float(binedges[min(i, numbins - 1) + 1]), self.max)
+
+    # Summary as a dictionary
+    def summary(self):
+        return {'count': self.count, 'total': self.total, 'mean': self.total/self.count if self.count else np.nan,
+                'min': self.min if self.count else np.nan, 'max': self.max,
+                'p50': self.percentile(0.5), 'p90': self.percentile(0.9), 'p99': self.percentile(0.99)}
+
+####################################################################################################
+# Span class: context manager timing one phase
+class Span:
+    __slots__ = ('tracer', 'name', 'start')
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, self.start)
+        return False
+
+####################################################################################################
+# NullSpan class: what span returns when the tracer is disabled
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+nullspan = NullSpan()
+
+####################################################################################################
+# Tracer class: span statistics and (optionally) events
+class Tracer:
+    def __init__(self, enabled = True, record_events = False, max_events = 1000000):
+        self.enabled = enabled #Time spans at all
+        self.record_events = record_events #Keep every span for the trace file
+        self.max_events = max_events #Events beyond this are not kept (the statistics still are)
+        self.start = time.perf_counter() #Time zero of the trace
+        self.stats = {} #Name -> SpanStats
+        self.events = [] #(name, start, duration, thread ID)
+        self.lock = threading.Lock() #Spans may be recorded from several threads
+
+    # Time a phase (use in a with statement)
+    def span(self, name):
+        if not self.enabled:
+            return nullspan
+        return Span(self, name)
+
+    # The clock of the spans
+    @staticmethod
+    def clock():
+        return time.perf_counter()
+
+    # Record a span that started at start (from clock()) and ended at end (now if None)
+    def record(self, name, start, end = None):
+        if not self.enabled:
+            return
+        duration = (time.perf_counter() if end is None else end) - start
+        with self.lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = SpanStats()
+            stats.add(duration)
+            if self.record_events and len(self.events) < self.max_events:
+                self.events.append((name, start, duration, threading.get_ident()))
+
+    # Summary of every span name, as {name: {count, total, mean, min, max, p50, p90, p99}}
+    def summary(self):
+        with self.lock:
+            return {name: stats.summary() for name, stats in self.stats.items()}
+
+    # Print a table of the spans, longest total first
+    def report(self):
+        summary = self.summary()
+        print('{:<20}{:>9}{:>12}{:>11}{:>11}{:>11}{:>11}'.format('span', 'count', 'total (s)', 'mean (ms)', 'p50 (ms)', 'p99 (ms)', 'max (ms)'))
+        for name, s in sorted(summary.items(), key = lambda item: -item[1]['total']):
+            print('{:<20}{:>9d}{:>12.3f}{:>11.3f}{:>11.3f}{:>11.3f}{:>11.3f}'.format(name, s['count'], s['total'], 1e3*s['mean'], 1e3*s['p50'], 1e3*s['p99'], 1e3*s['max']))
+
+    # Write the events as a Chrome trace (JSON, times in microseconds from the start of the tracer)
+    def exportchrome(self, filename):
+        pid = os.getpid()
+        with self.lock:
+            events = [{'name': name, 'ph': 'X', 'ts': 1e6*(start - self.start), 'dur': 1e6*duration, 'pid': pid, 'tid': tid}
+                      for name, start, duration, tid in self.events]
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        print('Trace of {} spans written to {}'.format(len(events), filename))
+
+    # Clear the statistics and events
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+            self.events = []
+        self.start = time.perf_counter()
+
+####################################################################################################
+#Define functions
+####################################################################################################
+
+#The tracer of this process (made on first use; statistics only)
+_tracer = None
+def tracer():
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer()
+    return _tracer
+
+#Time a phase with the tracer of this process
+def span(name):
+    return tracer().span(name)
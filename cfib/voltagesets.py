@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+"""
+Define the versioned store of electrode voltage sets for the CFIB control system
+
+Every voltage set (e.g. 20190212_Initialisation-voltages.txt) imported into the store is kept as
+{electrode: voltage} under the hash of its contents, so a set can always be recovered exactly. The
+index (voltage_sets/index.json in the configuration directory) holds
+    versions: [hash, name, time] in time order     -> latest, and as of a date (bisect)
+    files:    path -> [mtime_ns, size, hash]       -> unchanged files are not parsed again
+    runs:     run (e.g. scan slab name) -> hash    -> the set used for a run
+    applied:  [time, hash] each time a set is loaded on the iCS2
+The time of a set is the date in its file name (YYYYMMDD_...) if there is one, otherwise the file
+modification time. Scans record the applied set in their HDF5 slab (see attach).
+"""
+
+####################################################################################################
+#Import modules
+####################################################################################################
+import os #Operating system interfacing
+import re #For dates in file names
+import json #Index and set file format
+import time #Time access and conversions
+import bisect #For lookups by time
+import hashlib #Content hashes
+from datetime import datetime #For dates in file names
+from cfib.registry import configdir #Directory of the configuration files
+
+####################################################################################################
+#Definitions
+####################################################################################################
+
+#Directory of the store (in the configuration directory)
+storedir = os.path.join(configdir, 'voltage_sets')
+
+#Date at the start of a voltage file name
+filedate = re.compile(r'^(\d{8})_')
+
+####################################################################################################
+#Define functions
+####################################################################################################
+
+#Hash of a voltage set: independent of the order of the electrodes and of int/float voltages
+def sethash(voltages):
+    canonical = json.dumps(sorted((e, float(v)) for e, v in voltages.items()), separators = (',', ':'))
+    return hashlib.sha1(canonical.encode()).hexdigest()
+
+#Write a JSON file atomically, so readers in other processes never see a partial file
+def writejson(filename, data):
+    tmpfile = filename + '.tmp'
+    with open(tmpfile, 'w') as f:
+        json.dump(data, f, indent = 1)
+    os.replace(tmpfile, filename)
+
+#Time of a voltage file: the date in the name if given, otherwise the modification time
+def filetime(filename):
+    match = filedate.match(os.path.basename(filename))
+    if match:
+        return datetime.strptime(match.group(1), '%Y%m%d').timestamp()
+    return os.path.getmtime(filename)
+
+#Convert a date ('2019-02-12', '20190212', datetime or UNIX time) to UNIX time
+def totimestamp(date):
+    if isinstance(date, datetime):
+        return date.timestamp()
+    if isinstance(date, str):
+        for fmt in ('%Y%m%d', '%Y-%m-%d', '%Y-%m-%d %H:%M:%S'):
+            try:
+                return datetime.strptime(date, fmt).timestamp()
+            except ValueError:
+                pass
+        raise ValueError("Unrecognised date {}; use YYYY-MM-DD or YYYYMMDD".format(date))
+    return float(date)
+
+####################################################################################################
+#Define classes
+####################################################################################################
+
+####################################################################################################
+# VoltageSetStore class: content addressed voltage sets with a time, file and run index
+class VoltageSetStore:
+    def __init__(self, directory = storedir, registry = None):
+        self.directory = directory #Directory of the set files and index
+        self.indexfile = os.path.join(directory, 'index.json')
+        self.registry = registry #Used to read and check voltage files (cfib.functions.registry by default)
+        self.sets = {} #Hash -> {electrode: voltage} (loaded on demand)
+        self.stamp = None #Modification time and size of the index when it was read
+        self.empty()
+        self.refresh()
+
+    # Reset the in-memory index
+    def empty(self):
+        self.versions = [] #[hash, name, time] in time order
+        self.times = [] #Times of the versions (for bisect)
+        self.byhash = {} #Hash -> version
+        self.files = {} #Path -> [mtime_ns, size, hash]
+        self.runs = {} #Run -> hash
+        self.appliedsets = [] #[time, hash] in time order
+
+    # Reread the index if another process has changed it
+    def refresh(self):
+        try:
+            stat = os.stat(self.indexfile)
+        except OSError:
+            return
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp == self.stamp:
+            return
+        with open(self.indexfile, 'r') as f:
+            index = json.load(f)
+        self.empty()
+        for version in index['versions']:
+            self.addversion(*version)
+        self.files = index['files']
+        self.runs = index['runs']
+        self.appliedsets = index['applied']
+        self.stamp = stamp
+
+    # Write the index
+    def save(self):
+        os.makedirs(self.directory, exist_ok = True)
+        writejson(self.indexfile, {'versions': self.versions, 'files': self.files, 'runs': self.runs, 'applied': self.appliedsets})
+        stat = os.stat(self.indexfile)
+        self.stamp = (stat.st_mtime_ns, stat.st_size)
+
+    # Insert a version in time order
+    def addversion(self, sethash, name, settime):
+        i = bisect.bisect_right(self.times, settime)
+        version = [sethash, name, settime]
+        self.times.insert(i, settime)
+        self.versions.insert(i, version)
+        self.byhash.setdefault(sethash, version)
+
+    # Add a voltage set ({electrode: voltage}). Returns its hash; adding the same contents again adds a version only
+    def add(self, voltages, name = '', settime = None):
+        self.refresh()
+        voltages = {e: float(v) for e, v in voltages.items()}
+        h = sethash(voltages)
+        setfile = os.path.join(self.directory, h + '.json')
+        if not os.path.exists(setfile):
+            os.makedirs(self.directory, exist_ok = True)
+            writejson(setfile, voltages)
+        self.sets[h] = voltages
+        self.addversion(h, name, time.time() if settime is None else settime)
+        self.save()
+        return h
+
+    # Import a voltage file ("e1, 100" per line). Unchanged files are looked up, not parsed again
+    def importfile(self, filename):
+        self.refresh()
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        known = self.files.get(filename)
+        if known is not None and known[:2] == [stat.st_mtime_ns, stat.st_size]:
+            return known[2]
+        if self.registry is None:
+            from cfib.functions import registry
+            self.registry = registry
+        h = self.add(self.registry.loadvoltages(filename), os.path.basename(filename), filetime(filename))
+        self.files[filename] = [stat.st_mtime_ns, stat.st_size, h]
+        self.save()
+        return h
+
+    # The voltage set with a given hash, as {electrode: voltage}
+    def get(self, sethash):
+        if sethash not in self.sets:
+            with open(os.path.join(self.directory, sethash + '.json'), 'r') as f:
+                self.sets[sethash] = json.load(f)
+        return dict(self.sets[sethash])
+
+    # Hash of the most recent set (None if the store is empty)
+    def latest(self):
+        self.refresh()
+        return self.versions[-1][0] if self.versions else None
+
+    # Hash of the most recent set as of a date (see totimestamp); None if there is no earlier set
+    def asof(self, date):
+        self.refresh()
+        i = bisect.bisect_right(self.times, totimestamp(date))
+        return self.versions[i-1][0] if i > 0 else None
+
+    # Name and time of a set, as [hash, name, time] of its first version
+    def version(self, sethash):
+        self.refresh()
+        return self.byhash[sethash]
+
+    # Record that a set was loaded on the iCS2
+    def markapplied(self, sethash, t = None):
+        self.refresh()
+        self.appliedsets.append([time.time() if t is None else t, sethash])
+        self.save()
+
+    # Hash of the set on the iCS2 (the last one applied, or the last one applied as of a date)
+    def applied(self, date = None):
+        self.refresh()
+        if date is None:
+            return self.appliedsets[-1][1] if self.appliedsets else None
+        i = bisect.bisect_right([t for t, h in self.appliedsets], totimestamp(date))
+        return self.appliedsets[i-1][1] if i > 0 else None
+
+    # Record the set used for a run
+    def recordrun(self, run, sethash):
+        self.refresh()
+        self.runs[run] = sethash
+        self.save()
+
+    # Hash of the set used for a run (None if the run is not recorded)
+    def forrun(self, run):
+        self.refresh()
+        return self.runs.get(run)
+
+    # Record a set in the attributes of an HDF5 dataset or group
+    def attach(self, h5obj, sethash):
+        h5obj.attrs['voltage_set_hash'] = sethash
+        h5obj.attrs['voltage_set_name'] = self.version(sethash)[1]
+        h5obj.attrs['voltage_set'] = json.dumps(self.get(sethash))
+
+####################################################################################################
+#The store in the configuration directory (made on first use)
+_defaultstore = None
+def defaultstore():
+    global _defaultstore
+    if _defaultstore is None:
+        _defaultstore = VoltageSetStore()
+    return _defaultstore
+
+#The voltage set recorded in an HDF5 dataset or group, as {electrode: voltage} (None if there is none)
+def setfromdataset(h5obj):
+    if 'voltage_set' not in h5obj.attrs:
+        return None
+    return json.loads(h5obj.attrs['voltage_set'])
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+"""
+Define the interface to the high-finesse wavemeter (published over ZMQ by the wavemeter machine)
+"""
+
+####################################################################################################
+# Import modules
+####################################################################################################
+
+import zmq # Used for ZeroMQ distributed messaging (TCP interface with high-finesse wavemeter)
+from cfib.timebase import timebase # The messages carry no time, so they are stamped on receipt
+
+####################################################################################################
+# Define classes
+####################################################################################################
+
+####################################################################################################
+# wavemeter class for defining objects to interface with a high-finesse wavemeter
+
+class wavemeter:
+
+    # Initialise the wavemeter polling object
+    def __init__(self, address, port = '5678'):
+        self.address = address # LAN address for TCP polling (IP address of wavemeter machine)
+        self.port = port # Port for TCP polling
+        self.wavelength = None # Last measured wavelength
+        self.time = None # Time the last wavelength was received (cfib.timebase reference time)
+        self.ctx = zmq.Context() # Create a ZMQ Context
+        self.sub = self.ctx.socket(zmq.SUB) # Set the ZMQ socket object
+        self.poller = zmq.Poller() # Create a poller
+
+    # Initialise the subscription
+    def initialise(self):
+        self.sub.setsockopt(zmq.SUBSCRIBE, b'L1') # Set the SUB socket to the 'data' topic (needs to be a byte string!)
+        self.sub.connect('tcp://' + self.address + ':' + self.port) # Point to the publisher (currently on the atomchumps network)
+        self.poller.register(self.sub, zmq.POLLIN) # Set a ZMQ socket for monitoring
+
+    # Return the current wavelength
+    def getwavelength(self, verbose = False):
+        # Confirm that the wavelength is being queried
+        if verbose == True:
+            print("Listening for publications")
+
+        # Need to ensure that the queue has been flushed before retrieving wavelength
+        while True: # Flush
+            poll_dict = dict(self.poller.poll(0)) # Get the data from the poll
+            if self.sub in poll_dict and poll_dict[self.sub] == zmq.POLLIN:
+                # recieve message straight away just to remove it from the queue
+                self.sub.recv_multipart()
+            else: # Retrieve
+                # when there is nothing left in the queue, wait for the next message to come through, and use that one
+                msg = self.sub.recv_multipart() # Get the message
+                self.time = timebase().now() # Stamp the message
+                self.wavelength = float(bytes.decode(msg[1])) # Extract the wavelength and update the lambda attribute
+                if verbose == True:
+                    print("Retrieved wavelength: {} nm".format(self.wavelength))
+                break # Stop looking for broadcasts
+        return self.wavelength
+
+    # Close the subscription
+    def close(self):
+        self.sub.close()